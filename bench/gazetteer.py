@@ -0,0 +1,111 @@
+"""
+Замер поиска по справочнику городов на синтетическом справочнике большого размера.
+
+Генерирует справочник из --size пунктов с похожими названиями (много "Ново...",
+"Верхне...", одинаковые окончания), строит по нему CityGazetteer из main.py и ищет
+названия с одной опечаткой, которые не находятся ни точно, ни по префиксу, то есть
+доходят до нечеткого поиска. Для каждого запроса перебором по всему справочнику
+считается лучшее достижимое расстояние Левенштейна - так видно, как часто
+ограниченный просмотр триграмм находит оптимальный ответ.
+
+Запуск:
+    python bench/gazetteer.py --size 40000 --queries 200
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PREFIXES = ['Ново', 'Ново', 'Ново', 'Ново', 'Старо', 'Верхне', 'Нижне', 'Красно', 'Больше', 'Мало', 'Бело', 'Черно']
+SYLLABLES = ['се', 'ло', 'по', 'ля', 'ду', 'бо', 'ро', 'ка', 'ми', 'ни', 'ва', 'го', 'ре', 'ли', 'та', 'ра', 'мо',
+             'ту', 'зе', 'ры', 'ше', 'жа']
+SUFFIXES = ['во', 'ево', 'ино', 'ка', 'ки', 'ск', 'ское', 'ный', 'ная', 'овка', 'евка', 'ье', 'цы']
+TYPO_LETTERS = 'абвгдеклмнопрстуя'
+
+
+def parse_args():
+    """Разбирает параметры командной строки"""
+    parser = argparse.ArgumentParser(description="Замер нечеткого поиска по большому справочнику городов")
+    parser.add_argument('--size', type=int, default=40000, help="Число пунктов в синтетическом справочнике")
+    parser.add_argument('--queries', type=int, default=200, help="Число запросов с опечаткой")
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args()
+
+
+def generate_gazetteer(path, size):
+    """Пишет справочник из size уникальных похожих друг на друга названий"""
+    names = set()
+    while len(names) < size:
+        name = (random.choice(PREFIXES) if random.random() < 0.6 else '')
+        name += ''.join(random.choice(SYLLABLES) for _ in range(random.randint(1, 3))) + random.choice(SUFFIXES)
+        names.add(name.capitalize())
+    with open(path, 'w', encoding='utf-8') as f:
+        for name in sorted(names):
+            f.write(f"{name}\t{random.uniform(42, 70):.4f}\t{random.uniform(30, 170):.4f}\n")
+
+
+def make_typo(name):
+    """Одна замена, пропуск или вставка буквы (кроме первой)"""
+    letters = list(name)
+    position = random.randrange(1, len(letters))
+    roll = random.random()
+    if roll < 0.4:
+        letters[position] = random.choice(TYPO_LETTERS)
+    elif roll < 0.7:
+        del letters[position]
+    else:
+        letters.insert(position, random.choice(TYPO_LETTERS))
+    return ''.join(letters)
+
+
+def main():
+    """Строит справочник, прогоняет запросы и печатает задержки и долю оптимальных ответов"""
+    args = parse_args()
+    random.seed(args.seed)
+    os.environ.setdefault('LOG_DIR', tempfile.mkdtemp(prefix='bot-bench-'))
+    os.environ.setdefault('WEATHER_API_KEY', 'bench')
+    os.environ.setdefault('BOT_TOKEN', '123456789:BENCHMARKBENCHMARKBENCHMARKBENCHMAR')
+    sys.path.insert(0, ROOT_DIR)
+    import main as bot_main
+
+    path = os.path.join(os.environ['LOG_DIR'], 'cities-bench.tsv')
+    generate_gazetteer(path, args.size)
+    gazetteer = bot_main.CityGazetteer(path)
+    started = time.perf_counter()
+    gazetteer.load()
+    load_ms = (time.perf_counter() - started) * 1000
+
+    queries = []
+    while len(queries) < args.queries:
+        query = make_typo(random.choice(gazetteer._names))
+        key = bot_main.normalize_city_name(query)
+        if gazetteer.exact(key) or gazetteer.prefix(key):
+            continue
+        queries.append((query, key))
+
+    timings = []
+    optimal = 0
+    for query, key in queries:
+        started = time.perf_counter()
+        city = gazetteer.find(query)
+        timings.append(time.perf_counter() - started)
+        limit = max(1, len(key) // 4)
+        best = min(bot_main._edit_distance(key, other, limit) for other in gazetteer._keys)
+        found = bot_main._edit_distance(key, bot_main.normalize_city_name(city.name), limit) if city else limit + 1
+        optimal += found == best
+
+    timings.sort()
+    count = len(timings)
+    print(f"Справочник: {len(gazetteer)} пунктов, загрузка {load_ms:.0f} мс")
+    print(f"Нечеткий поиск, мс: p50={timings[count // 2] * 1000:.2f} "
+          f"p99={timings[int(count * 0.99)] * 1000:.2f} max={timings[-1] * 1000:.2f}")
+    print(f"Оптимальный ответ: {optimal} из {count}")
+    bot_main.log_writer.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,422 @@
+"""
+Нагрузочный тест бота без выхода в сеть.
+
+Поднимает в отдельном процессе локальные заглушки Telegram Bot API,
+Яндекс.Погоды, маркетплейсов и Авито (выдача отдается из сохраненной страницы
+bench/fixtures/avito_search.html) с настраиваемой задержкой и долей ошибок, создает синтетических
+пользователей, которые жмут кнопки weather/products/real_estate и пишут
+города и запросы, и прогоняет их обновления через настоящий dp из main.py
+с заданной частотой. В конце печатает пропускную способность, задержки
+p50/p95/p99 и пиковое потребление памяти.
+
+Запуск:
+    python bench/loadtest.py --rate 200 --duration 30 --users 2000
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import sys
+import tempfile
+import time
+from collections import deque
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES_DIR = os.path.join(ROOT_DIR, 'bench', 'fixtures')
+
+# Что пишут синтетические пользователи
+CITIES = ['Москва', 'москва', 'Питер', 'Самара', 'Самарa', 'Тольятти', 'Новосибирк', 'Казань', 'Екатеринбург',
+          'Тюмень', 'Салехард', 'село Горки', 'Мордово', 'Сочи', 'Неизвестный город']
+PRODUCTS = ['iPhone 15', 'Ноутбук ASUS', 'Фен Dyson', 'Кроссовки Nike', 'Пылесос', 'Чайник']
+PROPERTIES = ['1-комнатная квартира', '2-комнатная квартира аренда', 'Дом продажа', 'Студия Москва']
+
+def parse_args():
+    """Разбирает параметры командной строки"""
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на локальных заглушках")
+    parser.add_argument('--rate', type=float, default=100, help="Целевая частота обновлений в секунду")
+    parser.add_argument('--duration', type=float, default=20, help="Длительность подачи нагрузки, с")
+    parser.add_argument('--users', type=int, default=1000, help="Число синтетических пользователей")
+    parser.add_argument('--think-time', type=float, default=1.0, help="Пауза пользователя между действиями, с")
+    parser.add_argument('--tg-latency', type=float, default=0.03, help="Задержка ответа заглушки Telegram, с")
+    parser.add_argument('--tg-error-rate', type=float, default=0.0, help="Доля ответов 429 от заглушки Telegram")
+    parser.add_argument('--weather-latency', type=float, default=0.2, help="Задержка ответа заглушки погоды, с")
+    parser.add_argument('--weather-error-rate', type=float, default=0.01, help="Доля ответов 500 от заглушки погоды")
+    parser.add_argument('--market-latency', type=float, default=0.3,
+                        help="Задержка ответа заглушек маркетплейсов, с (Ozon отвечает втрое медленнее)")
+    parser.add_argument('--send-rate', type=float, default=1000,
+                        help="Общий лимит исходящих сообщений бота в секунду (30 - как у настоящего Telegram)")
+    parser.add_argument('--chat-rate', type=float, default=1000,
+                        help="Лимит сообщений в секунду на чат (1 - как у настоящего Telegram)")
+    parser.add_argument('--drain-timeout', type=float, default=30, help="Сколько ждать завершения обработки после подачи, с")
+    parser.add_argument('--json', action='store_true', help="Вывести отчет в JSON")
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args()
+
+def free_port():
+    """Возвращает свободный локальный порт"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+# Заглушки внешних сервисов (работают в отдельном процессе, чтобы не искажать замеры бота)
+def run_stub_servers(tg_port, weather_port, config, ready):
+    """Точка входа процесса заглушек"""
+    asyncio.run(serve_stubs(tg_port, weather_port, config, ready))
+
+def fake_forecast():
+    """Ответ в формате Яндекс.Погоды со случайными значениями"""
+    temp = random.randint(-25, 30)
+    days = []
+    for offset in range(7):
+        day = time.gmtime(time.time() + offset * 86400)
+        days.append({
+            'date': time.strftime('%Y-%m-%d', day),
+            'parts': {'day': {'temp_min': temp - 3, 'temp_max': temp + 3, 'condition': 'cloudy'}},
+            'hours': [{'hour': str(hour), 'temp': temp + hour % 5, 'condition': 'clear'} for hour in range(24)]
+        })
+    return {
+        'now': int(time.time()),
+        'fact': {
+            'temp': temp, 'feels_like': temp - 2, 'condition': random.choice(['clear', 'cloudy', 'rain', 'snow']),
+            'wind_dir': 'nw', 'wind_speed': 3.5, 'humidity': 70, 'pressure_mm': 745
+        },
+        'forecasts': days
+    }
+
+def fake_offers(query, count=10):
+    """Случайные предложения по запросу: (название, цена в рублях)"""
+    return [(f"{query} модель {number}", random.randint(500, 150000)) for number in range(count)]
+
+async def serve_stubs(tg_port, weather_port, config, ready):
+    """Поднимает заглушки Telegram Bot API, Яндекс.Погоды и маркетплейсов"""
+    from aiohttp import web
+
+    message_ids = itertools.count(1)
+
+    async def jitter_sleep(latency):
+        if latency > 0:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * latency)
+
+    async def telegram_handler(request):
+        method = request.match_info['method']
+        await jitter_sleep(config['tg_latency'])
+        if method not in ('getMe', 'getUpdates') and random.random() < config['tg_error_rate']:
+            return web.json_response({
+                'ok': False, 'error_code': 429,
+                'description': 'Too Many Requests: retry after 1', 'parameters': {'retry_after': 1}
+            }, status=429)
+
+        fields = await request.post()
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        elif method == 'getUpdates':
+            result = []
+        elif method in ('sendMessage', 'editMessageText', 'sendPhoto'):
+            result = {
+                'message_id': next(message_ids),
+                'date': int(time.time()),
+                'chat': {'id': int(fields.get('chat_id', 0)), 'type': 'private'},
+                'text': fields.get('text', '')
+            }
+            if method == 'sendPhoto':
+                result['photo'] = [{'file_id': f'photo-{result["message_id"]}', 'file_unique_id': 'u', 'width': 800, 'height': 400}]
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def weather_handler(request):
+        await jitter_sleep(config['weather_latency'])
+        if random.random() < config['weather_error_rate']:
+            return web.Response(status=500, text='stub error')
+        return web.json_response(fake_forecast())
+
+    # Маркетплейсы отвечают в форматах своих API; Ozon - самый медленный
+    async def market_handler(request):
+        await jitter_sleep(config['market_latency'])
+        offers = fake_offers(request.query.get('text', ''))
+        return web.json_response({'items': [
+            {'name': name, 'link': 'https://market.yandex.ru/product/1', 'price': {'min': str(price)}} for name, price in offers
+        ]})
+
+    async def ozon_handler(request):
+        await jitter_sleep(config['market_latency'] * 3)
+        offers = fake_offers(request.query.get('text', ''))
+        return web.json_response({'items': [
+            {'title': title, 'price': price, 'url': 'https://www.ozon.ru/product/1'} for title, price in offers
+        ]})
+
+    async def wildberries_handler(request):
+        await jitter_sleep(config['market_latency'])
+        offers = fake_offers(request.query.get('query', ''))
+        return web.json_response({'data': {'products': [
+            {'id': number, 'brand': 'Stub', 'name': name, 'sizes': [{'price': {'product': price * 100}}]}
+            for number, (name, price) in enumerate(offers)
+        ]}})
+
+    # Выдача Авито: две страницы из сохраненной страницы, дальше - пустая выдача
+    with open(os.path.join(FIXTURES_DIR, 'avito_search.html'), encoding='utf-8') as f:
+        avito_page = f.read()
+    empty_page = avito_page[:avito_page.index('<div class="iva-item-root"')] + '</div></body></html>'
+
+    async def avito_handler(request):
+        await jitter_sleep(config['market_latency'])
+        page = avito_page if int(request.query.get('p', 1)) <= 2 else empty_page
+        return web.Response(text=page, content_type='text/html')
+
+    tg_app = web.Application()
+    tg_app.router.add_route('*', '/bot{token}/{method}', telegram_handler)
+    weather_app = web.Application()
+    weather_app.router.add_get('/v2/forecast', weather_handler)
+    weather_app.router.add_get('/market/search', market_handler)
+    weather_app.router.add_get('/ozon/search', ozon_handler)
+    weather_app.router.add_get('/wb/search', wildberries_handler)
+    weather_app.router.add_get('/avito/nedvizhimost', avito_handler)
+
+    runners = []
+    for app, port in ((tg_app, tg_port), (weather_app, weather_port)):
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        runners.append(runner)
+    ready.set()
+
+    # Работаем, пока родительский процесс не завершит нас
+    while True:
+        await asyncio.sleep(3600)
+
+# Синтетические обновления Telegram
+class UpdateFactory:
+    """Создает обновления Telegram от имени синтетических пользователей"""
+
+    def __init__(self, bot_main):
+        self.types = bot_main.types
+        self.bot = bot_main.bot
+        self.bot_main = bot_main
+        self.ids = itertools.count(1)
+
+    def _user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}
+
+    def message(self, user_id, text):
+        data = {
+            'update_id': next(self.ids),
+            'message': {
+                'message_id': next(self.ids), 'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'}, 'from': self._user(user_id), 'text': text
+            }
+        }
+        if text.startswith('/'):
+            data['message']['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return self.types.Update.model_validate(data, context={'bot': self.bot})
+
+    def callback(self, user_id, callback_data):
+        data = {
+            'update_id': next(self.ids),
+            'callback_query': {
+                'id': str(next(self.ids)), 'chat_instance': str(user_id), 'data': callback_data,
+                'from': self._user(user_id),
+                'message': {
+                    'message_id': 1, 'date': int(time.time()),
+                    'chat': {'id': user_id, 'type': 'private'}, 'text': 'menu'
+                }
+            }
+        }
+        return self.types.Update.model_validate(data, context={'bot': self.bot})
+
+    def listings_page(self, user_id, query, page):
+        """Нажатие на листание выдачи: курсор с ключом запроса, как на кнопках бота"""
+        key = self.bot_main.remember_listing_query(query)
+        return self.callback(user_id, self.bot_main.RealEstatePage(page=page, key=key).pack())
+
+def scenario_step(factory, user_id, step):
+    """Очередное действие пользователя: меню -> погода -> товары -> жилье (с листанием) -> меню"""
+    property_query = PROPERTIES[user_id % len(PROPERTIES)]
+    actions = (
+        lambda: factory.message(user_id, '/start'),
+        lambda: factory.callback(user_id, 'weather'),
+        lambda: factory.message(user_id, random.choice(CITIES)),
+        lambda: factory.message(user_id, random.choice(CITIES)),
+        lambda: factory.callback(user_id, 'products'),
+        lambda: factory.message(user_id, random.choice(PRODUCTS)),
+        lambda: factory.callback(user_id, 'real_estate'),
+        lambda: factory.message(user_id, property_query),
+        lambda: factory.listings_page(user_id, property_query, 1),
+        lambda: factory.listings_page(user_id, property_query, 2),
+        lambda: factory.listings_page(user_id, property_query, 1),
+        lambda: factory.callback(user_id, 'back_to_menu'),
+    )
+    return actions[step % len(actions)]()
+
+def percentile(sorted_values, fraction):
+    """Перцентиль по отсортированному списку"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+async def run_load(bot_main, args):
+    """Подает обновления в dp с заданной частотой и собирает задержки"""
+    loop = asyncio.get_running_loop()
+    factory = UpdateFactory(bot_main)
+    latencies = []
+    errors = 0
+    skipped = 0
+
+    # Свободные пользователи в порядке готовности: (момент готовности, id, номер шага)
+    idle = deque((0.0, 10 ** 6 + user, 0) for user in range(args.users))
+    in_flight = set()
+
+    async def process(user_id, step):
+        nonlocal errors
+        update = scenario_step(factory, user_id, step)
+        started = time.perf_counter()
+        try:
+            await bot_main.dp.feed_update(bot_main.bot, update)
+        except Exception:
+            errors += 1
+        latencies.append(time.perf_counter() - started)
+        idle.append((loop.time() + args.think_time, user_id, step + 1))
+
+    lag_task = asyncio.create_task(bot_main.monitor_event_loop_lag(0.1))
+    started = loop.time()
+    interval = 1.0 / args.rate
+    sent = 0
+    while True:
+        target = started + sent * interval
+        if target - started >= args.duration:
+            break
+        delay = target - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        sent += 1
+        if not idle or idle[0][0] > loop.time():
+            skipped += 1  # Все пользователи заняты или думают
+            continue
+        _, user_id, step = idle.popleft()
+        task = asyncio.create_task(process(user_id, step))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+
+    if in_flight:
+        await asyncio.wait(in_flight, timeout=args.drain_timeout)
+    elapsed = loop.time() - started
+    lag_task.cancel()
+
+    latencies.sort()
+    return {
+        'target_rate': args.rate,
+        'duration_s': round(elapsed, 2),
+        'offered': sent,
+        'skipped_no_idle_user': skipped,
+        'completed': len(latencies),
+        'unfinished': len(in_flight),
+        'errors': errors,
+        'throughput_per_s': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'latency_ms': {
+            'p50': round(percentile(latencies, 0.50) * 1000, 1),
+            'p95': round(percentile(latencies, 0.95) * 1000, 1),
+            'p99': round(percentile(latencies, 0.99) * 1000, 1),
+            'max': round(latencies[-1] * 1000, 1) if latencies else 0.0
+        },
+        'event_loop_lag_max_ms': round(bot_main.event_loop_lag['max'] * 1000, 1),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'weather_cache': bot_main.weather_cache.stats(),
+        'telegram_send': bot_main.send_scheduler.stats()
+    }
+
+def print_report(report):
+    """Печатает отчет в читаемом виде"""
+    latency = report['latency_ms']
+    cache = report['weather_cache']
+    sender = report['telegram_send']
+    print()
+    print("📊 Результаты нагрузочного теста")
+    print(f"  Целевая частота:       {report['target_rate']} обн/с за {report['duration_s']} с")
+    print(f"  Подано / обработано:   {report['offered']} / {report['completed']} "
+          f"(пропущено без свободных пользователей: {report['skipped_no_idle_user']})")
+    print(f"  Пропускная способность: {report['throughput_per_s']} обн/с")
+    print(f"  Задержка, мс:          p50={latency['p50']} p95={latency['p95']} p99={latency['p99']} max={latency['max']}")
+    print(f"  Ошибки / не завершено: {report['errors']} / {report['unfinished']}")
+    print(f"  Задержка цикла событий (макс): {report['event_loop_lag_max_ms']} мс")
+    print(f"  Пиковый RSS:           {report['peak_rss_mb']} МБ")
+    print(f"  Кэш погоды:            {cache['hits']} попаданий, {cache['misses']} промахов "
+          f"(доля {cache['hit_ratio']:.2f})")
+    print(f"  Telegram:              отправлено {sender['sent']}, повторов {sender['retried']}, "
+          f"ошибок {sender['failed']}")
+
+async def bench(args):
+    """Импортирует бота, настроенного на заглушки, и запускает нагрузку"""
+    sys.path.insert(0, ROOT_DIR)
+    import main as bot_main
+
+    await bot_main.start_weather_client()
+    await bot_main.start_chart_pool()
+    try:
+        return await run_load(bot_main, args)
+    finally:
+        await bot_main.close_weather_client()
+        await bot_main.close_market_client()
+        bot_main.close_chart_pool()
+        await bot_main.bot.session.close()
+
+def main():
+    """Поднимает заглушки, настраивает окружение бота и печатает отчет"""
+    args = parse_args()
+    random.seed(args.seed)
+
+    tg_port, weather_port = free_port(), free_port()
+    config = {
+        'tg_latency': args.tg_latency,
+        'tg_error_rate': args.tg_error_rate,
+        'weather_latency': args.weather_latency,
+        'weather_error_rate': args.weather_error_rate,
+        'market_latency': args.market_latency
+    }
+    context = multiprocessing.get_context('spawn')
+    ready = context.Event()
+    stubs = context.Process(target=run_stub_servers, args=(tg_port, weather_port, config, ready), daemon=True)
+    stubs.start()
+    if not ready.wait(15):
+        stubs.terminate()
+        sys.exit("Заглушки не запустились")
+
+    # Бот работает только с локальными заглушками
+    os.environ.update({
+        'BOT_TOKEN': '123456789:BENCHMARKBENCHMARKBENCHMARKBENCHMAR',
+        'WEATHER_API_KEY': 'bench',
+        'TELEGRAM_API_URL': f'http://127.0.0.1:{tg_port}',
+        'WEATHER_API_URL': f'http://127.0.0.1:{weather_port}/v2/forecast',
+        'YANDEX_MARKET_API_URL': f'http://127.0.0.1:{weather_port}/market/search',
+        'OZON_API_URL': f'http://127.0.0.1:{weather_port}/ozon/search',
+        'WILDBERRIES_API_URL': f'http://127.0.0.1:{weather_port}/wb/search',
+        'REAL_ESTATE_URL': f'http://127.0.0.1:{weather_port}/avito/nedvizhimost',
+        'LOG_DIR': os.environ.get('LOG_DIR') or tempfile.mkdtemp(prefix='bot-bench-'),
+        'STATE_BACKEND': os.environ.get('STATE_BACKEND', 'memory'),
+        'SEND_GLOBAL_RATE': str(args.send_rate),
+        'SEND_CHAT_RATE': str(args.chat_rate),
+        'SEND_CHAT_BURST': str(max(3, int(args.chat_rate)))
+    })
+
+    # Информационные логи бота не нужны в отчете и сами замедляют прогон
+    if os.environ.get('BENCH_VERBOSE') != '1':
+        logging.disable(logging.INFO)
+
+    try:
+        report = asyncio.run(bench(args))
+    finally:
+        stubs.terminate()
+        stubs.join(5)
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+if __name__ == "__main__":
+    main()
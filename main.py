@@ -1,19 +1,81 @@
+import time
+
+# Момент запуска процесса: от него считается разбивка времени старта
+BOOT_STARTED = time.perf_counter()
+
 import logging
+import logging.handlers
+import queue
+import json
+import random
+import atexit
 import os
 import asyncio
 import signal
 import sys
-import requests  # ИЗМЕНЕНИЕ ЗДЕСЬ
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import CommandStart, Command
+import sqlite3
+import struct
+import zlib
+import threading
+import bisect
+import hmac
+import hashlib
+import secrets
+import math
+import heapq
+import itertools
+import contextvars
+import re
+import functools
+import traceback
+from abc import ABC, abstractmethod
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+import aiohttp
+from aiohttp import web, FormData
+from aiogram import Bot, Dispatcher, BaseMiddleware, types, F
+from aiogram.filters import CommandStart, Command, CommandObject
+from aiogram.filters.callback_data import CallbackData
 from aiogram.enums import ContentType
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, BufferedInputFile
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from aiogram.methods import AnswerCallbackQuery
 from dotenv import load_dotenv
+from urllib.parse import quote, urljoin
+from html.parser import HTMLParser
+import codecs
 from enum import Enum
+from collections import OrderedDict, namedtuple, deque
+from array import array
 
 # Загружаем переменные окружения из .env файла (для локальной разработки)
 load_dotenv()
 
+# Разбивка времени запуска по этапам
+class StartupTimer:
+    """Запоминает длительность этапов запуска от BOOT_STARTED"""
+    
+    def __init__(self, started):
+        self.started = started
+        self._last = started
+        self.phases = []  # [(этап, секунд), ...]
+    
+    def mark(self, phase):
+        """Завершает этап: его длительность - время с предыдущей отметки"""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+    
+    def report(self):
+        details = ", ".join(f"{phase} {seconds:.2f} с" for phase, seconds in self.phases)
+        return f"{self._last - self.started:.2f} с ({details})"
+
+startup_timer = StartupTimer(BOOT_STARTED)
+startup_timer.mark('импорт модулей')
+
 # Токен бота и API ключ погоды из переменных окружения
 BOT_TOKEN = os.getenv('BOT_TOKEN') or "YOUR_BOT_TOKEN_HERE"
 WEATHER_API_KEY = os.getenv('WEATHER_API_KEY')
@@ -21,17 +83,286 @@ WEATHER_API_KEY = os.getenv('WEATHER_API_KEY')
 # Порт для Cloud Amvera
 PORT = int(os.getenv('PORT', 8080))
 
+# Директория для логов и файлов данных бота
+LOG_DIR = os.getenv('LOG_DIR', '/app/logs')  # ИЗМЕНЕНИЕ: /app для контейнера
+
+# Настройки логирования
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FILE = os.getenv('LOG_FILE', 'bot.jsonl')                                 # Файл в LOG_DIR (пусто - только stdout)
+LOG_FILE_MAX_BYTES = int(os.getenv('LOG_FILE_MAX_BYTES', 10 * 1024 * 1024))
+LOG_FILE_BACKUPS = int(os.getenv('LOG_FILE_BACKUPS', 5))
+LOG_MAX_MESSAGE = int(os.getenv('LOG_MAX_MESSAGE', 2000))                     # Длиннее - обрезается
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))                      # При переполнении записи отбрасываются
+LOG_SAMPLING = os.getenv('LOG_SAMPLING', '')                                  # Например: INFO=0.1,DEBUG=0
+
+# Адрес Bot API (локальный сервер Bot API или заглушка для нагрузочного теста)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', '')
+
+# Способ получения обновлений: polling (по умолчанию) или webhook
+DELIVERY_MODE = os.getenv('DELIVERY_MODE', 'polling').lower()
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').rstrip('/')  # Публичный адрес бота, например https://bot.amvera.io
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')  # Пусто - генерируется при запуске (только для одного экземпляра бота)
+# Сколько обновлений может обрабатываться одновременно
+UPDATES_CONCURRENCY = int(os.getenv('UPDATES_CONCURRENCY', 100))
+# Обновления, накопившиеся пока бот был остановлен: drain - обработать последнее действие каждого чата, drop - отбросить
+PENDING_UPDATES = os.getenv('PENDING_UPDATES', 'drain').lower()
+PENDING_MAX_AGE = float(os.getenv('PENDING_MAX_AGE', 3600))   # Сообщения старше (в секундах) считаются неактуальными
+
+# Многопроцессный режим: прием обновлений в главном процессе, обработка в WORKERS процессах по chat id
+WORKERS = int(os.getenv('WORKERS', 1)) or os.cpu_count() or 1   # 0 - по числу ядер, 1 - один процесс
+WORKER_QUEUE_SIZE = int(os.getenv('WORKER_QUEUE_SIZE', 1000))     # Обновлений в очереди одного обработчика
+WORKER_HEARTBEAT_TIMEOUT = float(os.getenv('WORKER_HEARTBEAT_TIMEOUT', 30))  # Без отклика дольше - перезапуск
+WORKER_START_TIMEOUT = float(os.getenv('WORKER_START_TIMEOUT', 120))          # Столько ждем готовности после запуска
+WORKER_STOP_TIMEOUT = float(os.getenv('WORKER_STOP_TIMEOUT', 10))
+WORKER_ID = os.getenv('BOT_WORKER_ID', '')                        # Задается главным процессом для обработчиков
+# Имя вспомогательного процесса: у обработчика свой файл логов, процессы отрисовки пишут через главный
+PROCESS_NAME = os.getenv('BOT_PROCESS_NAME') or (f"worker{WORKER_ID}" if WORKER_ID else '')
+
+# Настройки HTTP-клиента API погоды
+WEATHER_API_URL = os.getenv('WEATHER_API_URL', 'https://api.weather.yandex.ru/v2/forecast')
+WEATHER_TIMEOUT = float(os.getenv('WEATHER_TIMEOUT', 10))
+WEATHER_MAX_CONNECTIONS = int(os.getenv('WEATHER_MAX_CONNECTIONS', 20))
+# Таймаут попытки подстраивается под наблюдаемые задержки, WEATHER_TIMEOUT - верхняя граница
+WEATHER_TIMEOUT_MIN = float(os.getenv('WEATHER_TIMEOUT_MIN', 2))
+WEATHER_HEDGE_QUANTILE = float(os.getenv('WEATHER_HEDGE_QUANTILE', 0.95))   # Повторный запрос, если первый дольше этого перцентиля
+WEATHER_HEDGE_RATIO = float(os.getenv('WEATHER_HEDGE_RATIO', 0.1))         # Повторных запросов не больше этой доли от всех
+WEATHER_BREAKER_FAILURES = int(os.getenv('WEATHER_BREAKER_FAILURES', 5))    # Ошибок подряд до размыкания
+WEATHER_BREAKER_COOLDOWN = float(os.getenv('WEATHER_BREAKER_COOLDOWN', 30)) # Секунд без запросов после размыкания
+WEATHER_COMPARE_MAX = int(os.getenv('WEATHER_COMPARE_MAX', 10))                 # Городов в одном сравнении
+WEATHER_COMPARE_CONCURRENCY = int(os.getenv('WEATHER_COMPARE_CONCURRENCY', 10)) # Одновременных запросов прогноза на сравнение
+
+# Поиск товаров на маркетплейсах
+MARKETPLACES = [name.strip() for name in os.getenv('MARKETPLACES', 'yandex_market,ozon,wildberries').split(',') if name.strip()]
+MARKETPLACE_TIMEOUTS = os.getenv('MARKETPLACE_TIMEOUTS', '')                  # Свой срок ответа источника, например ozon=3,wildberries=2
+MARKETPLACE_RESULTS = int(os.getenv('MARKETPLACE_RESULTS', 8))               # Сколько самых дешевых предложений показывать
+YANDEX_MARKET_API_URL = os.getenv('YANDEX_MARKET_API_URL', 'https://api.content.market.yandex.ru/v3/affiliate/search')
+YANDEX_MARKET_API_KEY = os.getenv('YANDEX_MARKET_API_KEY', '')               # Ключ партнерского API Маркета
+OZON_API_URL = os.getenv('OZON_API_URL', '')                                 # У Ozon нет публичного поиска - адрес своего прокси
+WILDBERRIES_API_URL = os.getenv('WILDBERRIES_API_URL', 'https://search.wb.ru/exactmatch/ru/common/v5/search')
+
+# Объявления о жилье (страница поиска Авито)
+REAL_ESTATE_URL = os.getenv('REAL_ESTATE_URL', 'https://www.avito.ru/rossiya/nedvizhimost')
+REAL_ESTATE_TIMEOUT = float(os.getenv('REAL_ESTATE_TIMEOUT', 10))
+REAL_ESTATE_PAGE_SIZE = int(os.getenv('REAL_ESTATE_PAGE_SIZE', 5))           # Объявлений на странице в Telegram
+REAL_ESTATE_MAX_PAGES = int(os.getenv('REAL_ESTATE_MAX_PAGES', 5))           # Страниц выдачи Авито на один запрос
+REAL_ESTATE_CACHE_TTL = float(os.getenv('REAL_ESTATE_CACHE_TTL', 900))
+REAL_ESTATE_CACHE_SIZE = int(os.getenv('REAL_ESTATE_CACHE_SIZE', 256))       # Страниц выдачи в кэше
+REAL_ESTATE_QUERY_TTL = float(os.getenv('REAL_ESTATE_QUERY_TTL', 86400))     # Сколько листаются старые выдачи
+REAL_ESTATE_QUERY_CACHE_SIZE = int(os.getenv('REAL_ESTATE_QUERY_CACHE_SIZE', 10000))
+
+# Графики температуры к прогнозу погоды
+WEATHER_CHARTS = os.getenv('WEATHER_CHARTS', '1') == '1'
+CHART_WORKERS = int(os.getenv('CHART_WORKERS', 1))                   # Процессов отрисовки
+CHART_CACHE_SIZE = int(os.getenv('CHART_CACHE_SIZE', 256))
+
+# Настройки кэша прогнозов погоды
+WEATHER_CACHE_TTL = float(os.getenv('WEATHER_CACHE_TTL', 600))
+WEATHER_CACHE_SIZE = int(os.getenv('WEATHER_CACHE_SIZE', 1024))
+WEATHER_GRID = float(os.getenv('WEATHER_GRID', 0.1))   # Шаг сетки в градусах: соседние точки получают один прогноз (0 - без сетки)
+
+# Упреждающее обновление прогнозов для популярных городов
+WEATHER_REFRESH_AHEAD = float(os.getenv('WEATHER_REFRESH_AHEAD', 60))   # За сколько секунд до устаревания обновлять
+WEATHER_REFRESH_BUDGET = int(os.getenv('WEATHER_REFRESH_BUDGET', 30))   # Не больше запросов к API в минуту
+WEATHER_REFRESH_TOP = int(os.getenv('WEATHER_REFRESH_TOP', 20))         # Сколько самых популярных координат держать теплыми
+WEATHER_REFRESH_INTERVAL = float(os.getenv('WEATHER_REFRESH_INTERVAL', 10))
+
+# Ограничения Telegram на исходящие сообщения
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', 30))      # Сообщений в секунду на весь бот
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', 1))           # Сообщений в секунду в личный чат
+SEND_GROUP_RATE = float(os.getenv('SEND_GROUP_RATE', 20 / 60))   # Сообщений в секунду в группу
+SEND_CHAT_BURST = int(os.getenv('SEND_CHAT_BURST', 3))           # Сколько сообщений подряд можно отправить в чат
+SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', 5))         # Повторов после ответа 429
+
+# Ограничение входящих сообщений от одного пользователя
+INBOUND_USER_RATE = float(os.getenv('INBOUND_USER_RATE', 1))       # Сообщений и нажатий в секунду (0 - без ограничения)
+INBOUND_USER_BURST = int(os.getenv('INBOUND_USER_BURST', 5))       # Сколько можно отправить подряд
+INBOUND_MAX_USERS = int(os.getenv('INBOUND_MAX_USERS', 100000))    # Пользователей в учете, давно неактивные забываются
+DUPLICATE_WINDOW = float(os.getenv('DUPLICATE_WINDOW', 3))         # Повтор того же текста в чате за это время не обрабатывается
+
+# Ежедневные подписки на прогноз погоды
+SUBSCRIPTIONS_DB_PATH = os.getenv('SUBSCRIPTIONS_DB_PATH', os.path.join(LOG_DIR, 'subscriptions.db'))
+SUBSCRIPTIONS_UTC_OFFSET = int(os.getenv('SUBSCRIPTIONS_UTC_OFFSET', 3))   # Часовой пояс времени рассылки (по умолчанию МСК)
+SUBSCRIPTIONS_TZ_LABEL = 'МСК' if SUBSCRIPTIONS_UTC_OFFSET == 3 else f'UTC{SUBSCRIPTIONS_UTC_OFFSET:+d}'
+SUBSCRIPTIONS_PER_CHAT = int(os.getenv('SUBSCRIPTIONS_PER_CHAT', 5))
+SUBSCRIPTIONS_SEND_BATCH = int(os.getenv('SUBSCRIPTIONS_SEND_BATCH', 500))   # Сколько сообщений рассылки ставить в очередь за раз
+
+# Справочник населенных пунктов (TSV: название, широта, долгота, синонимы)
+LOCATION_MAX_DISTANCE = float(os.getenv('LOCATION_MAX_DISTANCE', 100))  # Дальше (км) от геопозиции пункт не подписываем
+GAZETTEER_PATH = os.getenv('GAZETTEER_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'cities.tsv'))
+
+# Обнаружение блокировок цикла событий и профилирование
+LOOP_WATCHDOG = os.getenv('LOOP_WATCHDOG', '1') == '1'
+LOOP_BLOCK_THRESHOLD_MS = float(os.getenv('LOOP_BLOCK_THRESHOLD_MS', 250))
+PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', 10))
+PROFILE_MAX_SECONDS = float(os.getenv('PROFILE_MAX_SECONDS', 300))
+ADMIN_IDS = {int(user_id) for user_id in os.getenv('ADMIN_IDS', '').replace(' ', '').split(',') if user_id}
+
+# Хранилище состояний чатов: memory (один процесс) или sqlite (общее для нескольких процессов)
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'memory').lower()
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', os.path.join(LOG_DIR, 'state.db'))
+STATE_TTL = float(os.getenv('STATE_TTL', 86400))
+
+# Снимок кэшей и режимов чатов при остановке для теплого перезапуска (пусто - не сохранять)
+SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH', os.path.join(LOG_DIR, 'snapshot.bin'))
+
 # Создание директории для логов
-os.makedirs('/app/logs', exist_ok=True)  # ИЗМЕНЕНИЕ: /app для контейнера
-
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-    ]
-)
+os.makedirs(LOG_DIR, exist_ok=True)
+
+# Настройка логирования: обработчики только ставят записи в очередь, пишет фоновый поток
+class SamplingFilter(logging.Filter):
+    """Пропускает заданную долю записей каждого уровня (остальные уровни - все)"""
+    
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+    
+    def filter(self, record):
+        rate = self.rates.get(record.levelno)
+        return rate is None or random.random() < rate
+
+def parse_log_sampling(value):
+    """Разбирает строку вида INFO=0.1,DEBUG=0 в {уровень: доля}"""
+    rates = {}
+    for item in value.split(','):
+        if '=' in item:
+            level, rate = item.split('=', 1)
+            rates[logging.getLevelName(level.strip().upper())] = float(rate)
+    return rates
+
+class AsyncLogHandler(logging.handlers.QueueHandler):
+    """Кладет готовую запись в очередь: форматирование и обрезка длинного сообщения - без ввода-вывода"""
+    
+    def __init__(self, log_queue, max_message):
+        super().__init__(log_queue)
+        self.max_message = max_message
+        self.dropped = 0
+    
+    def prepare(self, record):
+        message = record.getMessage()
+        if len(message) > self.max_message:
+            record.msg = f"{message[:self.max_message]}... [обрезано {len(message) - self.max_message} символов]"
+            record.args = None
+        return super().prepare(record)
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class BatchLogWriter:
+    """Фоновый поток: забирает записи пачками и пишет их в JSON-lines файл с ротацией и в stdout"""
+    
+    BATCH_SIZE = 500
+    
+    def __init__(self, log_queue, path, max_bytes, backups):
+        self.queue = log_queue
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.text_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        self._file = None
+        self._size = 0
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+    
+    def _open(self, mode='a'):
+        try:
+            self._file = open(self.path, mode, encoding='utf-8')
+            self._size = self._file.tell()
+        except OSError as e:
+            self._file = None
+            sys.stderr.write(f"Не удалось открыть файл логов {self.path}: {e}\n")
+    
+    def _rotate(self):
+        """Сдвигает bot.jsonl -> bot.jsonl.1 -> ... и открывает новый файл (без копий - очищает текущий)"""
+        self._file.close()
+        if self.backups <= 0:
+            self._open('w')
+            return
+        for index in range(self.backups - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        os.replace(self.path, f"{self.path}.1")
+        self._open()
+    
+    @staticmethod
+    def to_json(record):
+        """Запись лога в виде строки JSON"""
+        return json.dumps({
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.msg,
+            'process': record.process
+        }, ensure_ascii=False)
+    
+    def _write_batch(self, records):
+        sys.stdout.write("".join(self.text_formatter.format(record) + "\n" for record in records))
+        sys.stdout.flush()
+        if self._file is not None:
+            data = "".join(self.to_json(record) + "\n" for record in records)
+            if self._size and self._size + len(data) > self.max_bytes:
+                self._rotate()
+            if self._file is not None:
+                self._file.write(data)
+                self._file.flush()
+                self._size += len(data)
+    
+    def _run(self):
+        stopping = False
+        while not stopping:
+            records = [self.queue.get()]
+            while len(records) < self.BATCH_SIZE:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if records[-1] is None:
+                stopping = True
+            records = [record for record in records if record is not None]
+            try:
+                self._write_batch(records)
+            except Exception as e:
+                sys.stderr.write(f"Ошибка записи логов: {e}\n")
+        if self._file is not None:
+            self._file.close()
+    
+    def start(self):
+        if self.path:
+            self._open()
+        self._thread.start()
+    
+    def stop(self):
+        """Дописывает очередь и останавливает поток"""
+        if self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join(5)
+
+def setup_logging():
+    """Настраивает асинхронное логирование и возвращает фоновый писатель"""
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    handler = AsyncLogHandler(log_queue, LOG_MAX_MESSAGE)
+    rates = parse_log_sampling(LOG_SAMPLING)
+    if rates:
+        handler.addFilter(SamplingFilter(rates))
+    
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(LOG_LEVEL)
+    
+    path = os.path.join(LOG_DIR, LOG_FILE) if LOG_FILE else ''
+    if PROCESS_NAME == 'charts':
+        path = ''  # Процессов отрисовки несколько: их записи пишет в файл главный процесс (forward_logs_to_parent)
+    elif path and PROCESS_NAME:
+        path = f"{path}.{PROCESS_NAME}"  # У каждого обработчика свой файл и своя ротация
+    writer = BatchLogWriter(log_queue, path, LOG_FILE_MAX_BYTES, LOG_FILE_BACKUPS)
+    writer.start()
+    atexit.register(writer.stop)
+    return handler, writer
+
+log_handler, log_writer = setup_logging()
 logger = logging.getLogger(__name__)
 
 # Проверка токена
@@ -51,130 +382,1591 @@ class BotMode(Enum):
     PRODUCTS = "products"   # Режим ввода товара
     REAL_ESTATE = "real_estate"  # Режим поиска жилья
 
+# Кэш с ограниченным временем жизни и вытеснением давно неиспользуемых записей
+class TTLCache:
+    """Ограниченный по размеру in-memory кэш с TTL и LRU-вытеснением"""
+    
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # ключ -> (момент истечения, значение)
+    
+    def get(self, key):
+        """Возвращает значение из кэша или None, если его нет или оно устарело"""
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        expires, value = item
+        if expires <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+    
+    def set(self, key, value, ttl=None):
+        """Кладет значение в кэш, вытесняя самые старые записи при переполнении"""
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+    
+    def pop(self, key):
+        """Удаляет запись, если она есть"""
+        self._data.pop(key, None)
+    
+    def expires_in(self, key):
+        """Сколько секунд осталось жить записи (None, если ее нет); счетчики не меняет"""
+        item = self._data.get(key)
+        if item is None:
+            return None
+        return item[0] - time.monotonic()
+    
+    def clear(self):
+        """Очищает кэш и счетчики"""
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+    
+    def snapshot(self):
+        """Возвращает живые записи [(ключ, срок по системным часам, значение), ...] от давних к свежим"""
+        now = time.monotonic()
+        offset = time.time() - now
+        return [(key, expires + offset, value) for key, (expires, value) in self._data.items() if expires > now]
+    
+    def restore(self, entries):
+        """Загружает записи из snapshot(), пропуская истекшие; возвращает число загруженных"""
+        now = time.time()
+        restored = 0
+        for key, expires, value in entries:
+            if expires > now:
+                self.set(key, value, ttl=expires - now)
+                restored += 1
+        return restored
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def stats(self):
+        """Возвращает счетчики попаданий и промахов"""
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / total if total else 0.0
+        }
+
+# Компактное представление режимов для хранилищ состояний
+MODE_CODES = {mode: index for index, mode in enumerate(BotMode)}
+MODES_BY_CODE = tuple(BotMode)
+
+# Хранилище режимов чатов в памяти процесса
+class MemoryStateStore:
+    """Хранит режим каждого чата в памяти; чаты в главном меню не хранятся вовсе"""
+    
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._data = OrderedDict()  # chat_id -> (момент истечения, код режима)
+    
+    async def get_mode(self, chat_id):
+        """Возвращает текущий режим чата"""
+        item = self._data.get(chat_id)
+        if item is None:
+            return BotMode.IDLE
+        if item[0] <= time.time():
+            del self._data[chat_id]
+            return BotMode.IDLE
+        return MODES_BY_CODE[item[1]]
+    
+    async def set_mode(self, chat_id, mode):
+        """Сохраняет режим чата и удаляет устаревшие сессии"""
+        now = time.time()
+        self._data.pop(chat_id, None)
+        if mode != BotMode.IDLE:
+            self._data[chat_id] = (now + self.ttl, MODE_CODES[mode])
+        self._purge(now)
+    
+    def _purge(self, now):
+        """Удаляет сессии с истекшим TTL (записи упорядочены по времени изменения)"""
+        while self._data:
+            chat_id, item = next(iter(self._data.items()))
+            if item[0] > now:
+                break
+            del self._data[chat_id]
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def snapshot(self):
+        """Возвращает живые сессии [(chat_id, момент истечения, режим), ...]"""
+        now = time.time()
+        return [(chat_id, expires, MODES_BY_CODE[code].value) for chat_id, (expires, code) in self._data.items() if expires > now]
+    
+    def restore(self, entries):
+        """Загружает сессии из snapshot(), пропуская истекшие и неизвестные режимы"""
+        now = time.time()
+        known = {mode.value: MODE_CODES[mode] for mode in BotMode}
+        restored = 0
+        for chat_id, expires, mode in entries:
+            if expires > now and mode in known:
+                self._data[chat_id] = (expires, known[mode])
+                restored += 1
+        return restored
+    
+    async def close(self):
+        """Закрывает хранилище"""
+        self._data.clear()
+
+# Хранилище режимов чатов в SQLite, общее для нескольких процессов бота
+class SQLiteStateStore:
+    """Хранит режимы чатов в файле SQLite (WAL), доступном всем процессам бота"""
+    
+    PURGE_EVERY = 1000  # Как часто (в записях) удалять устаревшие сессии
+    
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self._conn = None
+        self._lock = threading.Lock()
+        self._writes = 0
+    
+    def _connection(self):
+        """Открывает соединение с базой при первом обращении"""
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS chat_state ("
+                "chat_id INTEGER PRIMARY KEY, mode INTEGER NOT NULL, expires REAL NOT NULL)"
+            )
+            self._conn = conn
+        return self._conn
+    
+    def _get(self, chat_id):
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT mode FROM chat_state WHERE chat_id = ? AND expires > ?",
+                (chat_id, time.time())
+            ).fetchone()
+        return MODES_BY_CODE[row[0]] if row else BotMode.IDLE
+    
+    def _set(self, chat_id, mode):
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            if mode == BotMode.IDLE:
+                conn.execute("DELETE FROM chat_state WHERE chat_id = ?", (chat_id,))
+            else:
+                conn.execute(
+                    "INSERT OR REPLACE INTO chat_state (chat_id, mode, expires) VALUES (?, ?, ?)",
+                    (chat_id, MODE_CODES[mode], now + self.ttl)
+                )
+            self._writes += 1
+            if self._writes % self.PURGE_EVERY == 0:
+                conn.execute("DELETE FROM chat_state WHERE expires <= ?", (now,))
+    
+    async def get_mode(self, chat_id):
+        """Возвращает текущий режим чата"""
+        return await asyncio.to_thread(self._get, chat_id)
+    
+    async def set_mode(self, chat_id, mode):
+        """Сохраняет режим чата"""
+        await asyncio.to_thread(self._set, chat_id, mode)
+    
+    async def close(self):
+        """Закрывает соединение с базой"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+# Создание хранилища состояний по настройкам окружения
+def create_state_store():
+    """Создает хранилище состояний, выбранное в STATE_BACKEND"""
+    if STATE_BACKEND == 'sqlite':
+        logger.info(f"Состояния чатов хранятся в SQLite: {STATE_DB_PATH}")
+        return SQLiteStateStore(STATE_DB_PATH, STATE_TTL)
+    if STATE_BACKEND != 'memory':
+        logger.warning(f"Неизвестное хранилище состояний '{STATE_BACKEND}', используется memory")
+    return MemoryStateStore(STATE_TTL)
+
 # Глобальная переменная для корректного завершения
 running = True
 
-# Глобальная переменная для отслеживания текущего режима
-current_mode = BotMode.IDLE
+# Бот принимает обновления (для /readyz)
+ready = False
+
+# Режимы чатов (у каждого чата свой режим)
+state_store = create_state_store()
+
+# HTTP-сервер на PORT (создается при запуске)
+web_runner = None
+
+# Фоновые задачи (запускаются в main, отменяются в shutdown)
+background_tasks = []
+
+# Общая HTTP-сессия для API погоды (создается при запуске, закрывается в shutdown)
+weather_session = None
+
+# HTTP-сессия для API маркетплейсов (создается при первом поиске)
+market_session = None
+
+# Кэш прогнозов погоды по координатам
+weather_cache = TTLCache(WEATHER_CACHE_SIZE, WEATHER_CACHE_TTL)
+
+# Запросы к API погоды, которые выполняются прямо сейчас (ключ кэша -> задача)
+weather_inflight = {}
+
+# Статические inline клавиатуры (создаются один раз при импорте, объекты неизменяемые)
+BACK_TO_MENU_BUTTON = InlineKeyboardButton(text="🔙 Назад в меню", callback_data="back_to_menu")
+
+MAIN_KEYBOARD = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [
+            InlineKeyboardButton(text="🌤️ Посмотреть прогноз погоды", callback_data="weather")
+        ],
+        [
+            InlineKeyboardButton(text="🛒 Поискать товары", callback_data="products")
+        ],
+        [
+            InlineKeyboardButton(text="🏠 Поискать жильё", callback_data="real_estate")
+        ]
+    ]
+)
+
+BACK_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[[BACK_TO_MENU_BUTTON]])
+
+# Сессия, которая не сериализует статические клавиатуры заново при каждой отправке
+class PreparedMarkupSession(AiohttpSession):
+    """Сессия aiogram, отправляющая статические клавиатуры в заранее сериализованном виде"""
+    
+    STATIC_MARKUPS = (MAIN_KEYBOARD, BACK_KEYBOARD)
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._prepared = {}  # id клавиатуры -> готовая JSON-строка
+    
+    def build_form_data(self, bot, method):
+        # Клавиатуру подменяем до model_dump: после него она уже обычный dict и узнать ее нельзя
+        markup = getattr(method, 'reply_markup', None)
+        if not any(markup is static for static in self.STATIC_MARKUPS):
+            return super().build_form_data(bot, method)
+        prepared = self._prepared.get(id(markup))
+        if prepared is None:
+            prepared = self._prepared[id(markup)] = self.prepare_value(markup, bot=bot, files={})
+        
+        form = FormData(quote_fields=False)
+        files = {}
+        for key, value in method.model_dump(warnings=False, exclude={'reply_markup'}).items():
+            value = self.prepare_value(value, bot=bot, files=files)
+            if value:
+                form.add_field(key, value)
+        form.add_field('reply_markup', prepared)
+        for key, value in files.items():
+            form.add_field(key, value.read(bot), filename=value.filename or key)
+        return form
+
+# Ведро токенов для ограничения частоты отправки
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity про запас"""
+    
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def delay(self):
+        """Сколько секунд ждать до появления токена"""
+        self._refill(time.monotonic())
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+    
+    def reserve(self):
+        """Забирает токен (возможно, в долг) и возвращает, сколько ждать до его появления"""
+        self._refill(time.monotonic())
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+    
+    def pause(self, seconds):
+        """Запрещает отправку на seconds секунд (после ответа 429)"""
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+    
+    def is_idle(self):
+        """Ведро полное - его можно забыть без потери информации"""
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+    
+    def take(self):
+        """Забирает токен, если он есть, без ухода в долг"""
+        self._refill(time.monotonic())
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+# Полосы приоритета исходящих запросов (меньше - раньше)
+PRIORITY_CALLBACK = 0   # Ответы на нажатия кнопок
+PRIORITY_REPLY = 1      # Ответы пользователям
+PRIORITY_BULK = 2       # Массовые рассылки
+PRIORITY_NAMES = ('callback', 'reply', 'bulk')
+
+# Приоритет исходящих запросов в текущем контексте (рассылки понижают его)
+outgoing_priority = contextvars.ContextVar('outgoing_priority', default=PRIORITY_REPLY)
+
+# Планировщик исходящих запросов с учетом лимитов Telegram
+class SendScheduler(BaseRequestMiddleware):
+    """Промежуточный слой сессии бота: общий и початовые лимиты, приоритеты, повтор после 429"""
+    
+    MAX_CHAT_BUCKETS = 100000  # После этого простаивающие ведра чатов удаляются
+    
+    def __init__(self, global_rate, chat_rate, group_rate, chat_burst, max_retries):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._waiters = []  # Куча (приоритет, порядковый номер, future)
+        self._seq = itertools.count()
+        self._pump_task = None
+        self.queue_depth = [0] * len(PRIORITY_NAMES)
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+    
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.MAX_CHAT_BUCKETS:
+                self._chats = {key: value for key, value in self._chats.items() if not value.is_idle()}
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = TokenBucket(self.group_rate if is_group else self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+    
+    async def _acquire_global(self, priority):
+        """Ждет общего токена; при очереди токены выдаются по приоритету"""
+        if not self._waiters and self._global.delay() == 0:
+            self._global.reserve()
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self.queue_depth[priority] += 1
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        try:
+            await future
+        finally:
+            self.queue_depth[priority] -= 1
+    
+    async def _pump(self):
+        """Выдает общие токены ожидающим в порядке приоритета"""
+        while self._waiters:
+            wait = self._global.delay()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self._global.reserve()
+                future.set_result(None)
+    
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        if isinstance(method, AnswerCallbackQuery):
+            priority = PRIORITY_CALLBACK
+        elif chat_id is not None:
+            priority = outgoing_priority.get()
+        else:
+            # Служебные запросы (getUpdates, setWebhook и т.п.) не ограничиваем
+            return await make_request(bot, method)
+        
+        for attempt in range(self.max_retries + 1):
+            if chat_id is not None:
+                wait = self._chat_bucket(chat_id).reserve()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            await self._acquire_global(priority)
+            try:
+                response = await make_request(bot, method)
+                self.sent += 1
+                return response
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    self.failed += 1
+                    raise
+                self.retried += 1
+                logger.warning(f"Лимит Telegram для {type(method).__name__} в чате {chat_id}, повтор через {e.retry_after} с")
+                if chat_id is not None:
+                    self._chat_bucket(chat_id).pause(e.retry_after)
+                else:
+                    await asyncio.sleep(e.retry_after)
+    
+    def stats(self):
+        """Возвращает метрики очереди исходящих запросов"""
+        return {
+            'queue_depth': dict(zip(PRIORITY_NAMES, self.queue_depth)),
+            'chats_tracked': len(self._chats),
+            'sent': self.sent,
+            'retried': self.retried,
+            'failed': self.failed
+        }
 
 # Создание бота и диспетчера
-bot = Bot(token=BOT_TOKEN)
+if TELEGRAM_API_URL:
+    bot = Bot(token=BOT_TOKEN, session=PreparedMarkupSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(token=BOT_TOKEN, session=PreparedMarkupSession())
 dp = Dispatcher()
 
-# Создание inline клавиатуры с кнопками
+# Все исходящие запросы проходят через планировщик с лимитами Telegram
+# Общий лимит делится между процессами-обработчиками
+send_scheduler = SendScheduler(SEND_GLOBAL_RATE / WORKERS if WORKER_ID else SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_GROUP_RATE, SEND_CHAT_BURST, SEND_MAX_RETRIES)
+bot.session.middleware(send_scheduler)
+
+# Метрики в формате Prometheus
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """Гистограмма Prometheus с одной меткой"""
+    
+    def __init__(self, name, documentation, label, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.buckets = buckets
+        self._series = {}  # значение метки -> [счетчики по корзинам..., сумма, количество]
+    
+    def observe(self, label_value, value):
+        """Добавляет наблюдение"""
+        series = self._series.get(label_value)
+        if series is None:
+            series = self._series[label_value] = [0] * (len(self.buckets) + 2)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+    
+    def render(self):
+        """Возвращает строки в текстовом формате Prometheus"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_value, series in sorted(self._series.items()):
+            labels = f'{self.label}="{label_value}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {series[-1]}')
+            lines.append(f"{self.name}_sum{{{labels}}} {series[-2]}")
+            lines.append(f"{self.name}_count{{{labels}}} {series[-1]}")
+        return lines
+
+def render_metric(name, documentation, metric_type, samples):
+    """Форматирует счетчик или датчик: samples - [(метки, значение), ...]"""
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} {metric_type}"]
+    for labels, value in samples:
+        lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+    return lines
+
+handler_latency = Histogram('bot_handler_duration_seconds', 'Время работы обработчиков', 'handler')
+handler_errors = {}  # имя обработчика -> число необработанных исключений
+update_queue_latency = Histogram('bot_update_queue_seconds', 'Ожидание обновления от приема до обработки', 'mode')
+weather_upstream_latency = Histogram('weather_upstream_duration_seconds', 'Время запросов к API погоды', 'status')
+event_loop_lag = {'current': 0.0, 'max': 0.0}
+event_loop_lag_histogram = Histogram('event_loop_lag_seconds', 'Задержка цикла событий', 'loop')
+
+# Замер времени работы функций-обработчиков
+def observe_latency(func):
+    """Декоратор: записывает время работы корутины в гистограмму обработчиков"""
+    name = func.__name__
+    
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            handler_latency.observe(name, time.perf_counter() - started)
+    return wrapper
+
+class MetricsMiddleware(BaseMiddleware):
+    """Промежуточный слой диспетчера: время работы и ошибки каждого обработчика"""
+    
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object else 'unknown'
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors[name] = handler_errors.get(name, 0) + 1
+            raise
+        finally:
+            handler_latency.observe(name, time.perf_counter() - started)
+
+class UpdateQueueMiddleware(BaseMiddleware):
+    """Внешний слой диспетчера: сколько обновление ждало обработки после приема"""
+    
+    async def __call__(self, handler, event, data):
+        received_at = data.get('received_at')
+        if received_at is not None:
+            update_queue_latency.observe(DELIVERY_MODE, time.monotonic() - received_at)
+        return await handler(event, data)
+
+class UserBucket(TokenBucket):
+    """Ведро входящих сообщений пользователя с отметкой о разосланном предупреждении"""
+    
+    __slots__ = ('warned',)
+    
+    def __init__(self, rate, capacity):
+        super().__init__(rate, capacity)
+        self.warned = False
+
+# Обработчик не смог ответить по существу (ошибка, нет данных): повтор того же текста склеивать нельзя
+reply_failed = contextvars.ContextVar('reply_failed', default=False)
+
+class InboundThrottleMiddleware(BaseMiddleware):
+    """Внешний слой диспетчера: лимит входящих на пользователя и склейка повторов одного текста"""
+    
+    def __init__(self, rate, burst, max_users, duplicate_window):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self._users = OrderedDict()  # id пользователя -> UserBucket, в порядке последней активности
+        self._recent = TTLCache(max_users, duplicate_window)  # (чат, текст) -> True
+        self.throttled = 0
+        self.merged = 0
+    
+    def _bucket(self, user_id):
+        bucket = self._users.get(user_id)
+        if bucket is None:
+            bucket = self._users[user_id] = UserBucket(self.rate, self.burst)
+            # Вытесняем самых давно неактивных: их ведра все равно уже полные
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+        return bucket
+    
+    async def __call__(self, handler, event, data):
+        user = event.from_user
+        if user is None or user.id in ADMIN_IDS:
+            return await handler(event, data)
+        
+        if self.rate > 0:
+            bucket = self._bucket(user.id)
+            if not bucket.take():
+                self.throttled += 1
+                # Предупреждаем один раз за эпизод, дальше молча отбрасываем
+                if not bucket.warned:
+                    bucket.warned = True
+                    try:
+                        await event.answer(THROTTLED_TEXT)
+                    except Exception as e:
+                        logger.warning(f"Не удалось предупредить пользователя {user.id} о лимите: {e}")
+                elif isinstance(event, types.CallbackQuery):
+                    # Пустой ответ снимает "часики" с кнопки
+                    try:
+                        await event.answer()
+                    except Exception as e:
+                        logger.debug(f"Не удалось ответить на отброшенное нажатие пользователя {user.id}: {e}")
+                return None
+            bucket.warned = False
+        
+        # Одинаковые тексты подряд (двойная отправка, повторы) обрабатываем один раз
+        if isinstance(event, types.Message) and event.text:
+            key = (event.chat.id, event.text.strip().casefold())
+            if self._recent.get(key):
+                self.merged += 1
+                return None
+            # Ключ ставим сразу, чтобы склеить повтор, пришедший во время обработки
+            self._recent.set(key, True)
+            token = reply_failed.set(False)
+            try:
+                result = await handler(event, data)
+                failed = reply_failed.get()
+            except BaseException:
+                self._recent.pop(key)
+                raise
+            finally:
+                reply_failed.reset(token)
+            # После неудачного ответа повтор должен пройти; после удачного окно считаем от ответа
+            if failed:
+                self._recent.pop(key)
+            else:
+                self._recent.set(key, True)
+            return result
+        return await handler(event, data)
+    
+    def __len__(self):
+        return len(self._users)
+
+inbound_throttle = InboundThrottleMiddleware(INBOUND_USER_RATE, INBOUND_USER_BURST, INBOUND_MAX_USERS, DUPLICATE_WINDOW)
+
+dp.message.middleware(MetricsMiddleware())
+dp.callback_query.middleware(MetricsMiddleware())
+dp.update.outer_middleware(UpdateQueueMiddleware())
+dp.message.outer_middleware(inbound_throttle)
+dp.callback_query.outer_middleware(inbound_throttle)
+
+# Измерение задержки цикла событий
+async def monitor_event_loop_lag(interval=0.5):
+    """Фоновая задача: насколько позже запланированного просыпается цикл событий"""
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.monotonic() - started - interval)
+        event_loop_lag['current'] = lag
+        event_loop_lag['max'] = max(event_loop_lag['max'], lag)
+        event_loop_lag_histogram.observe('main', lag)
+
+# Сторожевой поток: сообщает, если цикл событий занят дольше порога
+def frame_label(code):
+    """Подпись кадра стека: функция (файл:строка)"""
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def loop_handler_names():
+    """Имена зарегистрированных обработчиков и логики, по которым опознается виновник блокировки"""
+    names = {'process_weather_city_logic', 'process_products_search_logic', 'process_real_estate_search_logic'}
+    for observer in dp.observers.values():
+        for handler in observer.handlers:
+            names.add(handler.callback.__name__)
+    return names
+
+class LoopWatchdog:
+    """Находит обратные вызовы, которые держат цикл событий дольше порога, и логирует их стек"""
+    
+    def __init__(self, threshold_ms):
+        self.threshold = threshold_ms / 1000
+        self.blocks = 0
+        self._beat = time.monotonic()
+        self._reported_beat = None
+        self._loop_thread = None
+        self._handler_names = set()
+        self._stop = threading.Event()
+    
+    async def _heartbeat(self):
+        """Отмечает, что цикл событий жив"""
+        interval = self.threshold / 4
+        while True:
+            self._beat = time.monotonic()
+            await asyncio.sleep(interval)
+    
+    def _watch(self):
+        """Поток-сторож: проверяет, давно ли цикл событий отмечался"""
+        while not self._stop.wait(self.threshold / 2):
+            beat = self._beat
+            stalled = time.monotonic() - beat
+            if stalled < self.threshold or beat == self._reported_beat:
+                continue
+            self._reported_beat = beat
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            self.blocks += 1
+            stack = traceback.extract_stack(frame)
+            culprit = next((entry.name for entry in stack if entry.name in self._handler_names), None)
+            if culprit is None:
+                culprit = next((entry.name for entry in reversed(stack) if entry.filename == __file__), 'неизвестно')
+            logger.warning(
+                f"Цикл событий заблокирован уже {stalled * 1000:.0f} мс, обработчик: {culprit}\n"
+                + "".join(traceback.format_list(stack[-15:]))
+            )
+    
+    def start(self):
+        """Запускает сторожа; вызывается из работающего цикла событий"""
+        self._loop_thread = threading.get_ident()
+        self._handler_names = loop_handler_names()
+        self._stop.clear()
+        threading.Thread(target=self._watch, name='loop-watchdog', daemon=True).start()
+        logger.info(f"Сторож цикла событий запущен (порог {self.threshold * 1000:.0f} мс)")
+        return asyncio.create_task(self._heartbeat())
+    
+    def stop(self):
+        """Останавливает поток-сторож"""
+        self._stop.set()
+
+loop_watchdog = LoopWatchdog(LOOP_BLOCK_THRESHOLD_MS)
+
+# Сэмплирующий профилировщик потока цикла событий
+class SamplingProfiler:
+    """Периодически снимает стек потока цикла событий и пишет свернутые стеки для flamegraph"""
+    
+    def __init__(self, interval_ms, max_seconds, output_dir):
+        self.interval = interval_ms / 1000
+        self.max_seconds = max_seconds
+        self.output_dir = output_dir
+        self.last_path = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._target = None
+    
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+    
+    def start(self, target_thread=None):
+        """Начинает сбор профиля потока target_thread (по умолчанию - текущего)"""
+        if self.running:
+            return False
+        self._target = target_thread or threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        logger.info(f"Профилировщик запущен (интервал {self.interval * 1000:.0f} мс)")
+        return True
+    
+    def stop(self):
+        """Останавливает сбор; файл профиля записывается потоком профилировщика"""
+        if not self.running:
+            return False
+        self._stop.set()
+        return True
+    
+    def toggle(self, target_thread=None):
+        """Запускает или останавливает профилировщик; возвращает True, если он запущен"""
+        if self.running:
+            self.stop()
+            return False
+        self.start(target_thread)
+        return True
+    
+    def _sample(self):
+        samples = Counter()
+        started = time.monotonic()
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            if frame is not None:
+                stack = []
+                while frame is not None:
+                    stack.append(frame_label(frame.f_code))
+                    frame = frame.f_back
+                samples[';'.join(reversed(stack))] += 1
+            if time.monotonic() - started > self.max_seconds:
+                break
+        self._write(samples, time.monotonic() - started)
+    
+    def _write(self, samples, duration):
+        """Записывает профиль в свернутом формате (flamegraph.pl, speedscope)"""
+        path = os.path.join(self.output_dir, f"profile-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                for stack, count in samples.most_common():
+                    f.write(f"{stack} {count}\n")
+            self.last_path = path
+            logger.info(f"Профиль записан: {path} ({sum(samples.values())} сэмплов за {duration:.1f} с)")
+        except OSError as e:
+            logger.error(f"Не удалось записать профиль {path}: {e}")
+
+profiler = SamplingProfiler(PROFILE_INTERVAL_MS, PROFILE_MAX_SECONDS, LOG_DIR)
+
+def render_metrics():
+    """Собирает все метрики бота в текстовом формате Prometheus"""
+    cache = weather_cache.stats()
+    sender = send_scheduler.stats()
+    lines = []
+    lines += handler_latency.render()
+    lines += render_metric('bot_handler_errors_total', 'Необработанные исключения в обработчиках', 'counter',
+                           [(f'handler="{name}"', count) for name, count in sorted(handler_errors.items())])
+    lines += update_queue_latency.render()
+    lines += weather_upstream_latency.render()
+    lines += render_metric('weather_cache_hits_total', 'Попадания в кэш прогнозов', 'counter', [('', cache['hits'])])
+    lines += render_metric('weather_cache_misses_total', 'Промахи кэша прогнозов', 'counter', [('', cache['misses'])])
+    lines += render_metric('weather_cache_hit_ratio', 'Доля попаданий в кэш прогнозов', 'gauge', [('', cache['hit_ratio'])])
+    lines += render_metric('weather_cache_entries', 'Записей в кэше прогнозов', 'gauge', [('', cache['size'])])
+    lines += render_metric('weather_inflight_requests', 'Запросов к API погоды в работе', 'gauge', [('', len(weather_inflight))])
+    lines += render_metric('weather_requests_total', 'Запросов прогноза к API погоды', 'counter', [
+        ('kind="primary"', weather_hedge_stats['requests']),
+        ('kind="hedged"', weather_hedge_stats['hedged']),
+        ('kind="hedge_won"', weather_hedge_stats['hedge_wins']),
+        ('kind="rejected"', weather_breaker.rejected)
+    ])
+    lines += render_metric('weather_breaker_open', 'Размыкатель API погоды: 0 - замкнут, 1 - разомкнут или проба', 'gauge',
+                           [('', int(weather_breaker.state != CircuitBreaker.CLOSED))])
+    lines += marketplace_latency.render()
+    lines += render_metric('marketplace_search_total', 'Поисков на маркетплейсах по итогу', 'counter',
+                           [(f'source="{source}",status="{status}"', count) for (source, status), count in sorted(marketplace_results.items())])
+    lines += render_metric('listings_cache_hits_total', 'Попадания в кэш страниц объявлений', 'counter', [('', listings_cache.hits)])
+    lines += render_metric('listings_cache_misses_total', 'Промахи кэша страниц объявлений', 'counter', [('', listings_cache.misses)])
+    lines += render_metric('weather_chart_sends_total', 'Отправок графиков погоды', 'counter', [
+        ('source="file_id"', chart_file_ids.hits),
+        ('source="cached_image"', chart_images.hits),
+        ('source="rendered"', chart_images.misses)
+    ])
+    lines += render_metric('bot_inbound_dropped_total', 'Входящих, не дошедших до обработчиков', 'counter', [
+        ('reason="throttled"', inbound_throttle.throttled),
+        ('reason="duplicate"', inbound_throttle.merged)
+    ])
+    lines += render_metric('bot_inbound_users_tracked', 'Пользователей в учете лимита входящих', 'gauge', [('', len(inbound_throttle))])
+    lines += render_metric('weather_refresh_total', 'Упреждающих обновлений прогнозов', 'counter', [('', weather_refresher.refreshed)])
+    lines += render_metric('telegram_send_queue_depth', 'Запросов в очереди на отправку', 'gauge',
+                           [(f'lane="{lane}"', depth) for lane, depth in sender['queue_depth'].items()])
+    lines += render_metric('telegram_send_total', 'Исходящие запросы к Telegram', 'counter', [
+        ('result="sent"', sender['sent']),
+        ('result="retried"', sender['retried']),
+        ('result="failed"', sender['failed'])
+    ])
+    lines += render_metric('event_loop_lag_seconds_current', 'Текущая задержка цикла событий', 'gauge', [('', event_loop_lag['current'])])
+    lines += render_metric('event_loop_lag_seconds_max', 'Максимальная задержка цикла событий', 'gauge', [('', event_loop_lag['max'])])
+    lines += event_loop_lag_histogram.render()
+    lines += render_metric('event_loop_blocks_total', 'Блокировок цикла событий дольше порога', 'counter', [('', loop_watchdog.blocks)])
+    lines += render_metric('bot_active_sessions', 'Чатов с активным режимом (хранилище в памяти)', 'gauge',
+                           [('', len(state_store) if isinstance(state_store, MemoryStateStore) else 0)])
+    if worker_pool is not None:
+        lines += render_metric('bot_worker_up', 'Обработчик жив и отвечает', 'gauge',
+                               [(f'worker="{index}"', int(worker_pool.is_healthy(index))) for index in range(worker_pool.size)])
+        lines += render_metric('bot_worker_updates_total', 'Обновлений передано обработчику', 'counter',
+                               [(f'worker="{index}"', count) for index, count in enumerate(worker_pool.routed)])
+        lines += render_metric('bot_worker_restarts_total', 'Перезапусков обработчика', 'counter',
+                               [(f'worker="{index}"', count) for index, count in enumerate(worker_pool.restarts)])
+    lines += render_metric('log_records_dropped_total', 'Записей лога, отброшенных при переполненной очереди', 'counter',
+                           [('', log_handler.dropped)])
+    return "\n".join(lines) + "\n"
+
+# Функции доступа к клавиатурам
 def get_main_keyboard():
-    """Создает основную клавиатуру с кнопками (каждая в отдельной строке)"""
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(text="🌤️ Посмотреть прогноз погоды", callback_data="weather")
-            ],
-            [
-                InlineKeyboardButton(text="🛒 Поискать товары", callback_data="products")
-            ],
-            [
-                InlineKeyboardButton(text="🏠 Поискать жильё", callback_data="real_estate")
-            ]
-        ]
-    )
-    return keyboard
+    """Возвращает основную клавиатуру с кнопками (каждая в отдельной строке)"""
+    return MAIN_KEYBOARD
 
 def get_weather_keyboard():
-    """Создает клавиатуру для возврата"""
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(text="🔙 Назад в меню", callback_data="back_to_menu")
-            ]
-        ]
-    )
-    return keyboard
+    """Возвращает клавиатуру для возврата"""
+    return BACK_KEYBOARD
 
 def get_products_keyboard():
-    """Создает клавиатуру для возврата из поиска товаров"""
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(text="🔙 Назад в меню", callback_data="back_to_menu")
-            ]
-        ]
-    )
-    return keyboard
+    """Возвращает клавиатуру для возврата из поиска товаров"""
+    return BACK_KEYBOARD
 
 def get_real_estate_keyboard():
-    """Создает клавиатуру для возврата из поиска жилья"""
-    keyboard = InlineKeyboardMarkup(
+    """Возвращает клавиатуру для возврата из поиска жилья"""
+    return BACK_KEYBOARD
+
+def get_link_keyboard(text, url):
+    """Создает клавиатуру с кнопкой-ссылкой и кнопкой возврата в меню"""
+    return InlineKeyboardMarkup(
         inline_keyboard=[
             [
-                InlineKeyboardButton(text="🔙 Назад в меню", callback_data="back_to_menu")
+                InlineKeyboardButton(text=text, url=url)
+            ],
+            [
+                BACK_TO_MENU_BUTTON
             ]
         ]
     )
-    return keyboard
 
-# Функция для получения координат города
-def get_city_coordinates(city_name):
-    """Получает координаты города"""
-    try:
-        # Координаты ваших городов
-        city_coords = {
-            'москва': {'lat': 55.7558, 'lon': 37.6176},
-            'спб': {'lat': 59.9311, 'lon': 30.3609},
-            'санкт-петербург': {'lat': 59.9311, 'lon': 30.3609},
-            'салехард': {'lat': 66.5345, 'lon': 66.6053},
-            'тюмень': {'lat': 57.1530, 'lon': 65.5343},
-            'самара': {'lat': 53.1959, 'lon': 50.1008},
-            'тольятти': {'lat': 53.5303, 'lon': 49.3461},
-            'новокуйбышевск': {'lat': 53.0978, 'lon': 49.9512},
-            # Добавлены новые населенные пункты
-            'село горки': {'lat': 63.2028, 'lon': 64.7286},  # село Горки, Шурышкарский район, ЯНАО
-            'горки': {'lat': 63.2028, 'lon': 64.7286},        # короткое название
-            'село мордово': {'lat': 53.6742, 'lon': 51.1239},  # село Мордово, Самарская область
-            'мордово': {'lat': 53.6742, 'lon': 51.1239}         # короткое название
-        }
+# Статические тексты ответов
+WELCOME_TEXT = (
+    "🌟 **Привет! Я бот на все случаи жизни!** 🌟\n\n"
+    "👋 Рад вас видеть! Я умею помогать в различных ситуациях.\n\n"
+    "🎯 **Вот что я могу:**\n\n"
+    "🌤️ **Прогноз погоды** - узнайте погоду в любом городе\n"
+    "🛒 **Поиск товаров** - найдите нужные товары по выгодным ценам\n"
+    "🏠 **Поиск жилья** - подберите квартиру или дом для покупки/аренды\n\n"
+    "👇 Выберите нужную функцию ниже:"
+)
+
+MENU_TEXT = (
+    "🌟 **Главное меню** 🌟\n\n"
+    "🎯 **Выберите нужную функцию:**\n\n"
+    "🌤️ **Прогноз погоды** - узнайте погоду в любом городе\n"
+    "🛒 **Поиск товаров** - найдите нужные товары по выгодным ценам\n"
+    "🏠 **Поиск жилья** - подберите квартиру или дом для покупки/аренды"
+)
+
+WEATHER_PROMPT_TEXT = (
+    "🌤️ **Прогноз погоды** 🌤️\n\n"
+    "🔍 Введите название города для получения прогноза погоды:\n\n"
+    "📍 **Поддерживаются города России**, например:\n"
+    "• Москва или Питер\n"
+    "• Салехард\n"
+    "• Тюмень\n"
+    "• Самара\n"
+    "• Тольятти\n"
+    "• Новокуйбышевск\n"
+    "• Село Горки (ЯНАО)\n"
+    "• Село Мордово (Самарская область)\n\n"
+    "💡 **Пример:** просто напишите название города, опечатки не страшны\n"
+    "📊 Для сравнения перечислите города через запятую: Самара, Тольятти, Новокуйбышевск\n"
+    "📍 Или отправьте геопозицию - покажу погоду там, где вы"
+)
+
+CITY_NOT_FOUND_TEMPLATE = (
+    "❌ Город '{city}' не найден в базе данных.\n\n"
+    "📍 **Попробуйте ввести:**\n"
+    "• Москва\n"
+    "• СПб\n"
+    "• Салехард\n"
+    "• Тюмень\n"
+    "• Самара\n"
+    "• Тольятти\n"
+    "• Новокуйбышевск\n"
+    "• Село Горки\n"
+    "• Село Мордово\n\n"
+    "🔙 Или вернитесь в главное меню:"
+)
+
+WEATHER_UNAVAILABLE_TEXT = (
+    "❌ Не удалось получить данные о погоде.\n\n"
+    "🔄 Попробуйте еще раз или выберите другой город:"
+)
+
+WEATHER_ERROR_TEXT = (
+    "❌ Произошла ошибка при получении прогноза погоды.\n\n"
+    "🔄 Попробуйте еще раз:"
+)
+
+PRODUCTS_PROMPT_TEMPLATE = (
+    "🛒 **Поиск товаров** 🛒\n\n"
+    "🔍 Опишите товар, который хотите найти:\n\n"
+    "💡 **Примеры запросов:**\n"
+    "• iPhone 15\n"
+    "• Ноутбук ASUS\n"
+    "• Фен Dyson\n"
+    "• Кроссовки Nike\n\n"
+    "{sources}"
+    "💭 **Введите название товара:**"
+)
+PRODUCTS_COMPARE_SOURCES = "📱 **Бот сравнит цены: {sources}**\nи покажет самые дешевые предложения!\n\n"
+PRODUCTS_SINGLE_SOURCE = "📱 **Бот ищет цены: {source}**\nи покажет самые дешевые предложения!\n\n"
+PRODUCTS_NO_SOURCES = "📱 Поиск цен не настроен - бот даст ссылки на поиск в магазинах\n\n"
+
+PRODUCTS_RESULTS_HEADER = "🛒 **Результаты поиска: {query}** 🛒\n\n💰 **Сначала самые дешевые:**"
+render_product_offer = "{number}. **{price} ₽** - [{title}]({url}) _{source}_".format
+PRODUCTS_NOT_FOUND_TEXT = "😔 Ничего не нашлось. Попробуйте изменить запрос или откройте магазины по кнопкам ниже."
+PRODUCTS_SOURCE_STATUS = {
+    None: "⏳ {source}: ищу...",
+    'ok': "✅ {source}: найдено {count}",
+    'timeout': "⌛ {source}: не ответил вовремя",
+    'error': "❌ {source}: ошибка"
+}
+
+REAL_ESTATE_PROMPT_TEXT = (
+    "🏠 **Поиск жилья** 🏠\n\n"
+    "🔍 Опишите, что вы ищете:\n\n"
+    "💡 **Примеры запросов:**\n"
+    "• 1-комнатная квартира\n"
+    "• 2-комнатная квартира аренда\n"
+    "• Дом продажа\n"
+    "• Студия Москва\n\n"
+    "📱 **Бот покажет объявления с Авито прямо здесь**\n"
+    "листайте их кнопками ◀️ и ▶️!\n\n"
+    "💭 **Введите описание жилья:**"
+)
+
+REAL_ESTATE_RESULT_TEMPLATE = (
+    "🏠 **Результаты поиска: {query}** 🏠\n\n"
+    "🔗 **Откройте Авито для просмотра результатов:**\n"
+    "{url}\n\n"
+    "🏡 **На Авито вы сможете:**\n"
+    "• Найти квартиры, дома, комнаты\n"
+    "• Сравнить цены разных продавцов\n"
+    "• Посмотреть фото и описания\n"
+    "• Связаться с владельцами\n"
+    "• Выбрать покупку или аренду\n\n"
+    "💡 **Совет:** Откройте ссылку в браузере на вашем устройстве!"
+)
+
+REAL_ESTATE_LISTINGS_HEADER = "🏠 **Результаты поиска: {query}** 🏠\n\n📄 Страница {page}, объявления {first}-{last}"
+render_listing = "{number}. **{price}** - [{title}]({url})\n    📍 {address}".format
+REAL_ESTATE_NO_MORE_TEXT = "Больше объявлений нет"
+REAL_ESTATE_LOAD_ERROR_TEXT = "Не удалось загрузить объявления, попробуйте позже"
+REAL_ESTATE_EXPIRED_TEXT = "Выдача устарела, повторите поиск"
+
+NAVIGATION_HINT_TEXT = (
+    "🤔 **Используйте кнопки для навигации** 🤔\n\n"
+    "👇 Выберите нужную функцию ниже:"
+)
+
+ONLY_TEXT_HINT_TEXT = (
+    "🤔 **Поддерживаю только текстовые сообщения** 🤔\n\n"
+    "👇 Воспользуйтесь кнопками ниже или командой /start\n"
+    "для выбора нужной функции!"
+)
+
+THROTTLED_TEXT = "⏳ Слишком много сообщений подряд. Подождите несколько секунд и попробуйте снова."
+
+NOT_UNDERSTOOD_TEXT = (
+    "🤔 **Не понял ваше сообщение** 🤔\n\n"
+    "👋 Воспользуйтесь кнопками ниже или командой /start\n"
+    "для выбора нужной функции!"
+)
+
+HELP_TEXT = (
+    "❓ **Помощь по боту** ❓\n\n"
+    "🤖 **Доступные команды:**\n"
+    "/start - Начать работу с ботом\n"
+    "/help - Показать эту справку\n"
+    "/subscribe <город> <ЧЧ:ММ> - Присылать прогноз каждый день\n"
+    "/subscriptions - Мои подписки\n"
+    "/unsubscribe [город] - Отменить подписку\n\n"
+    "🎯 **Функции бота:**\n"
+    "🌤️ Прогноз погоды (УЖЕ РАБОТАЕТ!)\n"
+    "🛒 Поиск товаров (УЖЕ РАБОТАЕТ!)\n"
+    "🏠 Поиск жилья (УЖЕ РАБОТАЕТ!)\n\n"
+    "📞 **Поддержка:**\n"
+    "Если у вас есть вопросы или предложения - пишите!"
+)
+
+SUBSCRIBE_USAGE_TEXT = (
+    "📬 **Ежедневный прогноз погоды**\n\n"
+    f"Напишите город и время ({SUBSCRIPTIONS_TZ_LABEL}), например:\n"
+    "/subscribe Самара 08:00"
+)
+
+NO_SUBSCRIPTIONS_TEXT = (
+    "📭 У вас нет подписок на прогноз.\n\n"
+    "Оформить: /subscribe Самара 08:00"
+)
+
+# Таблицы и шаблоны для сообщения с прогнозом погоды
+WEATHER_EMOJIS = {
+    'clear': '☀️ Ясно',
+    'partly-cloudy': '⛅ Малооблачно',
+    'cloudy': '☁️ Облачно',
+    'overcast': '☁️ Пасмурно',
+    'drizzle': '🌦️ Морось',
+    'light-rain': '🌦️ Небольшой дождь',
+    'rain': '🌧️ Дождь',
+    'moderate-rain': '🌧️ Умеренный дождь',
+    'heavy-rain': '🌧️ Сильный дождь',
+    'thunderstorm': '⛈️ Гроза',
+    'snow': '❄️ Снег',
+    'snowfall': '❄️ Снегопад'
+}
+
+WIND_DIRECTIONS = {
+    'nw': 'СЗ', 'n': 'С', 'ne': 'СВ',
+    'e': 'В', 'se': 'ЮВ', 's': 'Ю',
+    'sw': 'ЮЗ', 'w': 'З', 'c': 'Штиль'
+}
+
+render_weather_header = (
+    "🌤️ **Погода в {city}** 🌤️\n\n"
+    "{icon} \n\n"
+    "🌡️ **Температура:** {temp:+d}°C\n"
+    "🌡️ **Ощущается как:** {feels_like:+d}°C\n\n"
+).format
+render_weather_wind = "💨 **Ветер:** {direction} {speed} м/с\n".format
+render_weather_humidity = "💧 **Влажность:** {humidity}%\n".format
+render_weather_pressure = "📊 **Давление:** {pressure} мм рт.ст.\n".format
+WEATHER_DAYS_HEADER = "\n📅 **Прогноз на 2 дня:**\n"
+WEATHER_COMPARE_HEADER = "📊 **Сравнение погоды** 📊\n\n"
+render_weather_compare_row = "{city:<14} {now:>6} {tomorrow:>10}\n".format
+WEATHER_COMPARE_NOT_FOUND_TEMPLATE = "\n❌ Не найдены: {cities}"
+WEATHER_COMPARE_LIMIT_TEMPLATE = "\n✂️ Сравниваю только первые {count} городов"
+LOCATION_NEAR_TEMPLATE = "{city} ({distance:.0f} км от вас)"
+LOCATION_POINT_TEMPLATE = "точка {lat:.2f}, {lon:.2f}"
+LOCATION_SAME_PLACE_KM = 5  # Ближе - считаем, что пользователь в самом пункте
+CHART_CAPTION_TEMPLATE = "📈 {city}: температура по часам и на 7 дней"
+render_weather_day = "📅 **{day}:** {icon} {temp_min:+d}°...{temp_max:+d}°C\n".format
+
+# Идентификатор чата, из которого пришел callback
+def callback_chat_id(callback):
+    """Возвращает id чата callback'а (или id пользователя, если сообщения нет)"""
+    if callback.message:
+        return callback.message.chat.id
+    return callback.from_user.id
+
+async def answer_callback(callback, text=None):
+    """Отвечает на нажатие; устаревшие нажатия (например, дочитанные после перезапуска) Telegram отклоняет"""
+    try:
+        await callback.answer(text)
+    except TelegramBadRequest as e:
+        logger.debug(f"Не удалось ответить на нажатие {callback.data!r}: {e}")
+
+# Справочник населенных пунктов с поиском по точному названию, префиксу и с опечатками
+City = namedtuple('City', ['name', 'lat', 'lon'])
+
+# Латинские буквы, похожие на кириллические (исправляют "Самарa" с латинской "a")
+LATIN_HOMOGLYPHS = str.maketrans('aceopxykmtbh', 'асеорхукмтвн')
+# Типы населенных пунктов, которые пользователи пишут перед названием
+SETTLEMENT_PREFIXES = ('город ', 'г ', 'село ', 'с ', 'поселок ', 'пос ', 'пгт ', 'деревня ', 'д ')
+
+def normalize_city_name(name):
+    """Приводит название к ключу поиска: регистр, ё, латиница-двойник, дефисы, тип пункта"""
+    key = name.lower().replace('ё', 'е').replace('-', ' ').replace('.', ' ')
+    if any('а' <= ch <= 'я' for ch in key):
+        key = key.translate(LATIN_HOMOGLYPHS)
+    key = ' '.join(key.split())
+    for prefix in SETTLEMENT_PREFIXES:
+        if key.startswith(prefix) and len(key) > len(prefix):
+            key = key[len(prefix):]
+            break
+    return key
+
+def _trigrams(key):
+    """Возвращает множество триграмм ключа (с границами слова)"""
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def _edit_distance(a, b, limit):
+    """Расстояние Левенштейна, обрывается, как только превышает limit.
+    Считается только полоса |i - j| <= limit: клетки вне нее заведомо больше limit"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    over = limit + 1
+    previous = [j if j <= limit else over for j in range(len(b) + 1)]
+    for i, ch_a in enumerate(a, 1):
+        low, high = max(1, i - limit), min(len(b), i + limit)
+        current = [over] * (len(b) + 1)
+        if i <= limit:
+            current[0] = i
+        for j in range(low, high + 1):
+            # Сравнения вместо min(): это самый горячий цикл нечеткого поиска
+            value = previous[j - 1] + (ch_a != b[j - 1])
+            if previous[j] < value:
+                value = previous[j] + 1 if previous[j] + 1 < value else value
+            if current[j - 1] < value:
+                value = current[j - 1] + 1 if current[j - 1] + 1 < value else value
+            current[j] = value
+        if min(current[low - 1:high + 1]) > limit:
+            return over
+        previous = current
+    return min(previous[-1], over)
+
+def _distance_km(lat1, lon1, lat2, lon2):
+    """Расстояние между точками в км (равнопромежуточная проекция, для сотен км точности хватает)"""
+    x = math.radians((lon2 - lon1 + 180) % 360 - 180) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return 6371.0 * math.hypot(x, y)
+
+class CityGazetteer:
+    """Компактный индекс населенных пунктов, загружаемый при первом обращении"""
+    
+    MIN_PREFIX = 3        # Минимальная длина запроса для поиска по префиксу
+    CELL_DEGREES = 1.0    # Шаг сетки пространственного индекса
+    LON_CELLS = 360       # Ячеек по долготе (через 180-й меридиан сетка замыкается)
+    KM_PER_DEGREE = 111.2
+    MAX_POSTINGS = 1500   # Сколько записей триграммного индекса просматривать на один нечеткий поиск
+    
+    def __init__(self, path):
+        self.path = path
+        self._loaded = False
+        self._load_lock = threading.Lock()  # Справочник может прогреваться в фоновом потоке
+        self._names = []            # Каноническое название по номеру записи
+        self._lats = array('d')
+        self._lons = array('d')
+        self._exact = {}            # Ключ поиска -> номер записи
+        self._keys = []             # Отсортированные ключи для поиска по префиксу
+        self._key_entries = []      # Номер записи для каждого ключа из _keys
+        self._trigram_index = {}    # Триграмма -> (номера ключей из _keys, их длины), по возрастанию длины
+        self._cells = {}            # Ячейка сетки (широта, долгота) -> номера записей
+    
+    def _add_key(self, key, entry):
+        if key and key not in self._exact:
+            self._exact[key] = entry
+    
+    def load(self):
+        """Загружает справочник и строит индексы"""
+        if self._loaded:
+            return
+        with self._load_lock:
+            if not self._loaded:
+                self._load()
+    
+    def _load(self):
+        started = time.perf_counter()
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                if not line.strip() or line.startswith('#'):
+                    continue
+                fields = line.rstrip('\n').split('\t')
+                entry = len(self._names)
+                self._names.append(fields[0])
+                self._lats.append(float(fields[1]))
+                self._lons.append(float(fields[2]))
+                self._add_key(normalize_city_name(fields[0]), entry)
+                if len(fields) > 3 and fields[3]:
+                    for alias in fields[3].split(','):
+                        self._add_key(normalize_city_name(alias), entry)
         
-        city_lower = city_name.lower().strip()
-        if city_lower in city_coords:
-            return city_coords[city_lower]
-        else:
+        self._keys = sorted(self._exact)
+        self._key_entries = array('I', (self._exact[key] for key in self._keys))
+        index = {}
+        # Списки триграмм упорядочены по длине ключа: нечеткий поиск берет из них только ключи подходящей длины
+        for key_id in sorted(range(len(self._keys)), key=lambda key_id: len(self._keys[key_id])):
+            key = self._keys[key_id]
+            for trigram in _trigrams(key):
+                posting = index.get(trigram)
+                if posting is None:
+                    posting = index[trigram] = (array('I'), array('H'))
+                posting[0].append(key_id)
+                posting[1].append(len(key))
+        self._trigram_index = index
+        cells = {}
+        for entry, (lat, lon) in enumerate(zip(self._lats, self._lons)):
+            cells.setdefault(self._cell(lat, lon), array('I')).append(entry)
+        self._cells = cells
+        self._loaded = True
+        logger.info(
+            f"Справочник городов загружен: {len(self._names)} пунктов, {len(self._keys)} ключей "
+            f"за {(time.perf_counter() - started) * 1000:.1f} мс"
+        )
+    
+    def __len__(self):
+        self.load()
+        return len(self._names)
+    
+    def _city(self, entry):
+        return City(self._names[entry], self._lats[entry], self._lons[entry])
+    
+    def exact(self, key):
+        """Точное совпадение по ключу или синониму"""
+        entry = self._exact.get(key)
+        return None if entry is None else self._city(entry)
+    
+    def prefix(self, key, scan=50):
+        """Самый значимый пункт, название которого начинается с ключа"""
+        if len(key) < self.MIN_PREFIX:
             return None
-            
+        start = bisect.bisect_left(self._keys, key)
+        best = None
+        for key_id in range(start, min(start + scan, len(self._keys))):
+            if not self._keys[key_id].startswith(key):
+                break
+            entry = self._key_entries[key_id]
+            if best is None or entry < best:
+                best = entry
+        return None if best is None else self._city(best)
+    
+    def fuzzy(self, key, candidates=10):
+        """Ближайший пункт с учетом опечаток (триграммы + проверка расстоянием Левенштейна).
+        Смотрим только ключи, длина которых отличается не больше чем на limit, и триграммы от редких к частым,
+        пока не исчерпан бюджет MAX_POSTINGS: частые ("нов", "ово") почти не отличают кандидатов,
+        а на больших справочниках стоят дороже всего"""
+        limit = max(1, len(key) // 4)
+        postings = []
+        for trigram in _trigrams(key):
+            posting = self._trigram_index.get(trigram)
+            if posting is not None:
+                key_ids, lengths = posting
+                start = bisect.bisect_left(lengths, len(key) - limit)
+                end = bisect.bisect_right(lengths, len(key) + limit)
+                if end > start:
+                    postings.append(key_ids[start:end])
+        postings.sort(key=len)
+        counts = Counter()
+        scanned = 0
+        for key_ids in postings:
+            if scanned and scanned + len(key_ids) > self.MAX_POSTINGS:
+                break
+            counts.update(key_ids)
+            scanned += len(key_ids)
+        if not counts:
+            return None
+        
+        best = None
+        for key_id, _ in counts.most_common(candidates):
+            # Хуже уже найденного нас не интересует: с меньшим порогом проверка обрывается раньше
+            bound = limit if best is None else best[0]
+            distance = _edit_distance(key, self._keys[key_id], bound)
+            if distance <= bound:
+                rank = (distance, self._key_entries[key_id])
+                if best is None or rank < best:
+                    best = rank
+        return None if best is None else self._city(best[1])
+    
+    def _cell(self, lat, lon):
+        return (math.floor(lat / self.CELL_DEGREES), math.floor(lon / self.CELL_DEGREES) % self.LON_CELLS)
+    
+    def nearest(self, lat, lon, max_km):
+        """Ближайший пункт не дальше max_km: (пункт, расстояние в км) или None.
+        Просматриваются только ячейки сетки, которые могут быть ближе max_km"""
+        self.load()
+        row, column = self._cell(lat, lon)
+        rows = math.ceil(max_km / (self.KM_PER_DEGREE * self.CELL_DEGREES))
+        # Ячейки по долготе сужаются к полюсу - считаем по самой северной (южной) строке
+        narrowest = math.cos(math.radians(min(abs(lat) + rows * self.CELL_DEGREES, 89.0)))
+        columns = min(math.ceil(max_km / (self.KM_PER_DEGREE * self.CELL_DEGREES * narrowest)), self.LON_CELLS // 2)
+        best = None
+        for row_offset in range(-rows, rows + 1):
+            for column_offset in range(-columns, columns + 1):
+                for entry in self._cells.get((row + row_offset, (column + column_offset) % self.LON_CELLS), ()):
+                    distance = _distance_km(lat, lon, self._lats[entry], self._lons[entry])
+                    if distance <= max_km and (best is None or distance < best[0]):
+                        best = (distance, entry)
+        return None if best is None else (self._city(best[1]), best[0])
+    
+    def find(self, name):
+        """Ищет пункт: точное совпадение, затем префикс, затем с опечатками"""
+        self.load()
+        key = normalize_city_name(name)
+        if not key:
+            return None
+        return self.exact(key) or self.prefix(key) or self.fuzzy(key)
+
+gazetteer = CityGazetteer(GAZETTEER_PATH)
+
+# Поиск населенного пункта по названию
+def find_city(city_name):
+    """Находит населенный пункт в справочнике (или None)"""
+    try:
+        return gazetteer.find(city_name)
     except Exception as e:
-        logger.error(f"Ошибка при получении координат города {city_name}: {e}")
+        logger.error(f"Ошибка при поиске города {city_name}: {e}")
         return None
+
+# Функция для получения координат города
+def get_city_coordinates(city_name):
+    """Получает координаты и название города из справочника"""
+    city = find_city(city_name)
+    if city is None:
+        return None
+    return {'lat': city.lat, 'lon': city.lon, 'name': city.name}
             
+# Создание общей HTTP-сессии для API погоды
+async def start_weather_client():
+    """Создает долгоживущую сессию с пулом keep-alive соединений к API погоды"""
+    global weather_session
+    if weather_session is not None and not weather_session.closed:
+        return weather_session
+    
+    # Лимит коннектора ограничивает число одновременных запросов к API погоды,
+    # остальные запросы ждут свободного соединения в очереди
+    connector = aiohttp.TCPConnector(
+        limit=WEATHER_MAX_CONNECTIONS,
+        keepalive_timeout=60,
+        ttl_dns_cache=300
+    )
+    weather_session = aiohttp.ClientSession(
+        connector=connector,
+        headers={'X-Yandex-Weather-Key': WEATHER_API_KEY},
+        timeout=aiohttp.ClientTimeout(total=WEATHER_TIMEOUT)
+    )
+    logger.info(f"HTTP-клиент погоды запущен (соединений не более {WEATHER_MAX_CONNECTIONS})")
+    return weather_session
+
+async def start_market_client():
+    """Создает сессию для API маркетплейсов (отдельно от погоды: без ключа погоды в заголовках)"""
+    global market_session
+    if market_session is None or market_session.closed:
+        market_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=WEATHER_MAX_CONNECTIONS, keepalive_timeout=60, ttl_dns_cache=300),
+            headers={'User-Agent': 'Mozilla/5.0 (compatible; pihta-bot)'}
+        )
+    return market_session
+
+async def close_weather_client():
+    """Закрывает общую HTTP-сессию API погоды"""
+    global weather_session
+    if weather_session is not None and not weather_session.closed:
+        await weather_session.close()
+    weather_session = None
+
+async def close_market_client():
+    """Закрывает сессию API маркетплейсов"""
+    global market_session
+    if market_session is not None and not market_session.closed:
+        await market_session.close()
+    market_session = None
+
+# Ключ кэша прогноза по координатам
+def weather_cache_key(lat, lon):
+    """Возвращает ключ кэша - центр ячейки сетки WEATHER_GRID (без сетки - округление до ~10 м).
+    Прогноз запрашивается именно для этой точки, поэтому соседние пользователи делят один ответ API"""
+    if WEATHER_GRID > 0:
+        lat = round(float(lat) / WEATHER_GRID) * WEATHER_GRID
+        lon = round(float(lon) / WEATHER_GRID) * WEATHER_GRID
+    return (round(float(lat), 4), round(float(lon), 4))
+
 # Функция для получения прогноза погоды
-def get_weather_forecast(lat, lon):
-    """Получает прогноз погоды через Яндекс.Погода API"""
-    try:
-        url = 'https://api.weather.yandex.ru/v2/forecast'
-        headers = {'X-Yandex-Weather-Key': WEATHER_API_KEY}
-        params = {
-            'lat': lat,
-            'lon': lon,
-            'lang': 'ru_RU',
-            'limit': 3
-        }
-        
-        response = requests.get(url, headers=headers, params=params, timeout=10)
-        
-        if response.status_code == 200:
-            data = response.json()
-            return data
-        else:
-            logger.error(f"API погоды вернул код {response.status_code}: {response.text}")
+async def get_weather_forecast(lat, lon):
+    """Получает прогноз погоды из кэша или через Яндекс.Погода API"""
+    key = weather_cache_key(lat, lon)
+    cached = weather_cache.get(key)
+    if cached is not None:
+        return cached
+    
+    # shield: отмена одного ожидающего не отменяет запрос для остальных
+    return await asyncio.shield(start_weather_load(key))
+
+def start_weather_load(key):
+    """Возвращает задачу загрузки прогноза; одновременные запросы одних координат делят одну задачу"""
+    task = weather_inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_load_weather_forecast(key))
+        weather_inflight[key] = task
+        task.add_done_callback(lambda _: weather_inflight.pop(key, None))
+    return task
+
+async def _load_weather_forecast(key):
+    """Загружает прогноз для точки ключа из API и сохраняет успешный ответ в кэш"""
+    data = await fetch_weather_forecast(*key)
+    if data is not None:
+        weather_cache.set(key, data)
+    return data
+
+# Адаптивный таймаут и повторные (hedged) запросы к API погоды
+class LatencyWindow:
+    """Скользящее окно задержек успешных запросов для оценки перцентилей"""
+    
+    MIN_SAMPLES = 20
+    
+    def __init__(self, size=500):
+        self._samples = deque(maxlen=size)
+    
+    def add(self, value):
+        self._samples.append(value)
+    
+    def quantile(self, q):
+        """Перцентиль задержки или None, пока наблюдений мало"""
+        if len(self._samples) < self.MIN_SAMPLES:
             return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class CircuitBreaker:
+    """Размыкается после серии ошибок и отклоняет запросы, пока не пройдет пауза;
+    затем пропускает один пробный запрос и по его результату замыкается или размыкается снова"""
+    
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+    
+    def __init__(self, failures, cooldown):
+        self.max_failures = failures
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+    
+    def allow(self):
+        """Можно ли отправить запрос сейчас"""
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = self.HALF_OPEN
+            return True
+        if self.state != self.CLOSED:
+            self.rejected += 1
+            return False
+        return True
+    
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info("API погоды снова отвечает, запросы возобновлены")
+        self.state = self.CLOSED
+        self.failures = 0
+    
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.max_failures:
+            if self.state != self.OPEN:
+                logger.warning(f"API погоды недоступен: запросы приостановлены на {self.cooldown:.0f} с")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+weather_latency_window = LatencyWindow()
+weather_breaker = CircuitBreaker(WEATHER_BREAKER_FAILURES, WEATHER_BREAKER_COOLDOWN)
+weather_hedge_stats = {'requests': 0, 'hedged': 0, 'hedge_wins': 0}
+
+def weather_attempt_timeout():
+    """Таймаут одной попытки: втрое больше p99, но в пределах [WEATHER_TIMEOUT_MIN, WEATHER_TIMEOUT]"""
+    p99 = weather_latency_window.quantile(0.99)
+    if p99 is None:
+        return WEATHER_TIMEOUT
+    return min(WEATHER_TIMEOUT, max(WEATHER_TIMEOUT_MIN, p99 * 3))
+
+def weather_hedge_delay():
+    """Через сколько секунд отправлять повторный запрос или None, если сейчас нельзя"""
+    if weather_hedge_stats['hedged'] >= WEATHER_HEDGE_RATIO * weather_hedge_stats['requests']:
+        return None
+    return weather_latency_window.quantile(WEATHER_HEDGE_QUANTILE)
+
+# Запрос прогноза погоды к API без кэша
+async def fetch_weather_forecast(lat, lon):
+    """Запрашивает прогноз погоды у Яндекс.Погода API.
+    
+    Если первая попытка не уложилась в p95, параллельно отправляется вторая и берется
+    первый успешный ответ. Пока API недоступен, запросы сразу возвращают None."""
+    if not weather_breaker.allow():
+        logger.debug("Запрос к API погоды отклонен: API недоступен")
+        return None
+    params = {
+        'lat': lat,
+        'lon': lon,
+        'lang': 'ru_RU',
+        'limit': 7,
+        'hours': 'true'
+    }
+    timeout = weather_attempt_timeout()
+    weather_hedge_stats['requests'] += 1
+    attempts = [asyncio.ensure_future(request_weather(params, timeout))]
+    try:
+        hedge_delay = weather_hedge_delay()
+        if hedge_delay is not None:
+            done, _ = await asyncio.wait(attempts, timeout=hedge_delay)
+            if not done:
+                weather_hedge_stats['hedged'] += 1
+                attempts.append(asyncio.ensure_future(request_weather(params, timeout)))
+        
+        pending = set(attempts)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for attempt in done:
+                data = attempt.result()
+                if data is not None:
+                    if attempt is not attempts[0]:
+                        weather_hedge_stats['hedge_wins'] += 1
+                    return data
+        return None
+    finally:
+        for attempt in attempts:
+            attempt.cancel()
+
+async def request_weather(params, timeout):
+    """Одна попытка запроса к API погоды; результат учитывается в окне задержек и размыкателе"""
+    started = time.perf_counter()
+    status = 'error'
+    try:
+        session = await start_weather_client()
+        async with session.get(WEATHER_API_URL, params=params, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            if response.status == 200:
+                data = await response.json()
+                status = 'ok'
+                weather_latency_window.add(time.perf_counter() - started)
+                weather_breaker.record_success()
+                return data
+            else:
+                text = await response.text()
+                logger.error(f"API погоды вернул код {response.status}: {text}")
+                # Ошибки в самом запросе (например, неверный ключ) не говорят о недоступности API
+                if response.status >= 500 or response.status == 429:
+                    weather_breaker.record_failure()
+                else:
+                    weather_breaker.record_success()
+                return None
             
-    except requests.exceptions.RequestException as e:  # ИЗМЕНЕНИЕ ЗДЕСЬ
+    except asyncio.CancelledError:
+        status = 'cancelled'
+        raise
+    except asyncio.TimeoutError:
+        status = 'timeout'
+        weather_breaker.record_failure()
+        logger.error(f"Таймаут запроса к API погоды ({timeout:.1f} с)")
+        return None
+    except aiohttp.ClientError as e:
+        weather_breaker.record_failure()
         logger.error(f"Ошибка запроса к API погоды: {e}")
         return None
     except Exception as e:
+        weather_breaker.record_failure()
         logger.error(f"Неожиданная ошибка при получении погоды: {e}")
         return None
+    finally:
+        weather_upstream_latency.observe(status, time.perf_counter() - started)
 
 # Функция для форматирования прогноза погоды
 def format_weather_message(weather_data, city_name):
-    """Форматирует сообщение с прогнозом погоды"""
+    """Форматирует сообщение с прогнозом погоды по готовым шаблонам"""
     try:
         if not weather_data:
             return "❌ Не удалось получить данные о погоде. Попробуйте позже."
@@ -186,83 +1978,54 @@ def format_weather_message(weather_data, city_name):
         current = weather_data['fact']
         forecasts = weather_data.get('forecasts', [])
         
-        # Эмодзи для условий погоды        
-        weather_emojis = {
-            'clear': '☀️ Ясно',
-            'partly-cloudy': '⛅ Малооблачно',
-            'cloudy': '☁️ Облачно',
-            'overcast': '☁️ Пасмурно',
-            'drizzle': '🌦️ Морось',
-            'light-rain': '🌦️ Небольшой дождь',
-            'rain': '🌧️ Дождь',
-            'moderate-rain': '🌧️ Умеренный дождь',
-            'heavy-rain': '🌧️ Сильный дождь',
-            'thunderstorm': '⛈️ Гроза',
-            'snow': '❄️ Снег',
-            'snowfall': '❄️ Снегопад'
-        }
-        
-        condition = current.get('condition', 'unknown')
-        icon = weather_emojis.get(condition, '🌤️')
-        
         # Температура - безопасное получение
         temp = current.get('temp', 0)
-        feels_like = current.get('feels_like', temp)
-        
-        # Направление ветра
-        wind_dir = current.get('wind_dir', '')
-        wind_speed = current.get('wind_speed', 0)
         
-        wind_directions = {
-            'nw': 'СЗ', 'n': 'С', 'ne': 'СВ', 
-            'e': 'В', 'se': 'ЮВ', 's': 'Ю', 
-            'sw': 'ЮЗ', 'w': 'З', 'c': 'Штиль'
-        }
-        wind_dir_ru = wind_directions.get(wind_dir, wind_dir)
-        
-        # Влажность и давление
-        humidity = current.get('humidity', 0)
-        pressure = current.get('pressure_mm', 0)
-        
-        message = f"🌤️ **Погода в {city_name.title()}** 🌤️\n\n"
-        message += f"{icon} \n\n"
-        message += f"🌡️ **Температура:** {temp:+d}°C\n"
-        message += f"🌡️ **Ощущается как:** {feels_like:+d}°C\n\n"
+        parts = [render_weather_header(
+            city=city_name[:1].upper() + city_name[1:],
+            icon=WEATHER_EMOJIS.get(current.get('condition', 'unknown'), '🌤️'),
+            temp=temp,
+            feels_like=current.get('feels_like', temp)
+        )]
         
+        # Ветер, влажность и давление
+        wind_speed = current.get('wind_speed', 0)
         if wind_speed > 0:
-            message += f"💨 **Ветер:** {wind_dir_ru} {wind_speed} м/с\n"
+            wind_dir = current.get('wind_dir', '')
+            parts.append(render_weather_wind(direction=WIND_DIRECTIONS.get(wind_dir, wind_dir), speed=wind_speed))
         
+        humidity = current.get('humidity', 0)
         if humidity > 0:
-            message += f"💧 **Влажность:** {humidity}%\n"
+            parts.append(render_weather_humidity(humidity=humidity))
         
+        pressure = current.get('pressure_mm', 0)
         if pressure > 0:
-            message += f"📊 **Давление:** {pressure} мм рт.ст.\n"
+            parts.append(render_weather_pressure(pressure=pressure))
         
-        # Прогноз на несколько дней - исправленная обработка
+        # Прогноз на несколько дней
         if forecasts:
-            message += "\n📅 **Прогноз на 2 дня:**\n"
+            parts.append(WEATHER_DAYS_HEADER)
             
             for forecast in forecasts[:2]:
-                date_parts = forecast.get('date', '').split('-')
-                parts = forecast.get('parts', {})
-                
                 # Берем дневную часть для информации о дне
-                day_part = parts.get('day', {})
+                day_part = forecast.get('parts', {}).get('day', {})
+                if not day_part:
+                    continue
                 
-                if day_part:
-                    temp_min = day_part.get('temp_min', 0)
-                    temp_max = day_part.get('temp_max', 0)
-                    condition_day = day_part.get('condition', 'unknown')
-                    icon_day = weather_emojis.get(condition_day, '🌤️')
-                    
-                    if len(date_parts) >= 3:
-                        day_str = f"{date_parts[2]}.{date_parts[1]}"
-                    else:
-                        day_str = "Завтра"
-                    
-                    message += f"📅 **{day_str}:** {icon_day} {temp_min:+d}°...{temp_max:+d}°C\n"
-        
-        return message
+                date_parts = forecast.get('date', '').split('-')
+                if len(date_parts) >= 3:
+                    day_str = f"{date_parts[2]}.{date_parts[1]}"
+                else:
+                    day_str = "Завтра"
+                
+                parts.append(render_weather_day(
+                    day=day_str,
+                    icon=WEATHER_EMOJIS.get(day_part.get('condition', 'unknown'), '🌤️'),
+                    temp_min=day_part.get('temp_min', 0),
+                    temp_max=day_part.get('temp_max', 0)
+                ))
+        
+        return "".join(parts)
         
     except Exception as e:
         logger.error(f"Ошибка при форматировании прогноза погоды: {e}")
@@ -274,18 +2037,8 @@ def format_weather_message(weather_data, city_name):
 async def cmd_start(message: types.Message):
     """Обработчик команды /start"""
     try:
-        welcome_text = (
-            "🌟 **Привет! Я бот на все случаи жизни!** 🌟\n\n"
-            "👋 Рад вас видеть! Я умею помогать в различных ситуациях.\n\n"
-            "🎯 **Вот что я могу:**\n\n"
-            "🌤️ **Прогноз погоды** - узнайте погоду в любом городе\n"
-            "🛒 **Поиск товаров** - найдите нужные товары по выгодным ценам\n"
-            "🏠 **Поиск жилья** - подберите квартиру или дом для покупки/аренды\n\n"
-            "👇 Выберите нужную функцию ниже:"
-        )
-        
         await message.answer(
-            welcome_text,
+            WELCOME_TEXT,
             parse_mode="Markdown",
             reply_markup=get_main_keyboard()
         )
@@ -298,28 +2051,11 @@ async def cmd_start(message: types.Message):
 async def process_weather_callback(callback: types.CallbackQuery):
     """Обработчик нажатия на кнопку погоды"""
     try:
-        global current_mode
-        await callback.answer()
-        current_mode = BotMode.WEATHER  # Устанавливаем режим погоды
-        
-        weather_text = (
-            "🌤️ **Прогноз погоды** 🌤️\n\n"
-            "🔍 Введите название города для получения прогноза погоды:\n\n"
-            "📍 **Поддерживаемые города:**\n"
-            "• Москва\n"
-            "• Санкт-Петербург\n"
-            "• Салехард\n"
-            "• Тюмень\n"
-            "• Самара\n"
-            "• Тольятти\n"
-            "• Новокуйбышевск\n"
-            "• Село Горки (ЯНАО)\n"
-            "• Село Мордово (Самарская область)\n\n"
-            "💡 **Пример:** просто напишите название города"
-        )
+        await state_store.set_mode(callback_chat_id(callback), BotMode.WEATHER)  # Устанавливаем режим погоды
+        await answer_callback(callback)
         
         await callback.message.edit_text(
-            weather_text,
+            WEATHER_PROMPT_TEXT,
             parse_mode="Markdown",
             reply_markup=get_weather_keyboard()
         )
@@ -333,25 +2069,11 @@ async def process_weather_callback(callback: types.CallbackQuery):
 async def process_products_callback(callback: types.CallbackQuery):
     """Обработчик нажатия на кнопку поиска товаров"""
     try:
-        global current_mode
-        await callback.answer()
-        current_mode = BotMode.PRODUCTS  # Устанавливаем режим поиска товаров
-        
-        products_text = (
-            "🛒 **Поиск товаров** 🛒\n\n"
-            "🔍 Опишите товар, который хотите найти:\n\n"
-            "💡 **Примеры запросов:**\n"
-            "• iPhone 15\n"
-            "• Ноутбук ASUS\n"
-            "• Фен Dyson\n"
-            "• Кроссовки Nike\n\n"
-            "📱 **После ввода запроса откроется Яндекс.Маркет**\n"
-            "где вы сможете сравнить цены и выбрать лучшее предложение!\n\n"
-            "💭 **Введите название товара:**"
-        )
+        await state_store.set_mode(callback_chat_id(callback), BotMode.PRODUCTS)  # Устанавливаем режим поиска товаров
+        await answer_callback(callback)
         
         await callback.message.edit_text(
-            products_text,
+            PRODUCTS_PROMPT_TEXT,
             parse_mode="Markdown",
             reply_markup=get_products_keyboard()
         )
@@ -365,25 +2087,11 @@ async def process_products_callback(callback: types.CallbackQuery):
 async def process_real_estate_callback(callback: types.CallbackQuery):
     """Обработчик нажатия на кнопку поиска жилья"""
     try:
-        global current_mode
-        await callback.answer()
-        current_mode = BotMode.REAL_ESTATE  # Устанавливаем режим поиска жилья
-        
-        real_estate_text = (
-            "🏠 **Поиск жилья** 🏠\n\n"
-            "🔍 Опишите, что вы ищете:\n\n"
-            "💡 **Примеры запросов:**\n"
-            "• 1-комнатная квартира\n"
-            "• 2-комнатная квартира аренда\n"
-            "• Дом продажа\n"
-            "• Студия Москва\n\n"
-            "📱 **После ввода запроса откроется Авито**\n"
-            "где вы сможете просмотреть все доступные варианты!\n\n"
-            "💭 **Введите описание жилья:**"
-        )
+        await state_store.set_mode(callback_chat_id(callback), BotMode.REAL_ESTATE)  # Устанавливаем режим поиска жилья
+        await answer_callback(callback)
         
         await callback.message.edit_text(
-            real_estate_text,
+            REAL_ESTATE_PROMPT_TEXT,
             parse_mode="Markdown",
             reply_markup=get_real_estate_keyboard()
         )
@@ -397,20 +2105,11 @@ async def process_real_estate_callback(callback: types.CallbackQuery):
 async def process_back_to_menu(callback: types.CallbackQuery):
     """Обработчик возврата в главное меню"""
     try:
-        global current_mode
-        await callback.answer()
-        current_mode = BotMode.IDLE  # Возвращаемся в главное меню
-        
-        welcome_text = (
-            "🌟 **Главное меню** 🌟\n\n"
-            "🎯 **Выберите нужную функцию:**\n\n"
-            "🌤️ **Прогноз погоды** - узнайте погоду в любом городе\n"
-            "🛒 **Поиск товаров** - найдите нужные товары по выгодным ценам\n"
-            "🏠 **Поиск жилья** - подберите квартиру или дом для покупки/аренды"
-        )
+        await state_store.set_mode(callback_chat_id(callback), BotMode.IDLE)  # Возвращаемся в главное меню
+        await answer_callback(callback)
         
         await callback.message.edit_text(
-            welcome_text,
+            MENU_TEXT,
             parse_mode="Markdown",
             reply_markup=get_main_keyboard()
         )
@@ -420,21 +2119,28 @@ async def process_back_to_menu(callback: types.CallbackQuery):
         logger.error(f"Ошибка при возврате в главное меню: {e}")
 
 # Универсальный обработчик текстовых сообщений
-@dp.message(F.content_type == ContentType.TEXT)
+@dp.message(F.content_type == ContentType.TEXT, ~F.text.startswith('/'))
 async def process_text_message(message: types.Message):
-    """Обработчик текстовых сообщений в зависимости от текущего режима"""
+    """Обработчик текстовых сообщений в зависимости от режима чата"""
     try:
-        global current_mode
-        
         text = message.text.strip()
-        
-        # Проверяем, что это не команда
-        if text.startswith('/'):
-            return
+        current_mode = await state_store.get_mode(message.chat.id)
         
         # Обрабатываем сообщения в зависимости от текущего режима
         if current_mode == BotMode.WEATHER:
-            await process_weather_city_logic(message, text)
+            city_names = split_city_list(text)
+            if len(city_names) > 1:
+                await process_weather_compare_logic(message, city_names)
+            elif city_names:
+                # Повторы одного города ("Москва, москва") схлопываются в один запрос
+                await process_weather_city_logic(message, city_names[0])
+            else:
+                # Одни разделители - названия нет, напоминаем, что ввести
+                await message.answer(
+                    WEATHER_PROMPT_TEXT,
+                    parse_mode="Markdown",
+                    reply_markup=get_weather_keyboard()
+                )
         elif current_mode == BotMode.PRODUCTS:
             await process_products_search_logic(message, text)
         elif current_mode == BotMode.REAL_ESTATE:
@@ -442,71 +2148,715 @@ async def process_text_message(message: types.Message):
         else:
             # Если мы в главном меню или другом режиме, показываем подсказку
             await message.answer(
-                "🤔 **Используйте кнопки для навигации** 🤔\n\n"
-                "👇 Выберите нужную функцию ниже:",
+                NAVIGATION_HINT_TEXT,
                 parse_mode="Markdown",
                 reply_markup=get_main_keyboard()
             )
         
     except Exception as e:
         logger.error(f"Ошибка при обработке текстового сообщения: {e}")
+        reply_failed.set(True)
+
+# Упреждающее обновление прогнозов для популярных городов
+class WeatherRefresher:
+    """Считает популярность координат и обновляет их прогнозы незадолго до устаревания"""
+    
+    MAX_TRACKED = 10000  # Ограничение числа отслеживаемых координат
+    MIN_SCORE = 2.0      # Разовые запросы не греем
+    
+    def __init__(self, ahead, budget, top, interval, half_life):
+        self.ahead = ahead
+        self.budget = budget
+        self.top = top
+        self.interval = interval
+        # Популярность затухает вдвое за время жизни записи кэша
+        self.decay = 0.5 ** (interval / max(half_life, interval))
+        self.refreshed = 0
+        self._scores = {}   # ключ кэша -> популярность
+        self._window_start = time.monotonic()
+        self._window_calls = 0
+    
+    def record(self, lat, lon):
+        """Учитывает запрос погоды для координат"""
+        key = weather_cache_key(lat, lon)
+        self._scores[key] = self._scores.get(key, 0.0) + 1.0
+    
+    def _decay(self):
+        """Снижает популярность со временем и забывает редкие координаты"""
+        scores = {key: score * self.decay for key, score in self._scores.items() if score * self.decay >= 0.1}
+        if len(scores) > self.MAX_TRACKED:
+            scores = dict(sorted(scores.items(), key=lambda item: -item[1])[:self.MAX_TRACKED])
+        self._scores = scores
+    
+    def _take_budget(self):
+        """Списывает один запрос из бюджета на текущую минуту"""
+        now = time.monotonic()
+        if now - self._window_start >= 60:
+            self._window_start = now
+            self._window_calls = 0
+        if self._window_calls >= self.budget:
+            return False
+        self._window_calls += 1
+        return True
+    
+    async def refresh_due(self):
+        """Обновляет популярные прогнозы, которые скоро устареют"""
+        hot = sorted(self._scores.items(), key=lambda item: -item[1])[:self.top]
+        tasks = []
+        for key, score in hot:
+            if score < self.MIN_SCORE or key in weather_inflight:
+                continue
+            remaining = weather_cache.expires_in(key)
+            if remaining is not None and remaining > self.ahead:
+                continue
+            if not self._take_budget():
+                break
+            tasks.append(start_weather_load(key))
+        
+        if tasks:
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            self.refreshed += sum(1 for result in results if isinstance(result, dict))
+            logger.info(f"Упреждающее обновление погоды: {len(tasks)} координат")
+        self._decay()
+    
+    async def run(self):
+        """Фоновый цикл упреждающего обновления"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.refresh_due()
+            except Exception as e:
+                logger.error(f"Ошибка упреждающего обновления погоды: {e}")
+
+weather_refresher = WeatherRefresher(
+    WEATHER_REFRESH_AHEAD,
+    WEATHER_REFRESH_BUDGET,
+    WEATHER_REFRESH_TOP,
+    WEATHER_REFRESH_INTERVAL,
+    WEATHER_CACHE_TTL
+)
+
+# Графики температуры: отрисовка PNG без сторонних библиотек
+CHART_WIDTH = 800
+CHART_HEIGHT = 520
+CHART_BACKGROUND = (255, 255, 255)
+CHART_GRID = (226, 230, 236)
+CHART_TEXT = (70, 74, 82)
+CHART_HOURLY_LINE = (235, 120, 35)
+CHART_DAY_WARM = (226, 92, 72)
+CHART_DAY_COLD = (66, 133, 214)
+CHART_ZERO = (150, 156, 166)
+
+# Шрифт 5x7 для подписей: только цифры и знаки
+CHART_FONT = {
+    '0': ('01110', '10001', '10011', '10101', '11001', '10001', '01110'),
+    '1': ('00100', '01100', '00100', '00100', '00100', '00100', '01110'),
+    '2': ('01110', '10001', '00001', '00010', '00100', '01000', '11111'),
+    '3': ('11110', '00001', '00001', '01110', '00001', '00001', '11110'),
+    '4': ('00010', '00110', '01010', '10010', '11111', '00010', '00010'),
+    '5': ('11111', '10000', '11110', '00001', '00001', '10001', '01110'),
+    '6': ('00110', '01000', '10000', '11110', '10001', '10001', '01110'),
+    '7': ('11111', '00001', '00010', '00100', '01000', '01000', '01000'),
+    '8': ('01110', '10001', '10001', '01110', '10001', '10001', '01110'),
+    '9': ('01110', '10001', '10001', '01111', '00001', '00010', '01100'),
+    '-': ('00000', '00000', '00000', '11111', '00000', '00000', '00000'),
+    '+': ('00000', '00100', '00100', '11111', '00100', '00100', '00000'),
+    '.': ('00000', '00000', '00000', '00000', '00000', '01100', '01100'),
+    ':': ('00000', '01100', '01100', '00000', '01100', '01100', '00000'),
+    '°': ('01100', '10010', '10010', '01100', '00000', '00000', '00000'),
+    ' ': ('00000',) * 7,
+}
+
+class Canvas:
+    """RGB-холст в bytearray с простыми примитивами и кодированием в PNG"""
+    
+    def __init__(self, width, height, background):
+        self.width = width
+        self.height = height
+        self.pixels = bytearray(bytes(background) * (width * height))
+    
+    def fill_rect(self, x0, y0, x1, y1, color):
+        """Закрашивает прямоугольник [x0, x1) x [y0, y1)"""
+        x0, x1 = max(0, min(x0, x1)), min(self.width, max(x0, x1))
+        y0, y1 = max(0, min(y0, y1)), min(self.height, max(y0, y1))
+        if x0 >= x1:
+            return
+        row = bytes(color) * (x1 - x0)
+        for y in range(y0, y1):
+            start = (y * self.width + x0) * 3
+            self.pixels[start:start + len(row)] = row
+    
+    def line(self, x0, y0, x1, y1, color, width=1):
+        """Отрезок алгоритмом Брезенхэма толщиной width пикселей"""
+        dx, dy = abs(x1 - x0), -abs(y1 - y0)
+        sx, sy = (1 if x0 < x1 else -1), (1 if y0 < y1 else -1)
+        error = dx + dy
+        half = width // 2
+        while True:
+            self.fill_rect(x0 - half, y0 - half, x0 - half + width, y0 - half + width, color)
+            if x0 == x1 and y0 == y1:
+                return
+            doubled = 2 * error
+            if doubled >= dy:
+                error += dy
+                x0 += sx
+            if doubled <= dx:
+                error += dx
+                y0 += sy
+    
+    def text(self, x, y, text, color, scale=2, align='left'):
+        """Подпись шрифтом 5x7; align - left, center или right относительно x"""
+        advance = 6 * scale
+        if align == 'center':
+            x -= len(text) * advance // 2
+        elif align == 'right':
+            x -= len(text) * advance
+        for char in text:
+            for row, bits in enumerate(CHART_FONT.get(char, CHART_FONT[' '])):
+                for column, bit in enumerate(bits):
+                    if bit == '1':
+                        self.fill_rect(x + column * scale, y + row * scale,
+                                       x + (column + 1) * scale, y + (row + 1) * scale, color)
+            x += advance
+    
+    def to_png(self):
+        """Кодирует холст в PNG (8 бит на канал, без фильтров строк)"""
+        stride = self.width * 3
+        raw = b"".join(b"\x00" + self.pixels[y * stride:(y + 1) * stride] for y in range(self.height))
+        
+        def chunk(kind, data):
+            return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+        
+        header = struct.pack(">IIBBBBB", self.width, self.height, 8, 2, 0, 0, 0)
+        return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw, 6)) + chunk(b"IEND", b"")
+
+def format_degrees(value):
+    return f"{value:+d}°" if value else "0°"
+
+def chart_scale(values, top, bottom):
+    """Функция перевода температуры в координату y и шаг сетки"""
+    low, high = min(values), max(values)
+    step = 2 if high - low <= 10 else 5 if high - low <= 30 else 10
+    low, high = (low // step) * step, -(-high // step) * step
+    if high == low:
+        high += step
+    return (lambda value: bottom - round((value - low) * (bottom - top) / (high - low))), low, high, step
+
+def draw_grid(canvas, to_y, low, high, step, left, right):
+    """Горизонтальная сетка с подписями температур и линией нуля"""
+    for value in range(low, high + 1, step):
+        y = to_y(value)
+        canvas.line(left, y, right, y, CHART_ZERO if value == 0 else CHART_GRID)
+        canvas.text(left - 8, y - 7, format_degrees(value), CHART_TEXT, align='right')
+
+def render_forecast_chart(hourly, daily):
+    """Рисует PNG: сверху температура по часам, снизу минимум и максимум по дням.
+    
+    hourly - [(час, температура), ...], daily - [(дата ДД.ММ, минимум, максимум), ...].
+    Выполняется в процессе отрисовки, поэтому работает только с переданными данными."""
+    canvas = Canvas(CHART_WIDTH, CHART_HEIGHT, CHART_BACKGROUND)
+    left, right = 80, CHART_WIDTH - 30
+    
+    # Почасовой прогноз
+    if hourly:
+        top, bottom = 30, 220
+        to_y, low, high, step = chart_scale([temp for _, temp in hourly], top, bottom)
+        draw_grid(canvas, to_y, low, high, step, left, right)
+        span = max(1, len(hourly) - 1)
+        points = [(left + index * (right - left) // span, to_y(temp)) for index, (_, temp) in enumerate(hourly)]
+        for (x0, y0), (x1, y1) in zip(points, points[1:]):
+            canvas.line(x0, y0, x1, y1, CHART_HOURLY_LINE, width=3)
+        for index, ((hour, temp), (x, y)) in enumerate(zip(hourly, points)):
+            canvas.fill_rect(x - 3, y - 3, x + 4, y + 4, CHART_HOURLY_LINE)
+            if index % 3 == 0:
+                canvas.text(x, bottom + 12, f"{int(hour):02d}:00", CHART_TEXT, align='center')
+    
+    # Прогноз по дням
+    if daily:
+        top, bottom = 300, 455
+        to_y, low, high, step = chart_scale([value for _, low_temp, high_temp in daily for value in (low_temp, high_temp)], top, bottom)
+        draw_grid(canvas, to_y, low, high, step, left, right)
+        slot = (right - left) // len(daily)
+        for index, (day, temp_min, temp_max) in enumerate(daily):
+            center = left + slot * index + slot // 2
+            color = CHART_DAY_WARM if temp_max > 0 else CHART_DAY_COLD
+            canvas.fill_rect(center - 14, to_y(temp_max), center + 14, to_y(temp_min) + 3, color)
+            canvas.text(center, to_y(temp_max) - 20, format_degrees(temp_max), CHART_TEXT, align='center')
+            canvas.text(center, to_y(temp_min) + 10, format_degrees(temp_min), CHART_TEXT, align='center')
+            canvas.text(center, bottom + 36, day, CHART_TEXT, align='center')
+    
+    return canvas.to_png()
+
+def chart_series(weather_data):
+    """Данные для графика из ответа API: 24 часа с текущего и до 7 дней"""
+    offset = weather_data.get('info', {}).get('tzinfo', {}).get('offset', 0)
+    current_hour = datetime.fromtimestamp(weather_data.get('now', time.time()) + offset, timezone.utc).hour
+    hours = [hour for forecast in weather_data.get('forecasts', [])[:2] for hour in forecast.get('hours', [])]
+    hourly = [(int(hour['hour']), hour['temp']) for hour in hours if 'temp' in hour]
+    hourly = hourly[current_hour:current_hour + 24] if len(hourly) > current_hour else hourly[:24]
+    
+    daily = []
+    for forecast in weather_data.get('forecasts', [])[:7]:
+        day_part = forecast.get('parts', {}).get('day', {})
+        date_parts = forecast.get('date', '').split('-')
+        if day_part and len(date_parts) >= 3:
+            daily.append((f"{date_parts[2]}.{date_parts[1]}", day_part.get('temp_min', 0), day_part.get('temp_max', 0)))
+    return hourly, daily
+
+# Пул процессов отрисовки (создается при запуске) и кэши готовых графиков
+chart_pool = None
+chart_log_listener = None  # Поток главного процесса, пишущий записи логов процессов отрисовки
+chart_images = TTLCache(CHART_CACHE_SIZE, WEATHER_CACHE_TTL * 2)    # (широта, долгота, версия прогноза) -> PNG
+chart_file_ids = TTLCache(CHART_CACHE_SIZE, WEATHER_CACHE_TTL * 2)  # (широта, долгота, версия прогноза) -> file_id в Telegram
+chart_inflight = {}
+
+def forward_logs_to_parent(log_queue):
+    """Инициализатор процесса отрисовки: записи логов уходят главному процессу, файл пишет только он"""
+    log_writer.stop()
+    logging.getLogger().handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+
+async def start_chart_pool():
+    """Запускает процессы отрисовки заранее, чтобы первый график не ждал их запуска"""
+    global chart_pool, chart_log_listener
+    if not WEATHER_CHARTS or chart_pool is not None:
+        return
+    # Процессы запускаются при первых задачах, по имени процесса они не открывают свой файл логов
+    os.environ['BOT_PROCESS_NAME'] = 'charts'
+    try:
+        # multiprocessing импортируется только здесь, чтобы не замедлять запуск бота
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        context = multiprocessing.get_context('spawn')
+        log_queue = context.Queue()
+        chart_log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+        chart_log_listener.start()
+        chart_pool = ProcessPoolExecutor(
+            CHART_WORKERS, mp_context=context, initializer=forward_logs_to_parent, initargs=(log_queue,)
+        )
+        # Пустой график: процесс заодно загружает модуль бота с функцией отрисовки
+        warmups = [asyncio.wrap_future(chart_pool.submit(render_forecast_chart, [], [])) for _ in range(CHART_WORKERS)]
+    finally:
+        del os.environ['BOT_PROCESS_NAME']
+    await asyncio.gather(*warmups)
+    logger.info(f"Процессы отрисовки графиков запущены: {CHART_WORKERS}")
+
+def close_chart_pool():
+    """Останавливает процессы отрисовки"""
+    global chart_pool, chart_log_listener
+    if chart_pool is not None:
+        chart_pool.shutdown(wait=False, cancel_futures=True)
+        chart_pool = None
+    if chart_log_listener is not None:
+        chart_log_listener.stop()
+        chart_log_listener = None
+
+async def render_chart(key, weather_data):
+    """PNG графика из кэша или из процесса отрисовки; одновременные запросы делят одну отрисовку"""
+    from concurrent.futures.process import BrokenProcessPool  # Модуль уже загружен вместе с пулом
+    image = chart_images.get(key)
+    if image is not None:
+        return image
+    task = chart_inflight.get(key)
+    if task is None:
+        hourly, daily = chart_series(weather_data)
+        task = asyncio.wrap_future(chart_pool.submit(render_forecast_chart, hourly, daily))
+        chart_inflight[key] = task
+        task.add_done_callback(lambda _: chart_inflight.pop(key, None))
+    try:
+        image = await asyncio.shield(task)
+    except BrokenProcessPool:
+        # Процесс отрисовки упал - пул больше не принимает задачи, создаем новый
+        logger.error("Пул отрисовки графиков сломан, перезапускаю")
+        close_chart_pool()
+        background_tasks.append(asyncio.create_task(start_chart_pool()))
+        raise
+    chart_images.set(key, image)
+    return image
+
+async def send_weather_chart(message, city_name, lat, lon, weather_data):
+    """Отправляет график: повторно - по file_id без отрисовки и загрузки"""
+    if chart_pool is None or not weather_data.get('forecasts'):
+        return
+    # График зависит только от прогноза, а не от подписи: у геопозиций в ней расстояние или координаты
+    key = (*weather_cache_key(lat, lon), weather_data.get('now'))
+    caption = CHART_CAPTION_TEMPLATE.format(city=city_name)
+    file_id = chart_file_ids.get(key)
+    if file_id is not None:
+        await message.answer_photo(file_id, caption=caption)
+        return
+    image = await render_chart(key, weather_data)
+    sent = await message.answer_photo(BufferedInputFile(image, filename='forecast.png'), caption=caption)
+    chart_file_ids.set(key, sent.photo[-1].file_id)
+
+# Логика обработки запроса погоды
+@observe_latency
+async def process_weather_city_logic(message: types.Message, city_name: str):
+    """Логика обработки запроса погоды"""
+    try:
+        # Ищем город в справочнике
+        city = find_city(city_name)
+        
+        if not city:
+            await message.answer(
+                CITY_NOT_FOUND_TEMPLATE.format(city=city_name),
+                parse_mode="Markdown",
+                reply_markup=get_weather_keyboard()
+            )
+            return
+        
+        await answer_weather(message, city.name, city.lat, city.lon)
+            
+    except Exception as e:
+        logger.error(f"Ошибка при обработке запроса погоды для города {city_name}: {e}")
+        reply_failed.set(True)
+        await message.answer(
+            WEATHER_ERROR_TEXT,
+            parse_mode="Markdown",
+            reply_markup=get_weather_keyboard()
+        )
+
+async def answer_weather(message: types.Message, place_name: str, lat, lon):
+    """Получает прогноз для точки и отвечает текстом и графиком"""
+    weather_refresher.record(lat, lon)
+    weather_data = await get_weather_forecast(lat, lon)
+    
+    if weather_data:
+        weather_message = format_weather_message(weather_data, place_name)
+        await message.answer(
+            weather_message,
+            parse_mode="Markdown",
+            reply_markup=get_weather_keyboard()
+        )
+        logger.info(f"Прогноз погоды отправлен пользователю {message.from_user.id} для {place_name}")
+        try:
+            await send_weather_chart(message, place_name, lat, lon, weather_data)
+        except Exception as e:
+            logger.error(f"Не удалось отправить график погоды для {place_name}: {e}")
+    else:
+        reply_failed.set(True)
+        await message.answer(
+            WEATHER_UNAVAILABLE_TEXT,
+            reply_markup=get_weather_keyboard()
+        )
+
+# Прогноз по отправленной геопозиции
+@dp.message(F.location)
+async def process_location_message(message: types.Message):
+    """Геопозиция в режиме погоды: прогноз для ближайшего населенного пункта"""
+    try:
+        if await state_store.get_mode(message.chat.id) != BotMode.WEATHER:
+            await unknown_message(message)
+            return
+        
+        lat, lon = message.location.latitude, message.location.longitude
+        nearest = gazetteer.nearest(lat, lon, LOCATION_MAX_DISTANCE)
+        if nearest is None:
+            place_name = LOCATION_POINT_TEMPLATE.format(lat=lat, lon=lon)
+        else:
+            city, distance = nearest
+            place_name = city.name if distance < LOCATION_SAME_PLACE_KM else LOCATION_NEAR_TEMPLATE.format(city=city.name, distance=distance)
+        # Прогноз - для самой точки (точнее, ее ячейки сетки), а не для центра найденного пункта
+        await answer_weather(message, place_name, lat, lon)
+    
+    except Exception as e:
+        logger.error(f"Ошибка при обработке геопозиции: {e}")
+        await message.answer(
+            WEATHER_ERROR_TEXT,
+            parse_mode="Markdown",
+            reply_markup=get_weather_keyboard()
+        )
 
-# Логика обработки запроса погоды
-async def process_weather_city_logic(message: types.Message, city_name: str):
-    """Логика обработки запроса погоды"""
+# Сравнение погоды в нескольких городах
+CITY_LIST_SEPARATORS = re.compile(r'[,;\n]+')
+
+def split_city_list(text):
+    """Разбивает перечисление городов через запятую, точку с запятой или с новой строки"""
+    names = []
+    seen = set()
+    for part in CITY_LIST_SEPARATORS.split(text):
+        name = part.strip()
+        if name and name.casefold() not in seen:
+            seen.add(name.casefold())
+            names.append(name)
+    return names
+
+def format_weather_comparison(rows, missing, truncated):
+    """Форматирует таблицу сравнения: rows - [(название города, прогноз или None), ...]"""
+    lines = [render_weather_compare_row(city="Город", now="Сейчас", tomorrow="Завтра")]
+    for city_name, weather_data in rows:
+        now = tomorrow = "—"
+        if weather_data and 'fact' in weather_data:
+            now = format_degrees(weather_data['fact'].get('temp', 0))
+            forecasts = weather_data.get('forecasts', [])
+            day_part = forecasts[1].get('parts', {}).get('day', {}) if len(forecasts) > 1 else {}
+            if day_part:
+                tomorrow = f"{format_degrees(day_part.get('temp_min', 0))}..{format_degrees(day_part.get('temp_max', 0))}"
+        lines.append(render_weather_compare_row(city=city_name[:14], now=now, tomorrow=tomorrow))
+    
+    parts = [WEATHER_COMPARE_HEADER, "```\n", "".join(lines), "```\n"]
+    if missing:
+        parts.append(WEATHER_COMPARE_NOT_FOUND_TEMPLATE.format(cities=escape_markdown(", ".join(missing))))
+    if truncated:
+        parts.append(WEATHER_COMPARE_LIMIT_TEMPLATE.format(count=WEATHER_COMPARE_MAX))
+    return "".join(parts)
+
+# Логика сравнения погоды (в гистограмме - отдельной меткой, по имени функции)
+@observe_latency
+async def process_weather_compare_logic(message: types.Message, city_names):
+    """Логика сравнения погоды: прогнозы всех городов запрашиваются одновременно"""
     try:
-        # Получаем координаты города
-        coords = get_city_coordinates(city_name)
+        truncated = len(city_names) > WEATHER_COMPARE_MAX
+        cities = {}  # (широта, долгота) -> координаты и название; повторы одного города схлопываются
+        missing = []
+        for city_name in city_names[:WEATHER_COMPARE_MAX]:
+            coordinates = get_city_coordinates(city_name)
+            if coordinates is None:
+                missing.append(city_name)
+            else:
+                cities.setdefault((coordinates['lat'], coordinates['lon']), coordinates)
         
-        if not coords:
+        if not cities:
             await message.answer(
-                f"❌ Город '{city_name}' не найден в базе данных.\n\n"
-                "📍 **Попробуйте ввести:**\n"
-                "• Москва\n"
-                "• СПб\n"
-                "• Салехард\n"
-                "• Тюмень\n"
-                "• Самара\n"
-                "• Тольятти\n"
-                "• Новокуйбышевск\n"
-                "• Село Горки\n"
-                "• Село Мордово\n\n"
-                "🔙 Или вернитесь в главное меню:",
+                CITY_NOT_FOUND_TEMPLATE.format(city=escape_markdown(", ".join(missing))),
                 parse_mode="Markdown",
                 reply_markup=get_weather_keyboard()
             )
             return
         
-        # Получаем прогноз погоды
-        weather_data = get_weather_forecast(coords['lat'], coords['lon'])
+        # Общая задержка - как у самого медленного запроса, а не сумма всех
+        slots = asyncio.Semaphore(WEATHER_COMPARE_CONCURRENCY)
         
-        if weather_data:
-            weather_message = format_weather_message(weather_data, city_name)
-            await message.answer(
-                weather_message,
-                parse_mode="Markdown",
-                reply_markup=get_weather_keyboard()
-            )
-            logger.info(f"Прогноз погоды отправлен пользователю {message.from_user.id} для города {city_name}")
-        else:
+        async def load(coordinates):
+            async with slots:
+                weather_refresher.record(coordinates['lat'], coordinates['lon'])
+                return await get_weather_forecast(coordinates['lat'], coordinates['lon'])
+        
+        results = await asyncio.gather(*(load(coordinates) for coordinates in cities.values()), return_exceptions=True)
+        rows = []
+        for coordinates, result in zip(cities.values(), results):
+            if isinstance(result, Exception):
+                logger.error(f"Ошибка прогноза для {coordinates['name']} при сравнении: {result}")
+                result = None
+            rows.append((coordinates['name'], result))
+        
+        if not any(weather_data for _, weather_data in rows):
+            reply_failed.set(True)
             await message.answer(
-                "❌ Не удалось получить данные о погоде.\n\n"
-                "🔄 Попробуйте еще раз или выберите другой город:",
+                WEATHER_UNAVAILABLE_TEXT,
                 reply_markup=get_weather_keyboard()
             )
-            
+            return
+        
+        await message.answer(
+            format_weather_comparison(rows, missing, truncated),
+            parse_mode="Markdown",
+            reply_markup=get_weather_keyboard()
+        )
+        logger.info(f"Сравнение погоды отправлено пользователю {message.from_user.id} для {len(rows)} городов")
+    
     except Exception as e:
-        logger.error(f"Ошибка при обработке запроса погоды для города {city_name}: {e}")
+        logger.error(f"Ошибка при сравнении погоды для {city_names}: {e}")
+        reply_failed.set(True)
         await message.answer(
-            "❌ Произошла ошибка при получении прогноза погоды.\n\n"
-            "🔄 Попробуйте еще раз:",
+            WEATHER_ERROR_TEXT,
             parse_mode="Markdown",
             reply_markup=get_weather_keyboard()
         )
 
+# Поиск товаров на маркетплейсах
+Offer = namedtuple('Offer', ['price', 'title', 'url', 'source'])
+
+class MarketplaceAdapter(ABC):
+    """Источник предложений: подклассы знают адрес и формат ответа своего маркетплейса"""
+    
+    name = ''
+    title = ''
+    default_timeout = 4.0
+    
+    def __init__(self, api_url, timeout=None):
+        self.api_url = api_url
+        self.timeout = timeout or self.default_timeout
+    
+    def is_configured(self):
+        """Хватает ли настроек, чтобы обращаться к API"""
+        return bool(self.api_url)
+    
+    @abstractmethod
+    def search_page(self, query):
+        """Ссылка на поиск на сайте маркетплейса (для кнопки)"""
+    
+    def request(self, query):
+        """Параметры запроса: (params, headers)"""
+        return {'text': query}, {}
+    
+    @abstractmethod
+    def parse(self, data):
+        """Превращает ответ API в список Offer"""
+    
+    async def search(self, session, query):
+        params, headers = self.request(query)
+        async with session.get(self.api_url, params=params, headers=headers) as response:
+            response.raise_for_status()
+            return self.parse(await response.json(content_type=None))
+
+class YandexMarketAdapter(MarketplaceAdapter):
+    """Партнерский Content API Яндекс.Маркета"""
+    
+    name = 'yandex_market'
+    title = 'Яндекс.Маркет'
+    
+    def is_configured(self):
+        # Официальный API требует ключ; локальной заглушке он не нужен
+        return bool(self.api_url) and (bool(YANDEX_MARKET_API_KEY) or 'api.content.market.yandex.ru' not in self.api_url)
+    
+    def search_page(self, query):
+        return f"https://market.yandex.ru/search?text={quote(query)}"
+    
+    def request(self, query):
+        headers = {'Authorization': YANDEX_MARKET_API_KEY} if YANDEX_MARKET_API_KEY else {}
+        return {'text': query, 'geo_id': 213, 'count': MARKETPLACE_RESULTS}, headers
+    
+    def parse(self, data):
+        offers = []
+        for item in data.get('items', []):
+            price = (item.get('price') or {}).get('min') or (item.get('price') or {}).get('value')
+            if price:
+                offers.append(Offer(float(price), item.get('name', ''), item.get('link') or self.search_page(item.get('name', '')), self.title))
+        return offers
+
+class OzonAdapter(MarketplaceAdapter):
+    """Ozon: публичного API поиска нет, адрес указывает на свой прокси или партнерскую выгрузку
+    с ответом вида {"items": [{"title", "price", "url"}]}"""
+    
+    name = 'ozon'
+    title = 'Ozon'
+    default_timeout = 5.0
+    
+    def search_page(self, query):
+        return f"https://www.ozon.ru/search/?text={quote(query)}"
+    
+    def parse(self, data):
+        return [
+            Offer(float(item['price']), item.get('title', ''), item.get('url') or self.search_page(item.get('title', '')), self.title)
+            for item in data.get('items', []) if item.get('price')
+        ]
+
+class WildberriesAdapter(MarketplaceAdapter):
+    """Публичный поиск Wildberries (цены в копейках)"""
+    
+    name = 'wildberries'
+    title = 'Wildberries'
+    default_timeout = 3.0
+    
+    def search_page(self, query):
+        return f"https://www.wildberries.ru/catalog/0/search.aspx?search={quote(query)}"
+    
+    def request(self, query):
+        return {
+            'query': query, 'resultset': 'catalog', 'sort': 'popular',
+            'appType': 1, 'curr': 'rub', 'dest': -1257786
+        }, {}
+    
+    def parse(self, data):
+        offers = []
+        products = (data.get('data') or data).get('products', [])
+        for product in products:
+            sizes = product.get('sizes') or [{}]
+            price = (sizes[0].get('price') or {}).get('product') or product.get('salePriceU')
+            if price:
+                title = f"{product['brand']} {product.get('name', '')}" if product.get('brand') else product.get('name', '')
+                offers.append(Offer(price / 100, title, f"https://www.wildberries.ru/catalog/{product['id']}/detail.aspx", self.title))
+        return offers
+
+MARKETPLACE_ADAPTERS = {adapter.name: adapter for adapter in (YandexMarketAdapter, OzonAdapter, WildberriesAdapter)}
+MARKETPLACE_API_URLS = {'yandex_market': YANDEX_MARKET_API_URL, 'ozon': OZON_API_URL, 'wildberries': WILDBERRIES_API_URL}
+
+def create_marketplaces():
+    """Создает включенные в MARKETPLACES источники со сроками ответа из MARKETPLACE_TIMEOUTS"""
+    timeouts = {}
+    for item in MARKETPLACE_TIMEOUTS.split(','):
+        if '=' in item:
+            name, seconds = item.split('=', 1)
+            timeouts[name.strip()] = float(seconds)
+    sources = []
+    for name in MARKETPLACES:
+        adapter_class = MARKETPLACE_ADAPTERS.get(name)
+        if adapter_class is None:
+            logger.warning(f"Неизвестный маркетплейс в MARKETPLACES: {name}")
+            continue
+        adapter = adapter_class(MARKETPLACE_API_URLS[name], timeouts.get(name))
+        if not adapter.is_configured():
+            logger.info(f"Поиск на {adapter.title} отключен: не заданы адрес или ключ API")
+        sources.append(adapter)
+    return sources
+
+marketplaces = create_marketplaces()
+
+def format_products_prompt(sources):
+    """Подсказка режима товаров: обещаем сравнение только на маркетплейсах, где поиск настроен"""
+    titles = [adapter.title for adapter in sources if adapter.is_configured()]
+    if len(titles) > 1:
+        line = PRODUCTS_COMPARE_SOURCES.format(sources=f"{', '.join(titles[:-1])} и {titles[-1]}")
+    elif titles:
+        line = PRODUCTS_SINGLE_SOURCE.format(source=titles[0])
+    else:
+        line = PRODUCTS_NO_SOURCES
+    return PRODUCTS_PROMPT_TEMPLATE.format(sources=line)
+
+PRODUCTS_PROMPT_TEXT = format_products_prompt(marketplaces)
+marketplace_latency = Histogram('marketplace_search_duration_seconds', 'Время поиска на маркетплейсах', 'source')
+marketplace_results = Counter()  # (источник, итог) -> число поисков
+
+async def search_marketplace(adapter, query):
+    """Ищет на одном маркетплейсе в пределах его срока: (адаптер, предложения, итог)"""
+    started = time.perf_counter()
+    status = 'ok'
+    offers = []
+    try:
+        session = await start_market_client()
+        offers = await asyncio.wait_for(adapter.search(session, query), adapter.timeout)
+    except asyncio.TimeoutError:
+        status = 'timeout'
+    except Exception as e:
+        status = 'error'
+        logger.error(f"Ошибка поиска '{query}' на {adapter.title}: {e}")
+    finally:
+        marketplace_latency.observe(adapter.name, time.perf_counter() - started)
+        marketplace_results[adapter.name, status] += 1
+    return adapter, offers, status
+
+def escape_markdown(text):
+    """Экранирует служебные символы Markdown в тексте от маркетплейсов"""
+    return re.sub(r'([_*`\[])', r'\\\1', text)
+
+def format_products_message(query, offers, statuses):
+    """Сообщение с самыми дешевыми предложениями и состоянием каждого источника"""
+    lines = [PRODUCTS_RESULTS_HEADER.format(query=escape_markdown(query))]
+    for number, offer in enumerate(sorted(offers)[:MARKETPLACE_RESULTS], 1):
+        title = escape_markdown(offer.title[:80].replace('[', '(').replace(']', ')'))
+        lines.append(render_product_offer(number=number, price=f"{offer.price:,.0f}".replace(',', ' '),
+                                          title=title, url=offer.url, source=offer.source))
+    if not offers and all(status is not None for status, _ in statuses.values()):
+        lines.append(PRODUCTS_NOT_FOUND_TEXT)
+    lines.append("")
+    for title, (status, count) in statuses.items():
+        lines.append(PRODUCTS_SOURCE_STATUS[status].format(source=title, count=count))
+    return "\n".join(lines)
+
+def get_marketplaces_keyboard(query):
+    """Кнопки-ссылки на поиск в каждом магазине и кнопка возврата в меню"""
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text=f"🛒 {adapter.title}", url=adapter.search_page(query))]
+            for adapter in marketplaces
+        ] + [[BACK_TO_MENU_BUTTON]]
+    )
+
 # Логика поиска товаров
+@observe_latency
 async def process_products_search_logic(message: types.Message, product_query: str):
     """Логика поиска товаров"""
+    pending = set()
     try:
         if not product_query:
             await message.answer(
@@ -516,56 +2866,204 @@ async def process_products_search_logic(message: types.Message, product_query: s
             )
             return
         
-        # Формируем ссылку на Яндекс.Маркет
-        from urllib.parse import quote
-        encoded_query = quote(product_query)
-        market_url = f"https://market.yandex.ru/search?text={encoded_query}"
-        
-        # Отправляем ссылку с описанием
-        response_text = (
-            f"🛒 **Результаты поиска: {product_query}** 🛒\n\n"
-            f"🔗 **Откройте Яндекс.Маркет для просмотра результатов:**\n"
-            f"{market_url}\n\n"
-            f"📊 **На Яндекс.Маркет вы сможете:**\n"
-            f"• Сравнить цены разных продавцов\n"
-            f"• Читать отзывы покупателей\n"
-            f"• Выбрать удобный способ доставки\n"
-            f"• Найти лучшие предложения\n\n"
-            f"💡 **Совет:** Откройте ссылку в браузере на вашем устройстве!"
-        )
-        
-        # Inline кнопка для быстрого перехода
-        keyboard = InlineKeyboardMarkup(
-            inline_keyboard=[
-                [
-                    InlineKeyboardButton(
-                        text="🛒 Открыть Яндекс.Маркет", 
-                        url=market_url
-                    )
-                ],
-                [
-                    InlineKeyboardButton(text="🔙 Назад в меню", callback_data="back_to_menu")
-                ]
-            ]
-        )
-        
-        await message.answer(
-            response_text,
+        # Опрашиваем все источники сразу и дополняем сообщение по мере ответов:
+        # медленный маркетплейс не задерживает результаты быстрых
+        sources = [adapter for adapter in marketplaces if adapter.is_configured()]
+        statuses = {adapter.title: (None, 0) for adapter in sources}
+        keyboard = get_marketplaces_keyboard(product_query)
+        reply = await message.answer(
+            format_products_message(product_query, [], statuses),
             parse_mode="Markdown",
-            reply_markup=keyboard
+            reply_markup=keyboard,
+            disable_web_page_preview=True
         )
+        
+        offers = []
+        pending = {asyncio.create_task(search_marketplace(adapter, product_query)) for adapter in sources}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                adapter, found, status = task.result()
+                offers.extend(found)
+                statuses[adapter.title] = (status, len(found))
+            # Неудачная правка не прерывает поиск: следующая покажет накопленные результаты
+            try:
+                await reply.edit_text(
+                    format_products_message(product_query, offers, statuses),
+                    parse_mode="Markdown",
+                    reply_markup=keyboard,
+                    disable_web_page_preview=True
+                )
+            except Exception as e:
+                logger.warning(f"Не удалось обновить результаты поиска товара {product_query}: {e}")
         logger.info(f"Поиск товара '{product_query}' для пользователя {message.from_user.id}")
         
     except Exception as e:
         logger.error(f"Ошибка при поиске товара {product_query}: {e}")
+        reply_failed.set(True)
         await message.answer(
             "❌ Произошла ошибка при поиске товара.\n\n"
             "🔄 Попробуйте еще раз:",
             parse_mode="Markdown",
             reply_markup=get_products_keyboard()
         )
+    finally:
+        # Ошибка или отмена на середине: незавершенные запросы к маркетплейсам не должны работать впустую
+        for task in pending:
+            task.cancel()
+
+# Объявления о жилье: потоковый разбор выдачи Авито и постраничный показ
+Listing = namedtuple('Listing', ['title', 'price', 'address', 'url'])
+
+class ListingParser(HTMLParser):
+    """Потоковый разбор страницы выдачи Авито: HTML подается кусками по мере загрузки,
+    из разметки берутся только поля карточек (атрибуты data-marker)"""
+    
+    def __init__(self, base_url):
+        super().__init__(convert_charrefs=True)
+        self.base_url = base_url
+        self.listings = []
+        self._item = None       # Поля текущей карточки
+        self._capture = None    # Поле, в которое пишется ближайший текст
+        self._text = []         # Куски этого текста: он может прийти разрезанным на границе куска HTML
+    
+    def _finish_item(self):
+        item = self._item
+        if item and item.get('title') and item.get('url'):
+            self.listings.append(Listing(
+                item['title'], item.get('price') or 'цена не указана', item.get('address') or '-', item['url']
+            ))
+        self._item = None
+    
+    def _flush_text(self):
+        """Текст закончился на теге: сохраняем его, если он не пустой"""
+        if self._capture is not None:
+            text = " ".join("".join(self._text).split())
+            if text and self._item is not None:
+                self._item.setdefault(self._capture, text)
+                self._capture = None
+        self._text = []
+    
+    def handle_starttag(self, tag, attrs):
+        self._flush_text()
+        attrs = dict(attrs)
+        marker = attrs.get('data-marker')
+        if marker == 'item':
+            self._finish_item()
+            self._item = {}
+        if self._item is None:
+            return
+        if marker == 'item-title':
+            self._item['url'] = urljoin(self.base_url, attrs.get('href', ''))
+            if attrs.get('title'):
+                self._item['title'] = attrs['title']
+            else:
+                self._capture = 'title'
+        elif marker == 'item-price':
+            self._capture = 'price'
+        elif marker == 'item-address':
+            self._capture = 'address'
+    
+    def handle_endtag(self, tag):
+        self._flush_text()
+    
+    def handle_data(self, data):
+        if self._capture is not None:
+            self._text.append(data)
+    
+    def close(self):
+        super().close()
+        self._flush_text()
+        self._finish_item()
+
+listings_cache = TTLCache(REAL_ESTATE_CACHE_SIZE, REAL_ESTATE_CACHE_TTL)
+
+async def fetch_listings_page(query, source_page):
+    """Загружает одну страницу выдачи и разбирает ее по мере получения"""
+    session = await start_market_client()
+    parser = ListingParser(REAL_ESTATE_URL)
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    params = {'q': query, 'p': source_page}
+    async with session.get(REAL_ESTATE_URL, params=params, timeout=aiohttp.ClientTimeout(total=REAL_ESTATE_TIMEOUT)) as response:
+        response.raise_for_status()
+        async for chunk in response.content.iter_chunked(16384):
+            parser.feed(decoder.decode(chunk))
+    parser.feed(decoder.decode(b'', final=True))
+    parser.close()
+    return parser.listings
+
+async def get_listings(query, count):
+    """Возвращает не меньше count объявлений (если они есть), дозагружая страницы выдачи через кэш.
+    Второй элемент - True, если выдача закончилась"""
+    listings = []
+    for source_page in range(1, REAL_ESTATE_MAX_PAGES + 1):
+        key = (query.lower(), source_page)
+        page = listings_cache.get(key)
+        if page is None:
+            page = await fetch_listings_page(query, source_page)
+            listings_cache.set(key, page)
+        if not page:
+            return listings, True
+        listings.extend(page)
+        if len(listings) >= count:
+            return listings, False
+    return listings, True
+
+class RealEstatePage(CallbackData, prefix='re'):
+    """Курсор выдачи в callback_data (до 64 байт): номер страницы и короткий ключ запроса"""
+    page: int
+    key: str
+
+# Полный текст запроса живет в боте, в callback_data - только его ключ
+listing_queries = TTLCache(REAL_ESTATE_QUERY_CACHE_SIZE, REAL_ESTATE_QUERY_TTL)  # ключ -> запрос
+
+def remember_listing_query(query):
+    """Запоминает запрос (продлевая срок) и возвращает его ключ для курсора"""
+    key = hashlib.blake2b(query.casefold().encode('utf-8'), digest_size=8).hexdigest()
+    listing_queries.set(key, query)
+    return key
+
+def format_listings_message(query, listings, page):
+    """Сообщение со страницей объявлений"""
+    first = page * REAL_ESTATE_PAGE_SIZE
+    shown = listings[first:first + REAL_ESTATE_PAGE_SIZE]
+    lines = [REAL_ESTATE_LISTINGS_HEADER.format(
+        query=escape_markdown(query), page=page + 1, first=first + 1, last=first + len(shown)
+    ), ""]
+    for number, listing in enumerate(shown, first + 1):
+        lines.append(render_listing(
+            number=number,
+            price=escape_markdown(listing.price),
+            title=escape_markdown(listing.title[:80].replace('[', '(').replace(']', ')')),
+            url=listing.url,
+            address=escape_markdown(listing.address[:80])
+        ))
+    return "\n".join(lines)
+
+def get_listings_keyboard(query, page, has_next):
+    """Листание страниц, ссылка на выдачу Авито и возврат в меню"""
+    key = remember_listing_query(query)
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton(text="◀️", callback_data=RealEstatePage(page=page - 1, key=key).pack()))
+    if has_next:
+        navigation.append(InlineKeyboardButton(text="▶️", callback_data=RealEstatePage(page=page + 1, key=key).pack()))
+    rows = [navigation] if navigation else []
+    rows.append([InlineKeyboardButton(text="🏠 Открыть Авито", url=f"{REAL_ESTATE_URL}?q={quote(query)}")])
+    rows.append([BACK_TO_MENU_BUTTON])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+async def render_listings_page(query, page):
+    """Текст и клавиатура страницы или None, если объявлений на ней нет"""
+    # Одно лишнее объявление показывает, есть ли следующая страница
+    listings, _ = await get_listings(query, (page + 1) * REAL_ESTATE_PAGE_SIZE + 1)
+    if len(listings) <= page * REAL_ESTATE_PAGE_SIZE:
+        return None
+    has_next = len(listings) > (page + 1) * REAL_ESTATE_PAGE_SIZE
+    return format_listings_message(query, listings, page), get_listings_keyboard(query, page, has_next)
 
 # Логика поиска жилья
+@observe_latency
 async def process_real_estate_search_logic(message: types.Message, property_query: str):
     """Логика поиска жилья"""
     try:
@@ -577,50 +3075,29 @@ async def process_real_estate_search_logic(message: types.Message, property_quer
             )
             return
         
-        # Формируем ссылку на Авито недвижимость
-        from urllib.parse import quote
-        encoded_query = quote(property_query)
-        # Используем основной раздел недвижимости Авито с поиском
-        avito_url = f"https://www.avito.ru/rossiya/nedvizhimost?q={encoded_query}"
-        
-        # Отправляем ссылку с описанием
-        response_text = (
-            f"🏠 **Результаты поиска: {property_query}** 🏠\n\n"
-            f"🔗 **Откройте Авито для просмотра результатов:**\n"
-            f"{avito_url}\n\n"
-            f"🏡 **На Авито вы сможете:**\n"
-            f"• Найти квартиры, дома, комнаты\n"
-            f"• Сравнить цены разных продавцов\n"
-            f"• Посмотреть фото и описания\n"
-            f"• Связаться с владельцами\n"
-            f"• Выбрать покупку или аренду\n\n"
-            f"💡 **Совет:** Откройте ссылку в браузере на вашем устройстве!"
-        )
-        
-        # Inline кнопка для быстрого перехода
-        keyboard = InlineKeyboardMarkup(
-            inline_keyboard=[
-                [
-                    InlineKeyboardButton(
-                        text="🏠 Открыть Авито", 
-                        url=avito_url
-                    )
-                ],
-                [
-                    InlineKeyboardButton(text="🔙 Назад в меню", callback_data="back_to_menu")
-                ]
-            ]
-        )
+        # Показываем первую страницу объявлений; если выдачу получить не удалось - ссылку на Авито
+        property_query = property_query.strip()
+        try:
+            rendered = await render_listings_page(property_query, 0)
+        except Exception as e:
+            logger.error(f"Не удалось загрузить объявления по запросу '{property_query}': {e}")
+            rendered = None
         
-        await message.answer(
-            response_text,
-            parse_mode="Markdown",
-            reply_markup=keyboard
-        )
+        if rendered is not None:
+            text, keyboard = rendered
+            await message.answer(text, parse_mode="Markdown", reply_markup=keyboard, disable_web_page_preview=True)
+        else:
+            avito_url = f"{REAL_ESTATE_URL}?q={quote(property_query)}"
+            await message.answer(
+                REAL_ESTATE_RESULT_TEMPLATE.format(query=property_query, url=avito_url),
+                parse_mode="Markdown",
+                reply_markup=get_link_keyboard("🏠 Открыть Авито", avito_url)
+            )
         logger.info(f"Поиск жилья '{property_query}' для пользователя {message.from_user.id}")
         
     except Exception as e:
         logger.error(f"Ошибка при поиске жилья {property_query}: {e}")
+        reply_failed.set(True)
         await message.answer(
             "❌ Произошла ошибка при поиске жилья.\n\n"
             "🔄 Попробуйте еще раз:",
@@ -628,31 +3105,300 @@ async def process_real_estate_search_logic(message: types.Message, property_quer
             reply_markup=get_real_estate_keyboard()
         )
 
+# Листание страниц объявлений
+@dp.callback_query(RealEstatePage.filter())
+async def process_real_estate_page(callback: types.CallbackQuery, callback_data: RealEstatePage):
+    """Показывает страницу объявлений из курсора; страницы выдачи берутся из кэша"""
+    query = listing_queries.get(callback_data.key)
+    if query is None:
+        await answer_callback(callback, REAL_ESTATE_EXPIRED_TEXT)
+        return
+    try:
+        rendered = await render_listings_page(query, callback_data.page)
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке страницы объявлений '{query}': {e}")
+        await answer_callback(callback, REAL_ESTATE_LOAD_ERROR_TEXT)
+        return
+    
+    if rendered is None:
+        await answer_callback(callback, REAL_ESTATE_NO_MORE_TEXT)
+        return
+    await answer_callback(callback)
+    text, keyboard = rendered
+    try:
+        await callback.message.edit_text(text, parse_mode="Markdown", reply_markup=keyboard, disable_web_page_preview=True)
+    except Exception as e:
+        logger.error(f"Ошибка при показе страницы объявлений: {e}")
+
 # Дополнительная команда /help
 @dp.message(Command("help"))
 async def cmd_help(message: types.Message):
     """Обработчик команды /help"""
-    help_text = (
-        "❓ **Помощь по боту** ❓\n\n"
-        "🤖 **Доступные команды:**\n"
-        "/start - Начать работу с ботом\n"
-        "/help - Показать эту справку\n\n"
-        "🎯 **Функции бота:**\n"
-        "🌤️ Прогноз погоды (УЖЕ РАБОТАЕТ!)\n"
-        "🛒 Поиск товаров (УЖЕ РАБОТАЕТ!)\n"
-        "🏠 Поиск жилья (УЖЕ РАБОТАЕТ!)\n\n"
-        "📞 **Поддержка:**\n"
-        "Если у вас есть вопросы или предложения - пишите!"
-    )
+    await message.answer(HELP_TEXT, parse_mode="Markdown")
+
+# Хранилище ежедневных подписок на прогноз погоды
+class SubscriptionStore:
+    """Хранит подписки в SQLite: чат, город, координаты и минута дня рассылки"""
+    
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+    
+    def _connection(self):
+        """Открывает соединение с базой при первом обращении"""
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS subscriptions ("
+                "chat_id INTEGER NOT NULL, city TEXT NOT NULL, lat REAL NOT NULL, lon REAL NOT NULL, "
+                "minute INTEGER NOT NULL, last_sent TEXT, PRIMARY KEY (chat_id, city))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS subscriptions_minute ON subscriptions (minute)")
+            self._conn = conn
+        return self._conn
+    
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._connection().execute(sql, params).fetchall()
+    
+    async def add(self, chat_id, city, minute, last_sent):
+        """Добавляет или обновляет подписку; возвращает False, если превышен лимит"""
+        def _add():
+            with self._lock:
+                conn = self._connection()
+                count = conn.execute(
+                    "SELECT COUNT(*) FROM subscriptions WHERE chat_id = ? AND city != ?", (chat_id, city.name)
+                ).fetchone()[0]
+                if count >= SUBSCRIPTIONS_PER_CHAT:
+                    return False
+                conn.execute(
+                    "INSERT OR REPLACE INTO subscriptions (chat_id, city, lat, lon, minute, last_sent) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (chat_id, city.name, city.lat, city.lon, minute, last_sent)
+                )
+                return True
+        return await asyncio.to_thread(_add)
+    
+    async def remove(self, chat_id, city_name=None):
+        """Удаляет подписки чата (все или на один город); возвращает число удаленных"""
+        def _remove():
+            with self._lock:
+                conn = self._connection()
+                if city_name is None:
+                    cursor = conn.execute("DELETE FROM subscriptions WHERE chat_id = ?", (chat_id,))
+                else:
+                    cursor = conn.execute(
+                        "DELETE FROM subscriptions WHERE chat_id = ? AND city = ?", (chat_id, city_name)
+                    )
+                return cursor.rowcount
+        return await asyncio.to_thread(_remove)
+    
+    async def list_for_chat(self, chat_id):
+        """Возвращает подписки чата: [(город, минута дня), ...]"""
+        return await asyncio.to_thread(
+            self._execute, "SELECT city, minute FROM subscriptions WHERE chat_id = ? ORDER BY minute", (chat_id,)
+        )
+    
+    async def due(self, minute, today):
+        """Подписки, время которых наступило, а сегодня они еще не отправлены"""
+        return await asyncio.to_thread(
+            self._execute,
+            "SELECT chat_id, city, lat, lon FROM subscriptions "
+            "WHERE minute <= ? AND (last_sent IS NULL OR last_sent < ?)",
+            (minute, today)
+        )
+    
+    async def mark_sent(self, chat_ids, city_name, today):
+        """Отмечает рассылку по городу отправленной для перечисленных чатов"""
+        def _mark():
+            with self._lock:
+                self._connection().executemany(
+                    "UPDATE subscriptions SET last_sent = ? WHERE chat_id = ? AND city = ?",
+                    [(today, chat_id, city_name) for chat_id in chat_ids]
+                )
+        await asyncio.to_thread(_mark)
+    
+    async def close(self):
+        """Закрывает соединение с базой"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+subscription_store = SubscriptionStore(SUBSCRIPTIONS_DB_PATH)
+SUBSCRIPTIONS_TZ = timezone(timedelta(hours=SUBSCRIPTIONS_UTC_OFFSET))
+
+def subscription_now():
+    """Текущие минута дня и дата в часовом поясе рассылки"""
+    now = datetime.now(SUBSCRIPTIONS_TZ)
+    return now.hour * 60 + now.minute, now.date().isoformat()
+
+def parse_subscription_time(value):
+    """Переводит строку ЧЧ:ММ в минуту дня (или None)"""
+    match = re.fullmatch(r'(\d{1,2})[:.](\d{2})', value)
+    if not match:
+        return None
+    hours, minutes = int(match.group(1)), int(match.group(2))
+    if hours > 23 or minutes > 59:
+        return None
+    return hours * 60 + minutes
+
+# Рассылка ежедневных прогнозов
+class SubscriptionScheduler:
+    """Раз в минуту собирает наступившие подписки и рассылает прогноз, запрашивая каждый город один раз"""
+    
+    CITY_CONCURRENCY = 10  # Сколько городов обрабатывать одновременно
+    
+    def __init__(self, store, send_batch):
+        self.store = store
+        self.send_batch = send_batch
+        self.delivered = 0
+    
+    async def _send(self, chat_id, text):
+        """Отправляет прогноз одному подписчику; возвращает True при успехе"""
+        try:
+            await bot.send_message(chat_id, text, parse_mode="Markdown", reply_markup=get_weather_keyboard())
+            return True
+        except TelegramForbiddenError:
+            # Пользователь заблокировал бота - подписки ему больше не нужны
+            await self.store.remove(chat_id)
+            logger.info(f"Чат {chat_id} заблокировал бота, подписки удалены")
+        except Exception as e:
+            logger.error(f"Ошибка при отправке подписки в чат {chat_id}: {e}")
+        return False
+    
+    async def _deliver_city(self, city_name, lat, lon, chat_ids, today, slots):
+        """Получает и форматирует прогноз для города один раз и рассылает его всем подписчикам"""
+        async with slots:
+            weather_data = await get_weather_forecast(lat, lon)
+            if not weather_data:
+                logger.warning(f"Нет прогноза для рассылки по городу {city_name}, повтор через минуту")
+                return
+            text = format_weather_message(weather_data, city_name)
+        
+        # Рассылка идет в полосе с низким приоритетом, ответы пользователям не ждут
+        outgoing_priority.set(PRIORITY_BULK)
+        for start in range(0, len(chat_ids), self.send_batch):
+            batch = chat_ids[start:start + self.send_batch]
+            results = await asyncio.gather(*(self._send(chat_id, text) for chat_id in batch))
+            self.delivered += sum(results)
+        await self.store.mark_sent(chat_ids, city_name, today)
+        logger.info(f"Прогноз по городу {city_name} разослан {len(chat_ids)} подписчикам")
     
-    await message.answer(help_text, parse_mode="Markdown")
+    async def dispatch_due(self):
+        """Рассылает все наступившие подписки, сгруппировав их по координатам"""
+        minute, today = subscription_now()
+        rows = await self.store.due(minute, today)
+        if not rows:
+            return
+        
+        groups = {}
+        for chat_id, city_name, lat, lon in rows:
+            groups.setdefault((city_name, lat, lon), []).append(chat_id)
+        
+        slots = asyncio.Semaphore(self.CITY_CONCURRENCY)
+        await asyncio.gather(*(
+            self._deliver_city(city_name, lat, lon, chat_ids, today, slots)
+            for (city_name, lat, lon), chat_ids in groups.items()
+        ))
+    
+    async def run(self):
+        """Фоновый цикл рассылки (проверка в начале каждой минуты)"""
+        while True:
+            await asyncio.sleep(60 - time.time() % 60 + 1)
+            try:
+                await self.dispatch_due()
+            except Exception as e:
+                logger.error(f"Ошибка рассылки подписок: {e}")
+
+subscription_scheduler = SubscriptionScheduler(subscription_store, SUBSCRIPTIONS_SEND_BATCH)
+
+# Команда /subscribe <город> <ЧЧ:ММ>
+@dp.message(Command("subscribe"))
+async def cmd_subscribe(message: types.Message, command: CommandObject):
+    """Оформляет ежедневную подписку на прогноз погоды"""
+    try:
+        parts = (command.args or '').rsplit(maxsplit=1)
+        minute = parse_subscription_time(parts[1]) if len(parts) == 2 else None
+        if minute is None:
+            await message.answer(SUBSCRIBE_USAGE_TEXT, parse_mode="Markdown")
+            return
+        
+        city = find_city(parts[0])
+        if city is None:
+            await message.answer(f"❌ Город '{parts[0]}' не найден в базе данных.")
+            return
+        
+        # Если время сегодня уже прошло, первая рассылка будет завтра
+        current_minute, today = subscription_now()
+        last_sent = today if minute <= current_minute else None
+        if not await subscription_store.add(message.chat.id, city, minute, last_sent):
+            await message.answer(f"❌ Можно оформить не больше {SUBSCRIPTIONS_PER_CHAT} подписок.")
+            return
+        
+        await message.answer(
+            f"✅ Каждый день в {minute // 60:02d}:{minute % 60:02d} ({SUBSCRIPTIONS_TZ_LABEL}) пришлю прогноз для: {city.name}\n\n"
+            "📋 Мои подписки: /subscriptions",
+        )
+        logger.info(f"Пользователь {message.from_user.id} подписался на {city.name} в {parts[1]}")
+    except Exception as e:
+        logger.error(f"Ошибка при оформлении подписки: {e}")
+
+# Команда /subscriptions
+@dp.message(Command("subscriptions"))
+async def cmd_subscriptions(message: types.Message):
+    """Показывает подписки чата"""
+    try:
+        rows = await subscription_store.list_for_chat(message.chat.id)
+        if not rows:
+            await message.answer(NO_SUBSCRIPTIONS_TEXT)
+            return
+        lines = [f"• {city} - {minute // 60:02d}:{minute % 60:02d} ({SUBSCRIPTIONS_TZ_LABEL})" for city, minute in rows]
+        await message.answer("📬 Ваши подписки на прогноз:\n\n" + "\n".join(lines) + "\n\nОтменить: /unsubscribe [город]")
+    except Exception as e:
+        logger.error(f"Ошибка при выводе подписок: {e}")
+
+# Команда /unsubscribe [город]
+@dp.message(Command("unsubscribe"))
+async def cmd_unsubscribe(message: types.Message, command: CommandObject):
+    """Отменяет подписку на город или все подписки чата"""
+    try:
+        city_name = None
+        if command.args:
+            city = find_city(command.args)
+            city_name = city.name if city else command.args.strip()
+        removed = await subscription_store.remove(message.chat.id, city_name)
+        if removed:
+            await message.answer(f"✅ Отменено подписок: {removed}")
+        else:
+            await message.answer(NO_SUBSCRIPTIONS_TEXT)
+    except Exception as e:
+        logger.error(f"Ошибка при отмене подписки: {e}")
+
+# Команда /profile для администраторов: включает и выключает профилировщик
+@dp.message(Command("profile"))
+async def cmd_profile(message: types.Message):
+    """Переключает сэмплирующий профилировщик (только для ADMIN_IDS)"""
+    try:
+        if message.from_user.id not in ADMIN_IDS:
+            await message.answer(NOT_UNDERSTOOD_TEXT, parse_mode="Markdown", reply_markup=get_main_keyboard())
+            return
+        if profiler.toggle():
+            await message.answer(f"🔬 Профилировщик запущен (не дольше {PROFILE_MAX_SECONDS:.0f} с). Повторите /profile, чтобы остановить.")
+        else:
+            await message.answer(f"🔬 Профилировщик остановлен, профиль будет записан в {LOG_DIR}")
+        logger.info(f"Администратор {message.from_user.id} переключил профилировщик")
+    except Exception as e:
+        logger.error(f"Ошибка при переключении профилировщика: {e}")
 
 # Обработчик неизвестных callback'ов
 @dp.callback_query()
 async def process_unknown_callback(callback: types.CallbackQuery):
     """Обработчик неизвестных callback'ов"""
     try:
-        await callback.answer("Неизвестная команда")
+        await answer_callback(callback, "Неизвестная команда")
         logger.info(f"Неизвестный callback от пользователя {callback.from_user.id}: {callback.data}")
     except Exception as e:
         logger.error(f"Ошибка при обработке неизвестного callback: {e}")
@@ -665,18 +3411,14 @@ async def unknown_message(message: types.Message):
         # Если это не текстовое сообщение, показываем подсказку
         if message.content_type != ContentType.TEXT:
             await message.answer(
-                "🤔 **Поддерживаю только текстовые сообщения** 🤔\n\n"
-                "👇 Воспользуйтесь кнопками ниже или командой /start\n"
-                "для выбора нужной функции!",
+                ONLY_TEXT_HINT_TEXT,
                 parse_mode="Markdown",
                 reply_markup=get_main_keyboard()
             )
         # Если это текст, но мы в неопределенном режиме
-        elif current_mode == BotMode.IDLE:
+        elif await state_store.get_mode(message.chat.id) == BotMode.IDLE:
             await message.answer(
-                "🤔 **Не понял ваше сообщение** 🤔\n\n"
-                "👋 Воспользуйтесь кнопками ниже или командой /start\n"
-                "для выбора нужной функции!",
+                NOT_UNDERSTOOD_TEXT,
                 parse_mode="Markdown",
                 reply_markup=get_main_keyboard()
             )
@@ -685,45 +3427,660 @@ async def unknown_message(message: types.Message):
     except Exception as e:
         logger.error(f"Ошибка при обработке неизвестного сообщения: {e}")
 
+# Ограничение числа одновременно обрабатываемых обновлений вебхука
+webhook_slots = asyncio.Semaphore(UPDATES_CONCURRENCY)
+webhook_tasks = set()
+
+async def process_webhook_update(update, received_at):
+    """Передает обновление в диспетчер и освобождает слот обработки"""
+    try:
+        await dp.feed_update(bot, update, received_at=received_at)
+    except Exception as e:
+        logger.error(f"Ошибка при обработке обновления {update.update_id}: {e}")
+    finally:
+        webhook_slots.release()
+
+# Обработчик входящих запросов вебхука
+async def handle_webhook(request):
+    """Проверяет секретный токен и ставит обновление в обработку"""
+    token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not webhook_secret or not hmac.compare_digest(token.encode(), webhook_secret.encode()):
+        logger.warning(f"Запрос к вебхуку с неверным секретным токеном от {request.remote}")
+        return web.Response(status=401)
+    
+    if worker_pool is not None:
+        return await handle_sharded_webhook(request)
+    
+    try:
+        update = types.Update.model_validate(await request.json(), context={'bot': bot})
+    except Exception as e:
+        logger.error(f"Некорректное обновление в вебхуке: {e}")
+        return web.Response(status=400)
+    
+    # Если все слоты заняты, ответ Telegram задерживается - так он сам снижает темп доставки
+    received_at = time.monotonic()
+    await webhook_slots.acquire()
+    task = asyncio.create_task(process_webhook_update(update, received_at))
+    webhook_tasks.add(task)
+    task.add_done_callback(webhook_tasks.discard)
+    return web.Response()
+
+# Проверки для платформы: жив ли процесс и готов ли он принимать обновления
+async def handle_healthz(request):
+    """Процесс жив и цикл событий отвечает"""
+    return web.Response(text="ok" if running else "stopping", status=200 if running else 503)
+
+async def handle_readyz(request):
+    """Бот запущен, принимает обновления и (в многопроцессном режиме) все обработчики готовы"""
+    is_ready = ready and running
+    if is_ready and worker_pool is not None:
+        is_ready = all(worker_pool.is_ready(index) for index in range(worker_pool.size))
+    return web.Response(text="ready" if is_ready else "not ready", status=200 if is_ready else 503)
+
+# Метрики Prometheus
+async def handle_metrics(request):
+    """Отдает метрики бота в текстовом формате Prometheus"""
+    return web.Response(text=render_metrics(), content_type='text/plain', charset='utf-8')
+
+# Создание HTTP-приложения на PORT
+def create_web_app(with_webhook=True):
+    """Создает aiohttp-приложение с маршрутами бота"""
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    app.router.add_get('/healthz', handle_healthz)
+    app.router.add_get('/readyz', handle_readyz)
+    if DELIVERY_MODE == 'webhook' and with_webhook:
+        app.router.add_post(WEBHOOK_PATH, handle_webhook)
+    return app
+
+async def start_web_server(port=PORT, with_webhook=True):
+    """Запускает HTTP-сервер на PORT"""
+    global web_runner
+    web_runner = web.AppRunner(create_web_app(with_webhook), access_log=None)
+    await web_runner.setup()
+    await web.TCPSite(web_runner, '0.0.0.0', port).start()
+    logger.info(f"HTTP-сервер запущен на порту {port}")
+
+async def stop_web_server():
+    """Останавливает HTTP-сервер"""
+    global web_runner
+    if web_runner is not None:
+        await web_runner.cleanup()
+        web_runner = None
+
+# Готовность к приему обновлений
+def mark_ready(phase):
+    """Отмечает бота готовым, пишет разбивку времени запуска и прогревает справочник городов"""
+    global ready
+    ready = True
+    startup_timer.mark(phase)
+    logger.info(f"Бот готов к работе за {startup_timer.report()}")
+    # Справочник нужен только для погоды - загружаем после старта, не задерживая его
+    # (в многопроцессном режиме погоду обрабатывают обработчики, главному процессу он не нужен)
+    if worker_pool is None:
+        background_tasks.append(asyncio.create_task(asyncio.to_thread(gazetteer.load)))
+
+@dp.startup()
+async def on_polling_startup():
+    """Вызывается диспетчером перед началом long polling"""
+    mark_ready('запуск polling')
+
+# Обновления, накопленные за время перезапуска
+PENDING_BATCH = 100  # Максимум getUpdates за один запрос
+MODE_CALLBACKS = frozenset({'weather', 'products', 'real_estate', 'back_to_menu'})  # Кнопки смены режима
+
+def pending_update_role(update):
+    """'mode' - кнопка смены режима, 'command' - команда, 'text' - обычный текст, None - прочее"""
+    if update.callback_query is not None:
+        return 'mode' if update.callback_query.data in MODE_CALLBACKS else None
+    if update.message is not None and update.message.text:
+        return 'command' if update.message.text.startswith('/') else 'text'
+    return None
+
+def keep_pending_update(kept, update):
+    """Добавляет обновление к накопленным обновлениям чата kept, отбрасывая то, что им уже перекрыто.
+    Команды не отбрасываются никогда; кнопка смены режима перекрывает все остальное до нее;
+    из текстов подряд важен последний (из пяти городов подряд - последний)"""
+    role = pending_update_role(update)
+    if role == 'mode':
+        kept[:] = [previous for previous in kept if pending_update_role(previous) == 'command']
+    elif role == 'text' and kept and pending_update_role(kept[-1]) == 'text':
+        kept.pop()
+    kept.append(update)
+
+async def collect_pending_updates():
+    """Выбирает накопленные обновления большими пачками и оставляет у каждого чата то, что еще актуально.
+    Возвращает {ключ чата: [обновление, ...]} в исходном порядке внутри чата"""
+    allowed_updates = dp.resolve_used_update_types()
+    chats = {}  # ключ чата -> [обновление, ...]
+    offset = None
+    total = outdated = 0
+    while True:
+        updates = await bot.get_updates(offset=offset, limit=PENDING_BATCH, timeout=0, allowed_updates=allowed_updates)
+        if not updates:
+            break  # Запрос со сдвинутым offset подтвердил все выбранное
+        now = time.time()
+        for update in updates:
+            offset = update.update_id + 1
+            total += 1
+            event = update.event
+            date = getattr(event, 'date', None)
+            if date is not None and now - date.timestamp() > PENDING_MAX_AGE:
+                outdated += 1
+                continue
+            keep_pending_update(chats.setdefault(update_chat_key(update.model_dump(mode='json', exclude_none=True)), []), update)
+    
+    if total:
+        kept = sum(len(updates) for updates in chats.values())
+        logger.info(f"Накопилось обновлений: {total}, устаревших: {outdated}, к обработке: {kept} в {len(chats)} чатах")
+    return chats
+
+async def drain_pending_updates():
+    """Снимает вебхук и обрабатывает накопленное (или отбрасывает его при PENDING_UPDATES=drop)"""
+    if PENDING_UPDATES == 'drop':
+        await bot.delete_webhook(drop_pending_updates=True)
+        return
+    await bot.delete_webhook(drop_pending_updates=False)
+    try:
+        chats = await collect_pending_updates()
+    except Exception as e:
+        logger.error(f"Не удалось получить накопленные обновления: {e}")
+        return
+    if not chats:
+        return
+    started = time.monotonic()
+    
+    # Многопроцессный режим: очередность внутри чата соблюдают обработчики
+    if worker_pool is not None:
+        for updates in chats.values():
+            for update in updates:
+                while not worker_pool.submit(update.model_dump(mode='json', exclude_none=True), started):
+                    await asyncio.sleep(0.05)
+        return
+    
+    # Справочник нужен погоде - загружаем заранее, а не при первом же городе в цикле событий
+    await asyncio.to_thread(gazetteer.load)
+    slots = asyncio.Semaphore(UPDATES_CONCURRENCY)
+    
+    async def process_chat(updates):
+        async with slots:
+            for update in updates:
+                try:
+                    await dp.feed_update(bot, update, received_at=started)
+                except Exception as e:
+                    logger.error(f"Ошибка при обработке накопленного обновления {update.update_id}: {e}")
+    
+    await asyncio.gather(*(process_chat(updates) for updates in chats.values()))
+    logger.info(f"Накопленные обновления обработаны за {time.monotonic() - started:.1f} с")
+
+# Запуск в режиме вебхука
+# Секретный токен вебхука: без него любой мог бы прислать поддельное обновление от имени любого пользователя
+webhook_secret = WEBHOOK_SECRET
+
+async def run_webhook():
+    """Регистрирует вебхук и принимает обновления через HTTP-сервер на PORT"""
+    global webhook_secret
+    if not webhook_secret:
+        webhook_secret = secrets.token_urlsafe(32)
+        logger.warning("WEBHOOK_SECRET не задан - сгенерирован случайный; для нескольких экземпляров бота задайте общий")
+    # getUpdates работает только без вебхука: накопленное разбираем до его регистрации
+    await drain_pending_updates()
+    startup_timer.mark('накопленные обновления')
+    await bot.set_webhook(
+        f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+        secret_token=webhook_secret,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=min(UPDATES_CONCURRENCY, 100)
+    )
+    logger.info(f"✅ Бот запущен в режиме вебхука: {WEBHOOK_URL}{WEBHOOK_PATH}")
+    mark_ready('регистрация вебхука')
+    
+    # Обновления приходят через HTTP-сервер, ждем завершения работы
+    while running:
+        await asyncio.sleep(1)
+
+# Запуск в режиме long polling
+async def run_polling():
+    """Получает обновления через long polling"""
+    # Разбираем накопленные обновления до начала обычного polling
+    await drain_pending_updates()
+    startup_timer.mark('накопленные обновления')
+    
+    # Запускаем polling
+    logger.info("✅ Бот запущен и готов к работе!")
+    await dp.start_polling(
+        bot,
+        allowed_updates=dp.resolve_used_update_types(),  # ИЗМЕНЕНИЕ: добавлен allowed_updates
+        tasks_concurrency_limit=UPDATES_CONCURRENCY,
+        handle_signals=False  # SIGINT/SIGTERM ловит signal_handler: перед выходом нужно сохранить снимок
+    )
+
+# Многопроцессный режим: главный процесс только принимает обновления и раскладывает их по обработчикам
+def update_chat_key(data):
+    """Ключ шардирования сырого обновления: id чата, иначе id пользователя, иначе update_id"""
+    for key, event in data.items():
+        if key == 'update_id' or not isinstance(event, dict):
+            continue
+        chat = event.get('chat') or (event.get('message') or {}).get('chat')
+        if chat:
+            return chat['id']
+        if event.get('from'):
+            return event['from']['id']
+    return data.get('update_id', 0)
+
+class WorkerPool:
+    """Процессы-обработчики: у каждого своя очередь, обновления одного чата всегда попадают в один процесс"""
+    
+    def __init__(self, size):
+        # Нужен только в многопроцессном режиме - не замедляет обычный запуск
+        import multiprocessing
+        self.size = size
+        self._context = multiprocessing.get_context('spawn')
+        self.processes = [None] * size
+        self.queues = [None] * size
+        self.heartbeats = [self._context.Value('d', 0.0, lock=False) for _ in range(size)]  # 0 - еще запускается
+        self.started_at = [0.0] * size
+        self.routed = [0] * size
+        self.restarts = [0] * size
+    
+    def _spawn(self, index):
+        """Запускает (или перезапускает) обработчик с новой очередью"""
+        self.queues[index] = self._context.Queue(WORKER_QUEUE_SIZE)
+        self.heartbeats[index].value = 0.0
+        self.started_at[index] = time.time()
+        os.environ['BOT_WORKER_ID'] = str(index)
+        try:
+            process = self._context.Process(
+                target=worker_main,
+                args=(index, self.queues[index], self.heartbeats[index]),
+                name=f"bot-worker-{index}",
+                daemon=True
+            )
+            process.start()
+        finally:
+            del os.environ['BOT_WORKER_ID']
+        self.processes[index] = process
+        logger.info(f"Запущен обработчик {index} (pid {process.pid})")
+    
+    def start(self):
+        for index in range(self.size):
+            self._spawn(index)
+    
+    def submit(self, data, received_at):
+        """Кладет сырое обновление в очередь обработчика; False, если очередь переполнена"""
+        index = update_chat_key(data) % self.size
+        try:
+            self.queues[index].put_nowait((data, received_at))
+        except queue.Full:
+            return False
+        self.routed[index] += 1
+        return True
+    
+    def is_healthy(self, index):
+        if not self.processes[index].is_alive():
+            return False
+        heartbeat = self.heartbeats[index].value
+        if heartbeat == 0.0:
+            return time.time() - self.started_at[index] < WORKER_START_TIMEOUT
+        return time.time() - heartbeat < WORKER_HEARTBEAT_TIMEOUT
+    
+    def is_ready(self, index):
+        """Обработчик запустился и отвечает"""
+        return self.heartbeats[index].value > 0 and self.is_healthy(index)
+    
+    async def supervise(self, interval=5):
+        """Фоновая задача: перезапускает упавшие и зависшие обработчики"""
+        while True:
+            await asyncio.sleep(interval)
+            for index in range(self.size):
+                if self.is_healthy(index):
+                    continue
+                process = self.processes[index]
+                logger.error(f"Обработчик {index} не отвечает (код выхода {process.exitcode}), перезапускаю; "
+                             f"обновления из его очереди потеряны")
+                if process.is_alive():
+                    process.kill()
+                await asyncio.to_thread(process.join, WORKER_STOP_TIMEOUT)
+                self.queues[index].cancel_join_thread()
+                self.restarts[index] += 1
+                self._spawn(index)
+    
+    async def stop(self):
+        """Просит обработчики доделать очереди и завершиться, зависшие останавливает принудительно"""
+        for worker_queue in self.queues:
+            try:
+                await asyncio.to_thread(worker_queue.put, None, True, WORKER_STOP_TIMEOUT)
+            except queue.Full:
+                pass
+        for index, process in enumerate(self.processes):
+            await asyncio.to_thread(process.join, WORKER_STOP_TIMEOUT)
+            if process.is_alive():
+                logger.warning(f"Обработчик {index} не завершился за {WORKER_STOP_TIMEOUT:.0f} с, останавливаю принудительно")
+                process.kill()
+                await asyncio.to_thread(process.join)
+        logger.info("Обработчики остановлены")
+
+# Пул обработчиков (создается в main при WORKERS > 1)
+worker_pool = None
+
+async def handle_sharded_webhook(request):
+    """Вебхук в многопроцессном режиме: только разбор JSON и передача в очередь обработчика"""
+    try:
+        data = await request.json()
+    except Exception as e:
+        logger.error(f"Некорректное обновление в вебхуке: {e}")
+        return web.Response(status=400)
+    # Очередь переполнена - Telegram повторит доставку позже
+    if not worker_pool.submit(data, time.monotonic()):
+        return web.Response(status=503)
+    return web.Response()
+
+async def run_sharded_polling():
+    """Long polling в главном процессе с раскладкой обновлений по обработчикам"""
+    await drain_pending_updates()
+    logger.info(f"✅ Бот запущен и готов к работе! Обработчиков: {WORKERS}")
+    mark_ready('накопленные обновления')
+    allowed_updates = dp.resolve_used_update_types()
+    offset = None
+    while running:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+        except Exception as e:
+            logger.error(f"Ошибка получения обновлений: {e}")
+            await asyncio.sleep(1)
+            continue
+        received_at = time.monotonic()
+        for update in updates:
+            data = update.model_dump(mode='json', exclude_none=True)
+            # Очередь обработчика полна - ждем, не теряя порядок обновлений
+            while not worker_pool.submit(data, received_at):
+                await asyncio.sleep(0.05)
+            offset = update.update_id + 1
+
+class ChatSequencer:
+    """Обрабатывает обновления одного чата строго по очереди, разных чатов - параллельно"""
+    
+    def __init__(self, limit):
+        self._slots = asyncio.Semaphore(limit)
+        self._chats = {}  # ключ чата -> очередь (обновление, время приема)
+        self.tasks = set()
+    
+    def submit(self, data, received_at):
+        key = update_chat_key(data)
+        pending = self._chats.get(key)
+        if pending is not None:
+            pending.append((data, received_at))
+            return
+        self._chats[key] = deque([(data, received_at)])
+        task = asyncio.create_task(self._drain(key))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+    
+    async def _drain(self, key):
+        pending = self._chats[key]
+        while pending:
+            data, received_at = pending[0]
+            async with self._slots:
+                try:
+                    update = types.Update.model_validate(data, context={'bot': bot})
+                    await dp.feed_update(bot, update, received_at=received_at)
+                except Exception as e:
+                    logger.error(f"Ошибка при обработке обновления {data.get('update_id')}: {e}")
+            pending.popleft()
+        del self._chats[key]
+
+def worker_main(index, update_queue, heartbeat):
+    """Точка входа процесса-обработчика"""
+    # Ctrl+C получает вся группа процессов, а завершением обработчиков управляет главный процесс
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(run_worker(index, update_queue, heartbeat))
+
+async def run_worker(index, update_queue, heartbeat):
+    """Обработчик: принимает обновления из очереди и выполняет обработчики dp"""
+    loop = asyncio.get_running_loop()
+    incoming = asyncio.Queue()
+    sequencer = ChatSequencer(UPDATES_CONCURRENCY)
+    
+    def read_updates():
+        # Блокирующее чтение из межпроцессной очереди - в отдельном потоке
+        while True:
+            item = update_queue.get()
+            loop.call_soon_threadsafe(incoming.put_nowait, item)
+            if item is None:
+                return
+    
+    async def send_heartbeats():
+        while True:
+            heartbeat.value = time.time()
+            await asyncio.sleep(1)
+    
+    await start_weather_client()
+    load_snapshot()
+    await start_web_server(PORT + 1 + index, with_webhook=False)
+    background_tasks.append(asyncio.create_task(send_heartbeats()))
+    background_tasks.append(asyncio.create_task(monitor_event_loop_lag()))
+    if LOOP_WATCHDOG:
+        background_tasks.append(loop_watchdog.start())
+    background_tasks.append(asyncio.create_task(weather_refresher.run()))
+    background_tasks.append(asyncio.create_task(start_chart_pool()))
+    # Рассылки по подпискам выполняет один обработчик
+    if index == 0:
+        background_tasks.append(asyncio.create_task(subscription_scheduler.run()))
+    threading.Thread(target=read_updates, name='update-reader', daemon=True).start()
+    startup_timer.mark('запуск обработчика')
+    logger.info(f"Обработчик {index} готов за {startup_timer.report()}, метрики на порту {PORT + 1 + index}")
+    background_tasks.append(asyncio.create_task(asyncio.to_thread(gazetteer.load)))
+    
+    while (item := await incoming.get()) is not None:
+        sequencer.submit(*item)
+    
+    # Доделываем начатое и освобождаем ресурсы
+    if sequencer.tasks:
+        await asyncio.wait(sequencer.tasks, timeout=WORKER_STOP_TIMEOUT)
+    for task in background_tasks:
+        task.cancel()
+    loop_watchdog.stop()
+    profiler.stop()
+    await stop_web_server()
+    await close_weather_client()
+    try:
+        save_snapshot()
+    except Exception as e:
+        logger.error(f"Не удалось сохранить снимок: {e}")
+    await close_market_client()
+    close_chart_pool()
+    await state_store.close()
+    await subscription_store.close()
+    await bot.session.close()
+    logger.info(f"Обработчик {index} остановлен")
+    log_writer.stop()
+
+# Снимок кэшей и режимов чатов для теплого перезапуска
+SNAPSHOT_MAGIC = b'PIHTA-SNAPSHOT/1\n'  # Формат: заголовок + JSON, сжатый zlib
+
+def snapshot_path():
+    """Файл снимка этого процесса (у обработчиков свои кэши и свои файлы)"""
+    if not SNAPSHOT_PATH:
+        return ''
+    return f"{SNAPSHOT_PATH}.{PROCESS_NAME}" if PROCESS_NAME else SNAPSHOT_PATH
+
+def snapshot_sections():
+    """Что попадает в снимок: имя -> (объект со snapshot/restore, восстановление ключа, восстановление значения)"""
+    sections = {
+        'weather': (weather_cache, tuple, None),
+        'listings': (listings_cache, tuple, lambda page: [Listing(*item) for item in page]),
+        'listing_queries': (listing_queries, None, None),
+        'chart_file_ids': (chart_file_ids, tuple, None)
+    }
+    # SQLite хранит режимы сам и переживает перезапуск без снимка
+    if isinstance(state_store, MemoryStateStore):
+        sections['modes'] = (state_store, None, None)
+    return sections
+
+def save_snapshot():
+    """Сохраняет живые записи кэшей и режимы чатов в файл (атомарно через переименование)"""
+    path = snapshot_path()
+    # Главный процесс многопроцессного режима своих кэшей не держит
+    if not path or worker_pool is not None:
+        return
+    started = time.perf_counter()
+    data = {name: target.snapshot() for name, (target, _, _) in snapshot_sections().items()}
+    payload = SNAPSHOT_MAGIC + zlib.compress(json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(f"{path}.tmp", 'wb') as f:
+        f.write(payload)
+    os.replace(f"{path}.tmp", path)
+    counts = ", ".join(f"{name}={len(entries)}" for name, entries in data.items())
+    logger.info(f"Снимок сохранен в {path}: {len(payload) // 1024} КБ за {(time.perf_counter() - started) * 1000:.0f} мс ({counts})")
+
+def load_snapshot():
+    """Восстанавливает кэши и режимы чатов из снимка, пропуская истекшие записи; файл после чтения удаляется"""
+    path = snapshot_path()
+    if not path or not os.path.exists(path):
+        return
+    try:
+        with open(path, 'rb') as f:
+            payload = f.read()
+        os.remove(path)
+        if not payload.startswith(SNAPSHOT_MAGIC):
+            logger.warning(f"Снимок {path} в неизвестном формате, пропускаю")
+            return
+        data = json.loads(zlib.decompress(payload[len(SNAPSHOT_MAGIC):]))
+        counts = []
+        for name, (target, decode_key, decode_value) in snapshot_sections().items():
+            entries = [
+                (decode_key(key) if decode_key else key, expires, decode_value(value) if decode_value else value)
+                for key, expires, value in data.get(name, [])
+            ]
+            counts.append(f"{name}={target.restore(entries)}/{len(entries)}")
+        logger.info(f"Снимок загружен из {path}: {', '.join(counts)}")
+    except Exception as e:
+        logger.error(f"Не удалось загрузить снимок {path}: {e}")
+
 async def shutdown():
     """Корректное завершение работы бота"""
-    global running
+    global running, ready
     running = False
+    ready = False
     logger.info("Получен сигнал завершения. Останавливаю бота...")
     try:
+        # Сначала перестаем принимать обновления, чтобы в снимок не попало полуобработанное
+        try:
+            await dp.stop_polling()
+        except RuntimeError:
+            pass  # Polling не запущен: вебхук, несколько процессов или polling уже закончился
+        for task in background_tasks:
+            task.cancel()
+        loop_watchdog.stop()
+        profiler.stop()
+        await stop_web_server()
+        if worker_pool is not None:
+            await worker_pool.stop()
+        try:
+            save_snapshot()
+        except Exception as e:
+            logger.error(f"Не удалось сохранить снимок: {e}")
+        await close_weather_client()
+        await close_market_client()
+        close_chart_pool()
+        await state_store.close()
+        await subscription_store.close()
         await bot.session.close()
         logger.info("Бот успешно остановлен")
     except Exception as e:
         logger.error(f"Ошибка при завершении: {e}")
+    log_writer.stop()
     sys.exit(0)
 
+# Задача завершения (main дожидается ее, если прием обновлений закончился раньше)
+shutdown_task = None
+
 def signal_handler(signum, frame):
     """Обработчик сигналов для корректного завершения"""
+    global shutdown_task
     logger.info(f"Получен сигнал {signum}. Завершение работы...")
-    asyncio.create_task(shutdown())
+    if shutdown_task is None:
+        shutdown_task = asyncio.create_task(shutdown())
+
+def profile_signal_handler(signum, frame):
+    """SIGUSR1 включает и выключает профилировщик"""
+    state = "запущен" if profiler.toggle() else "остановлен"
+    logger.info(f"Получен сигнал {signum}: профилировщик {state}")
+
+async def run_ingress():
+    """Главный процесс многопроцессного режима: прием обновлений и надзор за обработчиками"""
+    global worker_pool
+    await start_web_server()
+    startup_timer.mark('HTTP-сервер')
+    worker_pool = WorkerPool(WORKERS)
+    worker_pool.start()
+    startup_timer.mark('запуск обработчиков')
+    background_tasks.append(asyncio.create_task(worker_pool.supervise()))
+    
+    if DELIVERY_MODE == 'webhook' and WEBHOOK_URL:
+        await run_webhook()
+    else:
+        if DELIVERY_MODE == 'webhook':
+            logger.warning("WEBHOOK_URL не задан, бот запускается в режиме polling")
+        await run_sharded_polling()
 
 async def main():
     """Главная функция для запуска бота"""
     # Регистрируем обработчики сигналов
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
+    signal.signal(signal.SIGUSR1, profile_signal_handler)
     
     try:
         logger.info("🤖 Запуск Telegram бота 'Бот на все случаи жизни'...")
         logger.info(f"Токен бота: {'*' * (len(BOT_TOKEN) - 10) + BOT_TOKEN[-10:] if len(BOT_TOKEN) > 10 else '***'}")
         logger.info(f"API ключ погоды: {WEATHER_API_KEY[:10]}...")
         
-        # Пропускаем накопленные обновления
-        await bot.delete_webhook(drop_pending_updates=True)
+        # Несколько процессов: здесь только прием обновлений, обработка - в обработчиках
+        if WORKERS > 1:
+            await run_ingress()
+            if shutdown_task is not None:
+                await shutdown_task
+            return
         
-        # Запускаем polling
-        logger.info("✅ Бот запущен и готов к работе!")
-        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())  # ИЗМЕНЕНИЕ: добавлен allowed_updates
+        # HTTP-сервер на PORT: проверки готовности, метрики и вебхук - первым, чтобы платформа видела процесс
+        await start_web_server()
+        startup_timer.mark('HTTP-сервер')
+        
+        # Открываем пул соединений к API погоды
+        await start_weather_client()
+        
+        # Теплый перезапуск: кэши и режимы чатов из снимка, сохраненного при остановке
+        load_snapshot()
+        startup_timer.mark('снимок')
+        
+        # Запускаем фоновые задачи
+        background_tasks.append(asyncio.create_task(monitor_event_loop_lag()))
+        if LOOP_WATCHDOG:
+            background_tasks.append(loop_watchdog.start())
+        background_tasks.append(asyncio.create_task(weather_refresher.run()))
+        background_tasks.append(asyncio.create_task(subscription_scheduler.run()))
+        background_tasks.append(asyncio.create_task(start_chart_pool()))
+        
+        if DELIVERY_MODE == 'webhook' and WEBHOOK_URL:
+            await run_webhook()
+        else:
+            if DELIVERY_MODE == 'webhook':
+                logger.warning("WEBHOOK_URL не задан, бот запускается в режиме polling")
+            await run_polling()
+        
+        # Polling мог закончиться и без сигнала - завершаемся тем же путем
+        if shutdown_task is None:
+            await shutdown()
+        else:
+            await shutdown_task
         
     except Exception as e:
         logger.error(f"❌ Ошибка при запуске бота: {e}")
         await shutdown()
 
+startup_timer.mark('инициализация')
+
 if __name__ == "__main__":
     # Запуск бота
     asyncio.run(main())
\ No newline at end of file
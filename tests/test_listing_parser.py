@@ -0,0 +1,65 @@
+"""Потоковый разбор выдачи Авито на сохраненной странице bench/fixtures/avito_search.html"""
+import codecs
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURE_PATH = os.path.join(ROOT_DIR, 'bench', 'fixtures', 'avito_search.html')
+BASE_URL = 'https://www.avito.ru/rossiya/nedvizhimost'
+
+# main.py читает настройки при импорте и без ключей завершает работу
+os.environ.setdefault('BOT_TOKEN', '123456789:TESTTESTTESTTESTTESTTESTTESTTESTTES')
+os.environ.setdefault('WEATHER_API_KEY', 'test')
+os.environ.setdefault('LOG_DIR', tempfile.mkdtemp(prefix='bot-test-'))
+sys.path.insert(0, ROOT_DIR)
+
+from main import Listing, ListingParser  # noqa: E402
+
+EXPECTED = [
+    Listing('1-к. квартира, 38 м², 5/15 эт.', '45 000 ₽ в месяц', 'ул. Профсоюзная, 56',
+            'https://www.avito.ru/moskva/kvartiry/1-k._kvartira_38m_515et._3012345671'),
+    Listing('Студия, 24 м², 3/9 эт.', '32 000 ₽ в месяц', 'Варшавское ш., 141к2',
+            'https://www.avito.ru/moskva/kvartiry/studiya_24m_39et._3012345672'),
+    Listing('2-к. квартира, 54 м², 12/17 эт.', '14 500 000 ₽', 'ул. Академика Королёва, 8',
+            'https://www.avito.ru/moskva/kvartiry/2-k._kvartira_54m_1217et._3012345673'),
+    Listing('Дом 120 м² на участке 6 сот.', '9 800 000 ₽', 'Истра, СНТ «Берёзка»',
+            'https://www.avito.ru/moskovskaya_oblast_istra/doma_dachi_kottedzhi/dom_120m_na_uchastke_6sot._3012345674'),
+    Listing('Комната 14 м² в 3-к., 2/5 эт.', '18 000 ₽ в месяц', 'ул. Бутлерова, 12',
+            'https://www.avito.ru/moskva/komnaty/komnata_14m_v_3-k._25et._3012345675'),
+    Listing('3-к. квартира, 78 м², 7/22 эт.', '23 900 000 ₽', 'Ленинский пр-т, 99',
+            'https://www.avito.ru/moskva/kvartiry/3-k._kvartira_78m_722et._3012345676'),
+    Listing('1-к. квартира, 41 м², 10/25 эт.', '52 000 ₽ в месяц', 'ул. Лётчика Бабушкина, 1',
+            'https://www.avito.ru/moskva/kvartiry/1-k._kvartira_41m_1025et._3012345677'),
+    Listing('Студия, 19 м², 1/5 эт.', '6 900 000 ₽', 'ул. Сайкина, 3 & 5',
+            'https://www.avito.ru/moskva/kvartiry/studiya_19m_15et._3012345678'),
+    Listing('Таунхаус 96 м² на участке 2 сот.', '15 200 000 ₽', 'Одинцово, мкр. Мичуринец',
+            'https://www.avito.ru/moskovskaya_oblast_odintsovo/doma_dachi_kottedzhi/taunhaus_96m_3012345679'),
+    Listing('2-к. квартира, 60 м², 4/9 эт.', '70 000 ₽ в месяц', 'ул. Миклухо-Маклая, 42',
+            'https://www.avito.ru/moskva/kvartiry/2-k._kvartira_60m_49et._3012345680'),
+    Listing('Апартаменты-студия, 28 м², 18/30 эт.', '11 300 000 ₽', 'Пресненская наб., 12',
+            'https://www.avito.ru/moskva/kvartiry/apartamenty-studiya_28m_1830et._3012345681'),
+    Listing('1-к. квартира, 33 м², 2/12 эт.', '39 000 ₽ в месяц', 'ул. Молодцова, 27',
+            'https://www.avito.ru/moskva/kvartiry/1-k._kvartira_33m_212et._3012345682'),
+]
+
+
+def parse_in_chunks(payload, chunk_size):
+    """Подает страницу парсеру кусками байтов, как fetch_listings_page"""
+    parser = ListingParser(BASE_URL)
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    for start in range(0, len(payload), chunk_size):
+        parser.feed(decoder.decode(payload[start:start + chunk_size]))
+    parser.feed(decoder.decode(b'', final=True))
+    parser.close()
+    return parser.listings
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 64, None])
+def test_fixture_parses_the_same_in_any_chunking(chunk_size):
+    with open(FIXTURE_PATH, 'rb') as f:
+        payload = f.read()
+    # Куски по 1 и 7 байт режут и теги, и многобайтные символы UTF-8
+    assert parse_in_chunks(payload, chunk_size or len(payload)) == EXPECTED
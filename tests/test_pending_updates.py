@@ -0,0 +1,65 @@
+"""Разбор обновлений, накопленных за время перезапуска"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from unittest import mock
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# main.py читает настройки при импорте и без ключей завершает работу
+os.environ.setdefault('BOT_TOKEN', '123456789:TESTTESTTESTTESTTESTTESTTESTTESTTES')
+os.environ.setdefault('WEATHER_API_KEY', 'test')
+os.environ.setdefault('LOG_DIR', tempfile.mkdtemp(prefix='bot-test-'))
+sys.path.insert(0, ROOT_DIR)
+
+import main  # noqa: E402
+
+CHAT_ID = 42
+USER = {'id': CHAT_ID, 'is_bot': False, 'first_name': 'test'}
+
+
+def message(update_id, text):
+    data = {'message_id': update_id, 'date': int(time.time()), 'chat': {'id': CHAT_ID, 'type': 'private'},
+            'from': USER, 'text': text}
+    if text.startswith('/'):
+        data['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return main.types.Update.model_validate({'update_id': update_id, 'message': data})
+
+
+def callback(update_id, data):
+    return main.types.Update.model_validate({'update_id': update_id, 'callback_query': {
+        'id': str(update_id), 'chat_instance': 'test', 'data': data, 'from': USER,
+        'message': {'message_id': 1, 'date': int(time.time()), 'chat': {'id': CHAT_ID, 'type': 'private'}, 'text': 'menu'}
+    }})
+
+
+def collect(backlog):
+    """Прогоняет collect_pending_updates на заглушке getUpdates; возвращает [(тип, текст или data), ...]"""
+    batches = [backlog, []]
+
+    async def get_updates(**kwargs):
+        return batches.pop(0)
+
+    with mock.patch.object(main.bot, 'get_updates', get_updates):
+        chats = asyncio.run(main.collect_pending_updates())
+    return [
+        ('callback', update.callback_query.data) if update.callback_query else ('message', update.message.text)
+        for updates in chats.values() for update in updates
+    ]
+
+
+def test_commands_survive_and_replay_starts_at_last_mode_button():
+    backlog = [message(1, '/subscribe Самара 08:00'), callback(2, 'weather'), message(3, 'Москва'), callback(4, 'products')]
+    assert collect(backlog) == [('message', '/subscribe Самара 08:00'), ('callback', 'products')]
+
+
+def test_text_after_mode_button_is_replayed_in_that_mode():
+    backlog = [
+        callback(1, 'products'), message(2, 'Чайник'), callback(3, 'weather'), message(4, 'Тверь'),
+        message(5, '/help'), message(6, 'Псков'), message(7, 'Москва'),
+    ]
+    assert collect(backlog) == [
+        ('callback', 'weather'), ('message', 'Тверь'), ('message', '/help'), ('message', 'Москва'),
+    ]
@@ -0,0 +1,81 @@
+"""Остановка бота по SIGTERM в режиме long polling: снимок должен сохраниться"""
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+
+from aiohttp import web
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_TOKEN = '123456789:TESTTESTTESTTESTTESTTESTTESTTESTTES'
+
+
+def free_port():
+    """Возвращает свободный локальный порт"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def serve_telegram_stub(port, polling, stop):
+    """Заглушка Bot API в отдельном потоке; polling выставляется на первом долгом getUpdates"""
+    async def telegram_handler(request):
+        method = request.match_info['method']
+        fields = await request.post()
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'test', 'username': 'test_bot'}
+        elif method == 'getUpdates':
+            result = []
+            if int(fields.get('timeout', 0)) > 0:
+                polling.set()
+                await asyncio.sleep(0.5)
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def serve():
+        app = web.Application()
+        app.router.add_route('*', '/bot{token}/{method}', telegram_handler)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        while not stop.is_set():
+            await asyncio.sleep(0.1)
+        await runner.cleanup()
+
+    asyncio.run(serve())
+
+
+def test_sigterm_in_polling_mode_saves_snapshot(tmp_path):
+    tg_port = free_port()
+    polling, stop = threading.Event(), threading.Event()
+    stub = threading.Thread(target=serve_telegram_stub, args=(tg_port, polling, stop), daemon=True)
+    stub.start()
+
+    env = dict(
+        os.environ,
+        BOT_TOKEN=BOT_TOKEN,
+        WEATHER_API_KEY='test',
+        LOG_DIR=str(tmp_path),
+        TELEGRAM_API_URL=f'http://127.0.0.1:{tg_port}',
+        PORT=str(free_port()),
+        DELIVERY_MODE='polling',
+        WORKERS='1',
+    )
+    env.pop('SNAPSHOT_PATH', None)
+    bot = subprocess.Popen([sys.executable, os.path.join(ROOT_DIR, 'main.py')], env=env, cwd=str(tmp_path),
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        assert polling.wait(60), "бот так и не начал long polling"
+        bot.send_signal(signal.SIGTERM)
+        assert bot.wait(30) == 0
+    finally:
+        if bot.poll() is None:
+            bot.kill()
+        stop.set()
+        stub.join(5)
+
+    assert (tmp_path / 'snapshot.bin').exists()